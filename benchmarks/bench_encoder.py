@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк сжатия изображения под бюджет байт.
+
+Сравнивает прежний `image_utils.compress_image` (качество 95→20 с шагом 5,
+затем масштаб 0.9→0.3 с шагом 0.1, полное кодирование на каждом шаге) с
+`utils.image_encoder.encode_to_budget` (бисекция по probe и одно-три полных
+кодирования) на синтетических фото 1024/2048/4000px. Печатает число полных
+кодирований, время, итоговый размер и качество.
+
+Запуск: python benchmarks/bench_encoder.py [--sizes 1024 2048 4000] [--budgets 100 300 500 1000] [--webp]
+"""
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+from typing import Tuple
+
+from PIL import Image, ImageChops, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.image_encoder import encode_to_budget  # noqa: E402
+
+
+def legacy_compress(img: Image.Image, target_size_kb: int) -> Tuple[bytes, int, int]:
+    """Прежний цикл из image_utils.compress_image; возвращает (байты, качество, число кодирований)."""
+    encodes = 0
+    quality = 95
+    while quality > 20:
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=quality, optimize=True)
+        encodes += 1
+        if len(output.getvalue()) / 1024 <= target_size_kb:
+            return output.getvalue(), quality, encodes
+        quality -= 5
+
+    scale = 0.9
+    while scale > 0.3:
+        resized = img.resize((int(img.width * scale), int(img.height * scale)), Image.Resampling.LANCZOS)
+        output = BytesIO()
+        resized.save(output, format='JPEG', quality=85, optimize=True)
+        encodes += 1
+        if len(output.getvalue()) / 1024 <= target_size_kb:
+            return output.getvalue(), 85, encodes
+        scale -= 0.1
+    return output.getvalue(), 85, encodes
+
+
+def synthetic_photo(width: int, height: int) -> Image.Image:
+    """Фото-подобное изображение: крупные пятна, зерно и градиент (без numpy)."""
+    blobs = Image.effect_noise((max(1, width // 8), max(1, height // 8)), 90).resize((width, height), Image.BICUBIC)
+    grain = Image.effect_noise((width, height), 25)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    channels = (ImageChops.add(blobs, grain, 2), gradient, ImageChops.blend(blobs, grain, 0.5))
+    return Image.merge("RGB", channels).filter(ImageFilter.DETAIL)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4000])
+    parser.add_argument("--budgets", type=int, nargs="+", default=[100, 300, 500, 1000], help="бюджеты, КБ")
+    parser.add_argument("--webp", action="store_true", help="дополнительно кодировать новым энкодером в WebP")
+    args = parser.parse_args()
+
+    print(
+        f"{'size':>6} {'KB':>5} | {'legacy: enc':>11} {'ms':>7} {'KB':>5} {'q':>3} "
+        f"| {'budget: enc':>11} {'probe':>5} {'ms':>7} {'KB':>5} {'q':>3} {'scale':>5} | {'speedup':>7}"
+    )
+    for size in args.sizes:
+        photo = synthetic_photo(size, size * 3 // 4)
+        for budget_kb in args.budgets:
+            started = time.perf_counter()
+            legacy_data, legacy_quality, legacy_encodes = legacy_compress(photo, budget_kb)
+            legacy_ms = (time.perf_counter() - started) * 1000
+
+            formats = ["JPEG", "WEBP"] if args.webp else ["JPEG"]
+            for format in formats:
+                started = time.perf_counter()
+                result = encode_to_budget(photo, budget_kb * 1024, format=format)
+                budget_ms = (time.perf_counter() - started) * 1000
+                label = "" if format == "JPEG" else " webp"
+                print(
+                    f"{size:>6} {budget_kb:>5} | {legacy_encodes:>11} {legacy_ms:>7.0f} {len(legacy_data) // 1024:>5} "
+                    f"{legacy_quality:>3} | {result.encodes:>11} {result.probe_encodes:>5} {budget_ms:>7.0f} "
+                    f"{len(result.data) // 1024:>5} {result.quality:>3} {result.size[0] / size:>5.2f} "
+                    f"| {legacy_ms / budget_ms:>6.1f}x{label}"
+                )
+
+
+if __name__ == "__main__":
+    main()
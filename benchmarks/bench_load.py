@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Офлайн нагрузочный бенчмарк пайплайна на заглушках провайдеров.
+
+Поднимает локальные заглушки Anthropic и Replicate (benchmarks/stand_ins.py)
+с логнормальными задержками и опциональными 429, направляет на них SDK через
+ANTHROPIC_BASE_URL / REPLICATE_BASE_URL и прогоняет заданное число задач
+с целевой конкурентностью. Кэши результатов, спецификаций и пул портретов
+выключены, каждая задача получает уникальное фото товара.
+
+Режимы:
+- sync  — generate_hat_on_model в пуле потоков;
+- async — agenerate_hat_on_model под семафором;
+- bot   — handle_photo с поддельным Update через очередь JOB_QUEUE
+          (QUEUE_WORKERS = --concurrency, фото распределяются по --chats чатам,
+          --album-size N отправляет каждую задачу альбомом из N фото).
+
+Отчет: пропускная способность, p50/p95/p99 латентности, ошибки, пиковый RSS,
+процессорное время на задачу, число запросов к заглушкам и 429, отправленные и скачанные байты, повторы генерации base
+портрета и хеджирование предсказаний (--cold-start-* задают хвост задержек, --hedge-percentile включает дубликаты).
+--output-format задает формат результата FLUX Fill на стороне заглушки, --trace-memory печатает пик Python-кучи
+(tracemalloc) на задачу в работе.
+
+Запуск: python benchmarks/bench_load.py [--mode async] [--jobs 40] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable, List, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stand_ins import Latency, StandInProviders, StandInSettings  # noqa: E402
+
+
+def _rss_mb() -> float:
+    """Текущий RSS процесса; без /proc (macOS) — пиковый."""
+    try:
+        with open("/proc/self/statm") as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def product_photo(index: int, size: int = 640) -> bytes:
+    """Уникальное фото «шапки»: иначе перцептивные хеши склеят задачи."""
+    rng = random.Random(index)
+    image = Image.new("RGB", (size, size), (240, 240, 240))
+    draw = ImageDraw.Draw(image)
+    color = tuple(rng.randrange(40, 220) for _ in range(3))
+    draw.pieslice((size * 0.15, size * 0.2, size * 0.85, size * 0.95), 180, 360, fill=color)
+    for _ in range(12):
+        x, y = rng.randrange(size), rng.randrange(size // 2)
+        draw.ellipse((x, y, x + size // 10, y + size // 10), fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _configure_environment(url: str, args: argparse.Namespace, workdir: str) -> None:
+    """Переменные окружения до импорта пайплайна: CONFIG читается при импорте."""
+    os.environ.update({
+        "ANTHROPIC_API_KEY": "stand-in",
+        "ANTHROPIC_BASE_URL": url,
+        "REPLICATE_API_TOKEN": "stand-in",
+        "REPLICATE_BASE_URL": url,
+        "REPLICATE_POLL_INTERVAL": str(args.poll_interval),
+        "REPLICATE_PREDICTIONS_PATH": os.path.join(workdir, "predictions.json"),
+        "REPLICATE_RATE_PER_MINUTE": str(args.replicate_rate),
+        "REPLICATE_MAX_RATE_PER_MINUTE": str(max(args.replicate_rate, 600)),
+        "REPLICATE_UPLOAD_FILES": "0" if args.data_uris else "1",
+        "REPLICATE_HEDGE_PERCENTILE": str(args.hedge_percentile),
+        "REPLICATE_HEDGE_MIN_SAMPLES": str(args.hedge_min_samples),
+        "REPLICATE_HEDGE_MAX_PER_HOUR": str(args.hedge_max_per_hour),
+        "FLUX_OUTPUT_FORMAT": args.output_format,
+        "FLUX_OUTPUT_QUALITY": str(args.output_quality),
+        "RESULT_CACHE": "0",
+        "SPEC_CACHE": "0",
+        "BASE_POOL_SIZE": "0",
+        "MASK_DEBUG": "0",
+        "QUEUE_WORKERS": str(args.concurrency),
+        "QUEUE_MAX_LENGTH": str(max(args.jobs, 1)),
+    })
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _timed(func: Callable[[], object]) -> Tuple[float, Optional[str]]:
+    started = time.perf_counter()
+    try:
+        func()
+    except Exception as error:  # noqa: BLE001
+        return time.perf_counter() - started, type(error).__name__
+    return time.perf_counter() - started, None
+
+
+def run_sync(photos: List[bytes], concurrency: int) -> List[Tuple[float, Optional[str]]]:
+    from pipeline.hat_on_model import generate_hat_on_model
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as pool:
+        return list(pool.map(lambda photo: _timed(lambda: generate_hat_on_model(photo).final_image.close()), photos))
+
+
+async def run_async(photos: List[bytes], concurrency: int) -> List[Tuple[float, Optional[str]]]:
+    from pipeline.hat_on_model import agenerate_hat_on_model
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(photo: bytes) -> Tuple[float, Optional[str]]:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                (await agenerate_hat_on_model(photo)).final_image.close()
+            except Exception as error:  # noqa: BLE001
+                return time.perf_counter() - started, type(error).__name__
+            return time.perf_counter() - started, None
+
+    return await asyncio.gather(*(one(photo) for photo in photos))
+
+
+class _FakeFile:
+    def __init__(self, data: bytes, file_id: str):
+        self._data = data
+        self.file_id = file_id
+
+    async def download_as_bytearray(self) -> bytearray:
+        return bytearray(self._data)
+
+
+class _FakePhotoSize:
+    def __init__(self, data: bytes, file_id: str):
+        self._file = _FakeFile(data, file_id)
+
+    async def get_file(self) -> _FakeFile:
+        return self._file
+
+
+class _FakeMessage:
+    """Минимальная замена telegram.Message: ответы только считаются."""
+
+    def __init__(
+        self,
+        photo: Optional[List[_FakePhotoSize]] = None,
+        text: str = "",
+        message_id: int = 0,
+        media_group_id: Optional[str] = None,
+    ):
+        self.photo = photo
+        self.text = text
+        self.message_id = message_id
+        self.media_group_id = media_group_id
+        self.replies: List[str] = []
+
+    async def reply_text(self, text: str, **kwargs) -> "_FakeMessage":
+        self.replies.append(text)
+        return _FakeMessage(text=text)
+
+    async def reply_photo(self, photo, caption: str = "", **kwargs) -> "_FakeMessage":
+        # telegram.InputFile читает файловый объект целиком — повторяем это для честной памяти
+        if hasattr(photo, "read"):
+            photo.read()
+        self.replies.append(caption)
+        return _FakeMessage()
+
+    async def edit_text(self, text: str, **kwargs) -> "_FakeMessage":
+        self.text = text
+        return self
+
+
+class _FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+
+class _FakeUpdate:
+    def __init__(self, chat_id: int, photo: bytes, index: int, media_group_id: Optional[str] = None):
+        self.message = _FakeMessage(
+            photo=[_FakePhotoSize(photo, f"bench-{index}")], message_id=index, media_group_id=media_group_id
+        )
+        self.effective_chat = _FakeChat(chat_id)
+
+
+async def run_bot(photos: List[bytes], chats: int, album_size: int = 1) -> List[Tuple[float, Optional[str]]]:
+    """Каждая задача — одно фото или альбом из album_size фото (отдельные обновления с общим media_group_id)."""
+    import bot
+
+    bot.JOB_QUEUE.start()
+    try:
+        async def one(job: int, album: List[bytes]) -> Tuple[float, Optional[str]]:
+            group_id = f"album-{job}" if len(album) > 1 else None
+            updates = [
+                _FakeUpdate(1000 + job % chats, photo, job * album_size + offset, group_id)
+                for offset, photo in enumerate(album)
+            ]
+            started = time.perf_counter()
+            await asyncio.gather(*(bot.handle_photo(update, None) for update in updates))
+            # handle_photo не пробрасывает ошибки: исход виден по ответам
+            replies = [reply for update in updates for reply in update.message.replies]
+            failed = any(reply.startswith(("❌", "⏳", "🛑")) for reply in replies)
+            return time.perf_counter() - started, "handler" if failed else None
+
+        albums = [photos[start:start + album_size] for start in range(0, len(photos), album_size)]
+        return await asyncio.gather(*(one(job, album) for job, album in enumerate(albums)))
+    finally:
+        await bot.JOB_QUEUE.stop()
+
+
+def _guard_retries() -> float:
+    from pipeline.hat_on_model import GUARD_RETRIES
+    from utils.metrics import REGISTRY
+
+    total = 0.0
+    for line in REGISTRY.render().splitlines():
+        if line.startswith(GUARD_RETRIES.name + "{"):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+def _hedging_stats() -> dict:
+    from providers.replicate_flux import HEDGING
+
+    stats = HEDGING.stats()
+    return {name: stats[name] for name in ("predictions", "hedged", "hedge_rate", "hedge_wins", "saved_seconds_total")}
+
+
+def _http_stats() -> List[str]:
+    from utils.http import http_stats
+
+    return [
+        f"{host}: requests={entry['requests']} reuse_rate={entry['reuse_rate']} p50_ms={entry.get('p50_ms')}"
+        for host, entry in sorted(http_stats()["hosts"].items())
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("sync", "async", "bot"), default="async")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--chats", type=int, default=4, help="Число чатов в режиме bot")
+    parser.add_argument("--album-size", type=int, default=1, help="Фото в альбоме на задачу в режиме bot")
+    parser.add_argument("--claude-latency", type=float, default=0.8, help="Медиана задержки Claude, с")
+    parser.add_argument("--flux-base-latency", type=float, default=2.0, help="Медиана генерации base, с")
+    parser.add_argument("--flux-fill-latency", type=float, default=4.0, help="Медиана FLUX Fill, с")
+    parser.add_argument("--download-latency", type=float, default=0.05, help="Медиана загрузки файла, с")
+    parser.add_argument("--sigma", type=float, default=0.35, help="Разброс логнормальных задержек")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--cold-start-probability", type=float, default=0.0,
+                        help="Доля предсказаний с холодным стартом")
+    parser.add_argument("--cold-start-seconds", type=float, default=0.0, help="Добавка холодного старта, с")
+    parser.add_argument("--hedge-percentile", type=float, default=0.0, help="REPLICATE_HEDGE_PERCENTILE")
+    parser.add_argument("--hedge-min-samples", type=int, default=10, help="REPLICATE_HEDGE_MIN_SAMPLES")
+    parser.add_argument("--hedge-max-per-hour", type=int, default=1000, help="REPLICATE_HEDGE_MAX_PER_HOUR")
+    parser.add_argument("--headwear-probability", type=float, default=0.0,
+                        help="Доля портретов, забракованных проверкой головного убора")
+    parser.add_argument("--image-size", type=int, default=512, help="Сторона портрета заглушки, px")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="REPLICATE_POLL_INTERVAL, с")
+    parser.add_argument("--replicate-rate", type=int, default=600, help="REPLICATE_RATE_PER_MINUTE")
+    parser.add_argument("--data-uris", action="store_true",
+                        help="Встраивать изображения FLUX Fill data URI вместо files API")
+    parser.add_argument("--output-format", default="jpg", help="FLUX_OUTPUT_FORMAT: png | jpg | webp")
+    parser.add_argument("--output-quality", type=int, default=0, help="FLUX_OUTPUT_QUALITY (0 — не передавать)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Пик Python-кучи через tracemalloc (замедляет прогон)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Не глушить INFO-логи пайплайна")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    settings = StandInSettings(
+        claude=Latency(args.claude_latency, args.sigma),
+        flux_base=Latency(args.flux_base_latency, args.sigma),
+        flux_fill=Latency(args.flux_fill_latency, args.sigma),
+        download=Latency(args.download_latency, args.sigma),
+        rate_limit_probability=args.rate_limit_probability,
+        cold_start_probability=args.cold_start_probability,
+        cold_start_seconds=args.cold_start_seconds,
+        headwear_probability=args.headwear_probability,
+        image_size=args.image_size,
+        seed=args.seed,
+    )
+    workdir = tempfile.mkdtemp(prefix="bench-load-")
+    cwd = os.getcwd()
+    try:
+        with StandInProviders(settings) as stand_in:
+            _configure_environment(stand_in.url, args, workdir)
+            # Пайплайн и бот пишут cache/ и outputs/ относительно текущей директории
+            os.chdir(workdir)
+            album_size = max(1, args.album_size) if args.mode == "bot" else 1
+            photos = [product_photo(args.seed * 100_000 + index) for index in range(args.jobs * album_size)]
+
+            rss_start = _rss_mb()
+            if args.trace_memory:
+                tracemalloc.start()
+                heap_start = tracemalloc.get_traced_memory()[0]
+            cpu_start = _cpu_seconds()
+            started = time.perf_counter()
+            if args.mode == "sync":
+                results = run_sync(photos, args.concurrency)
+            elif args.mode == "async":
+                results = asyncio.run(run_async(photos, args.concurrency))
+            else:
+                results = asyncio.run(run_bot(photos, args.chats, album_size))
+            wall = time.perf_counter() - started
+            cpu = _cpu_seconds() - cpu_start
+            if args.trace_memory:
+                heap_peak = tracemalloc.get_traced_memory()[1] - heap_start
+                tracemalloc.stop()
+            requests = dict(stand_in.requests)
+            request_bytes = {name: size for name, size in stand_in.request_bytes.items() if size}
+            response_bytes = {name: size for name, size in stand_in.response_bytes.items() if size}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = [elapsed for elapsed, error in results if error is None]
+    errors = [error for _, error in results if error is not None]
+    print(f"mode={args.mode} jobs={args.jobs} concurrency={args.concurrency} wall={wall:.1f}s")
+    print(f"throughput: {len(latencies) / wall * 60:.1f} jobs/min, errors: {len(errors)} {sorted(set(errors))}")
+    if latencies:
+        print(
+            "latency, s: "
+            + " ".join(f"p{p}={_percentile(latencies, p):.2f}" for p in (50, 95, 99))
+            + f" max={max(latencies):.2f}"
+        )
+    print(f"rss, MB: start={rss_start:.0f} end={_rss_mb():.0f} peak={_peak_rss_mb():.0f}")
+    if args.trace_memory:
+        # Пик кучи делится на число одновременно выполняемых задач
+        print(
+            f"python heap peak, MB: total={heap_peak / 2**20:.1f} "
+            f"per in-flight job={heap_peak / 2**20 / max(1, min(args.concurrency, args.jobs)):.1f}"
+        )
+    # Процессорное время процесса, включая заглушки (они работают в нем же)
+    print(f"cpu per job, ms: {cpu / max(len(results), 1) * 1000:.0f}")
+    print("stand-in requests: " + " ".join(f"{name}={count}" for name, count in sorted(requests.items())))
+    print(
+        "request KB per job: "
+        + " ".join(f"{name}={size / 1024 / max(args.jobs, 1):.0f}" for name, size in sorted(request_bytes.items()))
+    )
+    print(
+        "response KB per job: "
+        + " ".join(f"{name}={size / 1024 / max(args.jobs, 1):.0f}" for name, size in sorted(response_bytes.items()))
+    )
+    print(f"guard retries: {_guard_retries():.0f}")
+    print("hedging: " + " ".join(f"{name}={value}" for name, value in _hedging_stats().items()))
+    # Скачивания результатов идут через общий клиент utils/http.py
+    print("http client: " + ("; ".join(_http_stats()) or "-"))
+
+
+if __name__ == "__main__":
+    main()
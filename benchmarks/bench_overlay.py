@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк построения debug overlay маски.
+
+Сравнивает прежнюю попиксельную реализацию (getpixel/draw.point) с текущей
+`_create_overlay_image` на 512, 1024 и 2048px и проверяет, что результаты
+совпадают пиксель в пиксель.
+
+Запуск: python benchmarks/bench_overlay.py [--sizes 512 1024 2048] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+from PIL import Image, ImageChops, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline.hat_on_model import _create_overlay_image  # noqa: E402
+from utils.mask import _ellipse_mask  # noqa: E402
+
+
+def legacy_overlay(base_image: Image.Image, mask_l: Image.Image) -> Image.Image:
+    """Прежняя реализация: обход каждого пикселя в Python."""
+    overlay = base_image.copy().convert("RGBA")
+    red_mask = Image.new("RGBA", base_image.size, (255, 0, 0, 0))
+    red_draw = ImageDraw.Draw(red_mask)
+    mask_resized = mask_l.resize(base_image.size)
+    for y in range(base_image.size[1]):
+        for x in range(base_image.size[0]):
+            if mask_resized.getpixel((x, y)) > 128:
+                red_draw.point((x, y), fill=(255, 0, 0, 128))
+    overlay = Image.alpha_composite(overlay, red_mask)
+    return overlay.convert("RGB")
+
+
+def _best_of(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'legacy, ms':>12} {'vectorized, ms':>15} {'speedup':>9}")
+    for size in args.sizes:
+        base = Image.radial_gradient("L").resize((size, size)).convert("RGB")
+        mask = _ellipse_mask((size, size))
+
+        if ImageChops.difference(legacy_overlay(base, mask), _create_overlay_image(base, mask)).getbbox():
+            raise SystemExit(f"Результаты отличаются на {size}px")
+
+        # Попиксельная версия на 2048px работает секунды — меряем ее один раз
+        legacy = _best_of(lambda: legacy_overlay(base, mask), 1 if size >= 2048 else args.repeat)
+        vectorized = _best_of(lambda: _create_overlay_image(base, mask), args.repeat)
+        print(f"{size:>6} {legacy * 1000:>12.1f} {vectorized * 1000:>15.2f} {legacy / vectorized:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""
+Локальные заглушки провайдеров для офлайн-бенчмарков.
+
+Один HTTP-сервер эмулирует:
+- Anthropic Messages API (`POST /v1/messages`): спецификация шапки или YES/NO проверки
+  головного убора;
+- предсказания Replicate (`POST /v1/models/<owner>/<name>/predictions`,
+  `GET /v1/predictions/<id>`, `POST /v1/predictions/<id>/cancel`): предсказание
+  «выполняется» заданное время, затем отдает ссылку на файл;
+- files API Replicate (`POST /v1/files`, multipart): файл принимается и получает ссылку;
+- раздачу результатов (`GET /files/<id>.<png|jpg|webp>`) в формате из `output_format` предсказания.
+
+Задержки берутся из логнормального распределения (медиана и sigma), 429 с
+Retry-After выдаются с заданной вероятностью. Для каждого вида запроса
+считаются принятые байты (`request_bytes`) — трафик входных изображений — и отданные (`response_bytes`). Часть предсказаний может
+получать «холодный старт» — добавочную задержку, образующую длинный хвост. Клиенты направляются на заглушки
+через ANTHROPIC_BASE_URL и REPLICATE_BASE_URL.
+"""
+from __future__ import annotations
+
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, ImageChops, ImageDraw
+
+SPEC = {
+    "category": "beanie",
+    "color": "red",
+    "knit": "rib",
+    "cuff": True,
+    "pompom": False,
+    "patch": None,
+}
+
+
+@dataclass
+class Latency:
+    """Логнормальная задержка: медиана в секундах и разброс sigma."""
+
+    median: float
+    sigma: float = 0.35
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(rng.gauss(0.0, self.sigma))
+
+
+@dataclass
+class StandInSettings:
+    claude: Latency = field(default_factory=lambda: Latency(0.8))
+    flux_base: Latency = field(default_factory=lambda: Latency(2.0))
+    flux_fill: Latency = field(default_factory=lambda: Latency(4.0))
+    download: Latency = field(default_factory=lambda: Latency(0.05))
+    rate_limit_probability: float = 0.0
+    # Доля предсказаний с холодным стартом и его добавочная задержка
+    cold_start_probability: float = 0.0
+    cold_start_seconds: float = 0.0
+    # Доля портретов, на которых «Claude» находит головной убор (для нагрузки на guard)
+    headwear_probability: float = 0.0
+    retry_after_seconds: float = 1.0
+    image_size: int = 512
+    # Sigma гауссова шума: делает PNG ближе по размеру к настоящим генерациям
+    image_noise: int = 6
+    seed: int = 0
+
+
+def portrait_png(size: int, noise: int) -> bytes:
+    """Условный портрет без головного убора: светлый фон, темные волосы, лицо."""
+    image = Image.new("RGB", (size, size), (228, 226, 222))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((size * 0.29, size * 0.12, size * 0.71, size * 0.82), fill=(62, 42, 30))
+    draw.ellipse((size * 0.36, size * 0.3, size * 0.64, size * 0.7), fill=(214, 176, 150))
+    if noise:
+        grain = Image.effect_noise((size, size), noise).convert("RGB")
+        image = ImageChops.add(image, grain, scale=1.0, offset=-128)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class StandInProviders:
+    """HTTP-сервер заглушек в фоновом потоке."""
+
+    def __init__(self, settings: Optional[StandInSettings] = None, host: str = "127.0.0.1", port: int = 0):
+        self.settings = settings or StandInSettings()
+        self._rng = random.Random(self.settings.seed)
+        self._rng_lock = threading.Lock()
+        self._predictions: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.requests: Counter = Counter()
+        self.request_bytes: Counter = Counter()
+        self.response_bytes: Counter = Counter()
+        self.image = portrait_png(self.settings.image_size, self.settings.image_noise)
+        self._encoded: Dict[Tuple[str, int], bytes] = {("png", 0): self.image}
+
+        handler = type("Handler", (_Handler,), {"stand_in": self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StandInProviders":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stand-ins", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StandInProviders":
+        return self.start()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+    def count(self, name: str, received: int = 0, sent: int = 0) -> None:
+        with self._lock:
+            self.requests[name] += 1
+            self.request_bytes[name] += received
+            self.response_bytes[name] += sent
+
+    def encoded_image(self, extension: str, quality: int) -> bytes:
+        """Результат в формате output_format (качество output_quality, 0 — по умолчанию модели)."""
+        key = (extension, quality if extension != "png" else 0)
+        with self._lock:
+            encoded = self._encoded.get(key)
+        if encoded is None:
+            buffer = BytesIO()
+            image = Image.open(BytesIO(self.image)).convert("RGB")
+            image.save(buffer, format="JPEG" if extension == "jpg" else "WEBP", quality=quality or 80)
+            encoded = buffer.getvalue()
+            with self._lock:
+                self._encoded[key] = encoded
+        return encoded
+
+    def delay(self, latency: Latency) -> float:
+        with self._rng_lock:
+            return latency.sample(self._rng)
+
+    def cold_start(self) -> float:
+        with self._rng_lock:
+            cold = self._rng.random() < self.settings.cold_start_probability
+        return self.settings.cold_start_seconds if cold else 0.0
+
+    def rate_limited(self) -> bool:
+        with self._rng_lock:
+            return self._rng.random() < self.settings.rate_limit_probability
+
+    def create_prediction(self, model: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        latency = self.settings.flux_fill if "mask" in payload.get("input", {}) else self.settings.flux_base
+        prediction_id = uuid.uuid4().hex[:16]
+        with self._lock:
+            self._predictions[prediction_id] = {
+                "id": prediction_id,
+                "model": model,
+                "outputs": int(payload.get("input", {}).get("num_outputs", 1)),
+                "format": _OUTPUT_EXTENSIONS.get(payload.get("input", {}).get("output_format", "png"), "png"),
+                "quality": int(payload.get("input", {}).get("output_quality", 0)),
+                "ready_at": time.monotonic() + self.delay(latency) + self.cold_start(),
+                "canceled": False,
+            }
+        return self.prediction_json(prediction_id)
+
+    def prediction_json(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._predictions.get(prediction_id)
+            if record is None:
+                return None
+            if record["canceled"]:
+                status = "canceled"
+            elif time.monotonic() >= record["ready_at"]:
+                status = "succeeded"
+            else:
+                status = "processing"
+        output = None
+        if status == "succeeded":
+            output = [
+                f"{self.url}/files/{prediction_id}-{index}-q{record['quality']}.{record['format']}"
+                for index in range(record["outputs"])
+            ]
+        return {
+            "id": prediction_id,
+            "model": record["model"],
+            "version": "stand-in",
+            "status": status,
+            "input": {},
+            "output": output,
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": "2024-01-01T00:00:00Z",
+            "urls": {
+                "get": f"{self.url}/v1/predictions/{prediction_id}",
+                "cancel": f"{self.url}/v1/predictions/{prediction_id}/cancel",
+            },
+        }
+
+    def create_file(self, size: int) -> Dict[str, Any]:
+        file_id = uuid.uuid4().hex[:16]
+        return {
+            "id": file_id,
+            "name": f"{file_id}.png",
+            "content_type": "image/png",
+            "size": size,
+            "etag": file_id,
+            "checksums": {},
+            "metadata": {},
+            "created_at": "2024-01-01T00:00:00Z",
+            "expires_at": None,
+            "urls": {"get": f"{self.url}/v1/files/{file_id}/download"},
+        }
+
+    def cancel_prediction(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if prediction_id in self._predictions:
+                self._predictions[prediction_id]["canceled"] = True
+        return self.prediction_json(prediction_id)
+
+    def headwear_answer(self) -> str:
+        with self._rng_lock:
+            return "YES" if self._rng.random() < self.settings.headwear_probability else "NO"
+
+    def claude_message(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        # Запрос спецификации отличается системным промптом; проверка головного убора — YES/NO,
+        # пакетная проверка нескольких портретов — строки «N: YES/NO»
+        content = request["messages"][0]["content"]
+        images = sum(1 for block in content if block.get("type") == "image")
+        if "system" in request:
+            text = json.dumps(SPEC)
+        elif images > 1:
+            text = "\n".join(f"{number}: {self.headwear_answer()}" for number in range(1, images + 1))
+        else:
+            text = self.headwear_answer()
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:12]}",
+            "type": "message",
+            "role": "assistant",
+            "model": request.get("model", "stand-in"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": 1200, "output_tokens": 40},
+        }
+
+
+_MODEL_PREDICTIONS = re.compile(r"^/v1/models/([^/]+)/([^/]+)/predictions$")
+_PREDICTION = re.compile(r"^/v1/predictions/([^/]+)(/cancel)?$")
+_FILE = re.compile(r"^/files/[^/]+-q(\d+)\.(png|jpg|webp)$")
+_OUTPUT_EXTENSIONS = {"png": "png", "jpg": "jpg", "jpeg": "jpg", "webp": "webp"}
+_CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    stand_in: StandInProviders
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Tuple[Tuple[str, str], ...] = ()) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status: int, payload: Any, headers: Tuple[Tuple[str, str], ...] = ()) -> None:
+        self._send(status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    def _too_many_requests(self) -> None:
+        retry_after = str(self.stand_in.settings.retry_after_seconds)
+        self._json(429, {"detail": "Request was throttled", "status": 429}, (("Retry-After", retry_after),))
+
+    def do_POST(self) -> None:  # noqa: N802
+        stand_in = self.stand_in
+        body = self._read_body()
+        if self.path == "/v1/files":
+            stand_in.count("replicate_file", len(body))
+            self._json(201, stand_in.create_file(len(body)))
+            return
+
+        request = json.loads(body or b"{}")
+        if self.path.split("?")[0] == "/v1/messages":
+            stand_in.count("anthropic", len(body))
+            if stand_in.rate_limited():
+                stand_in.count("anthropic_429")
+                self._json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "stand-in"}},
+                           (("retry-after", str(stand_in.settings.retry_after_seconds)),))
+                return
+            time.sleep(stand_in.delay(stand_in.settings.claude))
+            self._json(200, stand_in.claude_message(request))
+            return
+
+        match = _MODEL_PREDICTIONS.match(self.path)
+        if match:
+            stand_in.count("replicate_create", len(body))
+            if stand_in.rate_limited():
+                stand_in.count("replicate_429")
+                self._too_many_requests()
+                return
+            self._json(201, stand_in.create_prediction(f"{match.group(1)}/{match.group(2)}", request))
+            return
+
+        match = _PREDICTION.match(self.path)
+        if match and match.group(2):
+            stand_in.count("replicate_cancel")
+            prediction = stand_in.cancel_prediction(match.group(1))
+            self._json(200 if prediction else 404, prediction or {"detail": "Not found"})
+            return
+        self._json(404, {"detail": "Not found"})
+
+    def do_GET(self) -> None:  # noqa: N802
+        stand_in = self.stand_in
+        match = _PREDICTION.match(self.path)
+        if match and not match.group(2):
+            stand_in.count("replicate_poll")
+            prediction = stand_in.prediction_json(match.group(1))
+            self._json(200 if prediction else 404, prediction or {"detail": "Not found"})
+            return
+
+        match = _FILE.match(self.path)
+        if match:
+            image = stand_in.encoded_image(match.group(2), int(match.group(1)))
+            stand_in.count("download", sent=len(image))
+            time.sleep(stand_in.delay(stand_in.settings.download))
+            self._send(200, image, _CONTENT_TYPES[match.group(2)])
+            return
+        self._json(404, {"detail": "Not found"})
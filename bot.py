@@ -1,22 +1,49 @@
 import asyncio
 import json
 import os
+import time
 from datetime import datetime
 from io import BytesIO
+from typing import List, Optional, Sequence, Tuple
 
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Message, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 
 # ВАЖНО: load_dotenv() должен быть ДО импорта config
 load_dotenv()
 
 from config import CONFIG
-from pipeline.hat_on_model import generate_hat_on_model
+from pipeline.hat_on_model import BASE_POOL, RESULT_CACHE, SPEC_CACHE, agenerate_hat_on_model, start_base_pool
+from pipeline.job_queue import FairJobQueue, JobCancelledError, QueueFullError
+from providers.cassette import PROVIDER_CASSETTE
+from providers.replicate_flux import (
+    REPLICATE_LIMITER,
+    PredictionCanceledError,
+    acancel_predictions,
+    asweep_orphaned_predictions,
+    prediction_owner,
+    prediction_stats,
+)
+from utils.albums import AlbumCollector
+from utils.http import http_stats
 from utils.logging import get_logger
+from utils.mask import get_mask_stats, load_sam_model
+from utils.metrics import Histogram, start_metrics_server
+from utils.progress import TELEGRAM_SECONDS, ProgressMessage
 
 logger = get_logger(__name__)
 
+JOB_SECONDS = Histogram("bot_job_seconds", "От получения фото до отправки результата", ("outcome",))
+
+JOB_QUEUE = FairJobQueue(workers=CONFIG.pipeline.queue_workers, max_length=CONFIG.pipeline.queue_max_length)
+
+# Фото альбома: (сообщение, байты, file_id)
+AlbumPhoto = Tuple[Message, bytes, str]
+# Альбом собирается из сообщений до скачивания: медленная загрузка одного фото
+# не должна выпасть из окна и запустить вторую задачу
+ALBUMS: AlbumCollector[Message] = AlbumCollector(CONFIG.pipeline.album_window_seconds)
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
@@ -25,50 +52,159 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает состояние очереди, пула base портретов и кэшей."""
+    report = {
+        "base_pool": BASE_POOL.stats(),
+        "result_cache": RESULT_CACHE.stats(),
+        "spec_cache": SPEC_CACHE.stats(),
+        "queue": JOB_QUEUE.stats(),
+        "replicate_limiter": REPLICATE_LIMITER.stats(),
+        "replicate_predictions": prediction_stats(),
+        "provider_cassette": PROVIDER_CASSETTE.stats(),
+        "http": http_stats(),
+        "mask": get_mask_stats(),
+    }
+    await update.message.reply_text("📊 Статистика:\n" + json.dumps(report, ensure_ascii=False, indent=2))
+
+
+async def cache_clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Явная инвалидация кэша результатов."""
+    removed = await asyncio.get_running_loop().run_in_executor(None, RESULT_CACHE.clear)
+    await update.message.reply_text(f"🧹 Кэш результатов очищен, удалено записей: {removed}")
+
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Снимает задачи чата из очереди и отменяет его предсказания Replicate, освобождая квоту."""
+    chat_id = update.effective_chat.id
+    dropped = JOB_QUEUE.cancel(chat_id)
+    canceled = await acancel_predictions(chat_id)
+    if not dropped and not canceled:
+        await update.message.reply_text("Нечего отменять: активных задач нет.")
+        return
+    await update.message.reply_text(
+        f"🛑 Отменено: задач в очереди — {dropped}, генераций в Replicate — {canceled}."
+    )
+
+
+async def _run_job(chat_id: int, photo_bytes: bytes, progress: ProgressMessage, extra_images: Sequence[bytes] = ()):
+    # Предсказания Replicate этой задачи привязываются к чату для /cancel
+    with prediction_owner(chat_id):
+        return await agenerate_hat_on_model(photo_bytes, on_event=progress.on_event, extra_images=extra_images)
+
+
+async def _download_photo(message: Message) -> AlbumPhoto:
+    with TELEGRAM_SECONDS.time(operation="download_photo"):
+        photo_file = await message.photo[-1].get_file()
+        photo_bytes = await photo_file.download_as_bytearray()
+    return message, bytes(photo_bytes), photo_file.file_id
+
+
+async def _collect_album(message: Message) -> Optional[List[AlbumPhoto]]:
+    """
+    Фото альбома (media group) собираются в одну задачу: обработчик первого фото
+    ждет остальные и получает весь альбом, обработчики остальных — None.
+    Сообщение регистрируется в альбоме сразу, а фото скачиваются вместе,
+    когда альбом собран.
+    """
+    if not message.media_group_id:
+        return [await _download_photo(message)]
+    album = await ALBUMS.collect(message.media_group_id, message)
+    if album is None:
+        return None
+    album.sort(key=lambda item: item.message_id)
+    if len(album) > CONFIG.pipeline.album_max_photos:
+        logger.info("Альбом %s: %s фото, в анализ идут первые %s",
+                    message.media_group_id, len(album), CONFIG.pipeline.album_max_photos)
+    return list(await asyncio.gather(*(_download_photo(item) for item in album[: CONFIG.pipeline.album_max_photos])))
+
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.photo:
         return
-    photo_file = await update.message.photo[-1].get_file()
-    photo_bytes = await photo_file.download_as_bytearray()
+    started = time.perf_counter()
+    photos = await _collect_album(update.message)
+    if photos is None:
+        return
+    message, photo_bytes, file_id = photos[0]
+    extra_images = [item[1] for item in photos[1:]]
+
+    chat_id = update.effective_chat.id
+    # Одно статусное сообщение, которое редактируется по мере выполнения стадий
+    subject = f"альбом из {len(photos)} фото" if extra_images else "фото"
+    status = await message.reply_text(f"🤖 Обрабатываю {subject}: анализ шапки, генерация модели, инпейтинг...")
+    progress = ProgressMessage(status, message, subject)
+    try:
+        job = await JOB_QUEUE.submit(chat_id, lambda: _run_job(chat_id, photo_bytes, progress, extra_images))
+    except QueueFullError:
+        logger.warning("Очередь переполнена, отклоняем фото из чата %s", chat_id)
+        await progress.finish("⏳ Сейчас слишком много заявок. Попробуйте отправить фото через пару минут.")
+        JOB_SECONDS.observe(time.perf_counter() - started, outcome="rejected")
+        return
 
-    await update.message.reply_text("🤖 Обрабатываю фото: анализ шапки, генерация модели, инпейтинг...")
+    position = JOB_QUEUE.position(chat_id)
+    if position > JOB_QUEUE.idle_workers:
+        await progress.wait_in_queue(position)
 
     try:
-        result = await asyncio.get_running_loop().run_in_executor(
-            None, lambda: generate_hat_on_model(bytes(photo_bytes))
-        )
+        result = await job
+    except (JobCancelledError, PredictionCanceledError):
+        await progress.finish("🛑 Обработка фото отменена.")
+        JOB_SECONDS.observe(time.perf_counter() - started, outcome="cancelled")
+        return
     except Exception as error:  # noqa: BLE001
         logger.exception("Ошибка пайплайна")
-        await update.message.reply_text(
-            "❌ Не удалось создать изображение. Проверьте ключи ANTHROPIC/REPLICATE и повторите."
-        )
+        await progress.finish("❌ Не удалось создать изображение. Проверьте ключи ANTHROPIC/REPLICATE и повторите.")
+        JOB_SECONDS.observe(time.perf_counter() - started, outcome="error")
         return
+    await progress.finish("✅ Готово")
 
     # Отправляем overlay изображение если включен режим отладки
     if CONFIG.pipeline.mask_debug and result.overlay_image:
         overlay_bio = BytesIO(result.overlay_image)
         overlay_bio.name = "mask_overlay.png"
-        await update.message.reply_photo(
-            photo=overlay_bio,
-            caption="🔍 DEBUG: Красная область показывает маску для инпейнтинга"
-        )
-
-    bio = BytesIO(result.final_image)
-    bio.name = "model_hat.png"
-    await update.message.reply_photo(photo=bio, caption="✅ Готово! Использован режим preview по умолчанию.")
+        with TELEGRAM_SECONDS.time(operation="send_overlay"):
+            await message.reply_photo(
+                photo=overlay_bio,
+                caption="🔍 DEBUG: Красная область показывает маску для инпейнтинга"
+            )
+
+    caption = "✅ Готово! Использован режим preview по умолчанию."
+    if result.metadata.get("result_cache") == "hit":
+        caption = "✅ Готово! Это фото уже обрабатывалось — результат взят из кэша (/cache_clear для сброса)."
+    # Результат отдается файлом из временного буфера, без промежуточной копии в BytesIO
+    try:
+        with TELEGRAM_SECONDS.time(operation="send_result"):
+            await message.reply_photo(
+                photo=result.final_image.open(),
+                filename=f"model_hat.{result.final_image.extension}",
+                caption=caption,
+            )
+    finally:
+        result.final_image.close()
+    JOB_SECONDS.observe(time.perf_counter() - started, outcome="ok")
 
     metadata = {
-        "telegram_file_id": photo_file.file_id,
+        "telegram_file_id": file_id,
         "generated_at": datetime.utcnow().isoformat(),
         "pipeline": result.metadata,
     }
+    if extra_images:
+        metadata["album_file_ids"] = [item[2] for item in photos]
     os.makedirs("outputs", exist_ok=True)
     meta_path = os.path.join("outputs", f"metadata_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json")
     with open(meta_path, "w", encoding="utf-8") as fp:
         json.dump(metadata, fp, ensure_ascii=False, indent=2)
     logger.info("Метаданные сохранены: %s", meta_path)
 
-    await update.message.reply_text("💾 Метаданные сохранены. Если нужен HQ режим, задайте QUALITY_MODE=hq или STEPS_HQ.")
+    await message.reply_text("💾 Метаданные сохранены. Если нужен HQ режим, задайте QUALITY_MODE=hq или STEPS_HQ.")
+
+
+async def post_init(application: Application) -> None:
+    JOB_QUEUE.start()
+    # Предсказания, оставшиеся от прошлого запуска и не возобновленные, не должны тратить квоту
+    if CONFIG.providers.replicate_orphan_grace_seconds >= 0:
+        application.create_task(asweep_orphaned_predictions(CONFIG.providers.replicate_orphan_grace_seconds))
 
 
 def main() -> None:
@@ -77,10 +213,24 @@ def main() -> None:
     if not token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN не задан")
 
-    application = Application.builder().token(token).build()
+    # Пайплайн асинхронный, поэтому обновления разных пользователей обрабатываются параллельно
+    application = (
+        Application.builder().token(token).concurrent_updates(True).post_init(post_init).build()
+    )
     application.add_handler(CommandHandler("start", start))
+    # Служебные команды: статистика раскрывает внутреннее состояние, очистка кэша стоит денег
+    admin_chats = filters.Chat(chat_id=CONFIG.telegram.admin_chat_ids)
+    application.add_handler(CommandHandler("stats", stats, filters=admin_chats))
+    application.add_handler(CommandHandler("cache_clear", cache_clear, filters=admin_chats))
+    application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
 
+    # SAM держим в памяти; с SAM_PRELOAD загружаем сразу, иначе при первой маске
+    if CONFIG.pipeline.sam_preload:
+        load_sam_model()
+    start_base_pool()
+    start_metrics_server(CONFIG.pipeline.metrics_port, CONFIG.pipeline.metrics_host)
+
     logger.info("Бот запущен в режиме %s", CONFIG.pipeline.quality_mode)
     # Используем синхронный метод run_polling для совместимости с Python 3.13
     application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -1,6 +1,6 @@
 import os
 from dataclasses import dataclass, field
-from typing import Literal
+from typing import Literal, Tuple
 
 QualityMode = Literal["preview", "hq"]
 
@@ -19,7 +19,27 @@ def get_int(name: str, default: int) -> int:
         return default
 
 
+def get_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def get_int_list(name: str) -> Tuple[int, ...]:
+    """Целые числа через запятую; нечисловые элементы пропускаются."""
+    values = []
+    for item in os.getenv(name, "").split(","):
+        try:
+            values.append(int(item.strip()))
+        except ValueError:
+            continue
+    return tuple(values)
+
+
 def get_bool(name: str, default: bool = False) -> bool:
+    if os.getenv(name) is None:
+        return default
     value = os.getenv(name, "").lower()
     if value in ("1", "true", "yes", "on"):
         return True
@@ -32,12 +52,45 @@ def get_bool(name: str, default: bool = False) -> bool:
 class ProviderSettings:
     anthropic_api_key: str = get_env("ANTHROPIC_API_KEY", "")
     anthropic_model: str = get_env("ANTHROPIC_MODEL", "claude-3-5-sonnet-latest")
+    # Бюджет на одно фото в запросе спецификации (КБ): крупные фото альбома ужимаются до него
+    anthropic_image_budget_kb: int = get_int("ANTHROPIC_IMAGE_BUDGET_KB", 400)
     replicate_api_token: str = get_env("REPLICATE_API_TOKEN", "")
+    # Адреса API (пусто — по умолчанию SDK); нужны для прокси и локальных заглушек в бенчмарках
+    anthropic_base_url: str = get_env("ANTHROPIC_BASE_URL", "")
+    replicate_base_url: str = get_env("REPLICATE_BASE_URL", "")
     flux_base_model: str = get_env("FLUX_BASE_MODEL", "black-forest-labs/flux-schnell")
     flux_base_model_preview: str = get_env(
         "FLUX_BASE_MODEL_PREVIEW", get_env("FLUX_BASE_MODEL", "black-forest-labs/flux-schnell")
     )
     flux_fill_model: str = get_env("FLUX_FILL_MODEL", "black-forest-labs/flux-fill-pro")
+    # Формат результата FLUX Fill на стороне Replicate (jpg/png, у fill-dev еще webp) и качество
+    # (0 — не передавать: flux-fill-pro параметр output_quality не принимает)
+    flux_output_format: str = get_env("FLUX_OUTPUT_FORMAT", "jpg")
+    flux_output_quality: int = get_int("FLUX_OUTPUT_QUALITY", 0)
+    # Общий адаптивный лимитер запросов к Replicate (запросов в минуту)
+    replicate_rate_per_minute: int = get_int("REPLICATE_RATE_PER_MINUTE", 60)
+    replicate_min_rate_per_minute: int = get_int("REPLICATE_MIN_RATE_PER_MINUTE", 4)
+    replicate_max_rate_per_minute: int = get_int("REPLICATE_MAX_RATE_PER_MINUTE", 600)
+    replicate_burst: int = get_int("REPLICATE_BURST", 3)
+    # Предсказания: интервал опроса, дедлайн (после него предсказание отменяется) и журнал для возобновления
+    replicate_poll_interval: float = get_float("REPLICATE_POLL_INTERVAL", 1.0)
+    replicate_prediction_timeout: int = get_int("REPLICATE_PREDICTION_TIMEOUT", 600)
+    replicate_predictions_path: str = get_env("REPLICATE_PREDICTIONS_PATH", "cache/predictions.json")
+    # Записи журнала с прошлого запуска, которые за это время не возобновили, отменяются при старте бота
+    # (отрицательное значение — не разбирать)
+    replicate_orphan_grace_seconds: float = get_float("REPLICATE_ORPHAN_GRACE_SECONDS", 300.0)
+    # Изображения для FLUX Fill загружаются через files API (иначе — data URI внутри JSON)
+    replicate_upload_files: bool = get_bool("REPLICATE_UPLOAD_FILES", True)
+    # Хеджирование: дубликат предсказания, не завершившегося к перцентилю недавних длительностей
+    # (0 — выключено); не раньше накопления замеров и не больше заданного числа дубликатов в час
+    replicate_hedge_percentile: float = get_float("REPLICATE_HEDGE_PERCENTILE", 0.0)
+    replicate_hedge_min_samples: int = get_int("REPLICATE_HEDGE_MIN_SAMPLES", 20)
+    replicate_hedge_max_per_hour: int = get_int("REPLICATE_HEDGE_MAX_PER_HOUR", 30)
+    # Кассета запросов к провайдерам: off, record (записывать ответы) или replay (отдавать без сети);
+    # масштаб времени 0 — мгновенно, 1 — с записанными задержками
+    cassette_mode: str = get_env("PROVIDER_CASSETTE", "off").lower()
+    cassette_dir: str = get_env("PROVIDER_CASSETTE_DIR", "cassettes/default")
+    cassette_time_scale: float = get_float("PROVIDER_CASSETTE_TIME_SCALE", 0.0)
 
 
 @dataclass
@@ -49,17 +102,99 @@ class PipelineSettings:
     timeout_seconds: int = get_int("PIPELINE_TIMEOUT", 90)
     retries: int = get_int("PIPELINE_RETRIES", 1)
     mask_debug: bool = get_bool("MASK_DEBUG", False)
+    # Пул заранее сгенерированных base портретов (0 — выключен)
+    base_pool_size: int = get_int("BASE_POOL_SIZE", 0)
+    base_pool_workers: int = get_int("BASE_POOL_WORKERS", 1)
+    # Портрет старше этого выбрасывается из пула (0 — без ограничения)
+    base_pool_max_age_seconds: float = get_float("BASE_POOL_MAX_AGE_SECONDS", 21600)
+    # После стольких ошибок пополнения подряд ключ пула ставится на паузу
+    base_pool_pause_after: int = get_int("BASE_POOL_PAUSE_AFTER", 5)
+    base_pool_pause_seconds: float = get_float("BASE_POOL_PAUSE_SECONDS", 900)
+    # Кандидатов base портрета за одно предсказание FLUX (num_outputs, до 4); 1 — по одному за попытку
+    base_candidates: int = get_int("BASE_CANDIDATES", 3)
+    # SAM: модель загружается один раз и остается в памяти
+    sam_model_type: str = get_env("SAM_MODEL_TYPE", "vit_b")
+    sam_checkpoint: str = get_env("SAM_CHECKPOINT", "")
+    sam_preload: bool = get_bool("SAM_PRELOAD", False)
+    sam_embedding_cache_size: int = get_int("SAM_EMBEDDING_CACHE_SIZE", 8)
+    # Локальный детектор головных уборов перед проверкой Claude: heuristic | onnx | off
+    headwear_detector: str = get_env("HEADWEAR_DETECTOR", "heuristic")
+    headwear_onnx_model: str = get_env("HEADWEAR_ONNX_MODEL", "")
+    # Равен потолку уверенности эвристики: ее уверенное «чисто» принимается без Claude
+    headwear_local_confidence: float = get_float("HEADWEAR_LOCAL_CONFIDENCE", 0.7)
+    # Очередь задач пайплайна перед ботом
+    queue_workers: int = get_int("QUEUE_WORKERS", 2)
+    queue_max_length: int = get_int("QUEUE_MAX_LENGTH", 50)
+    # Альбом (media group): фото собираются в течение окна (секунды, продлевается каждым фото)
+    # и обрабатываются одной задачей; в анализ идут первые album_max_photos фото
+    album_window_seconds: float = get_float("ALBUM_WINDOW_SECONDS", 1.5)
+    album_max_photos: int = get_int("ALBUM_MAX_PHOTOS", 4)
+    # Endpoint метрик Prometheus (0 — выключен)
+    metrics_port: int = get_int("METRICS_PORT", 0)
+    metrics_host: str = get_env("METRICS_HOST", "127.0.0.1")
+
+
+@dataclass
+class CacheSettings:
+    result_cache_enabled: bool = get_bool("RESULT_CACHE", True)
+    result_cache_dir: str = get_env("RESULT_CACHE_DIR", "cache/results")
+    result_cache_max_mb: int = get_int("RESULT_CACHE_MAX_MB", 500)
+    result_cache_max_age_hours: int = get_int("RESULT_CACHE_MAX_AGE_HOURS", 24 * 7)
+    # Кэш спецификаций по перцептивному хешу (dHash, 64 бита)
+    spec_cache_enabled: bool = get_bool("SPEC_CACHE", True)
+    spec_cache_path: str = get_env("SPEC_CACHE_PATH", "cache/specs.json")
+    spec_cache_max_distance: int = get_int("SPEC_CACHE_MAX_DISTANCE", 6)
+    # dHash не различает цвет: средний RGB переднего плана должен отличаться не больше чем на столько
+    spec_cache_max_color_distance: int = get_int("SPEC_CACHE_MAX_COLOR_DISTANCE", 24)
+    spec_cache_max_entries: int = get_int("SPEC_CACHE_MAX_ENTRIES", 1000)
+
+
+@dataclass
+class HttpSettings:
+    # Общий клиент с пулом соединений для скачиваний и загрузок вне SDK (utils/http.py)
+    max_connections: int = get_int("HTTP_MAX_CONNECTIONS", 50)
+    max_keepalive_connections: int = get_int("HTTP_MAX_KEEPALIVE", 20)
+    keepalive_seconds: float = get_float("HTTP_KEEPALIVE_SECONDS", 30.0)
+    # Одновременных запросов к одному хосту (0 — без ограничения)
+    max_per_host: int = get_int("HTTP_MAX_PER_HOST", 8)
+    # HTTP/2 (нужен пакет h2; без него — HTTP/1.1)
+    http2: bool = get_bool("HTTP_HTTP2", False)
+    timeout_seconds: float = get_float("HTTP_TIMEOUT", 60.0)
+    # Повторы идемпотентных GET/HEAD при сетевых ошибках и 429/502/503/504 с экспоненциальной паузой
+    retries: int = get_int("HTTP_RETRIES", 3)
+    retry_backoff_seconds: float = get_float("HTTP_RETRY_BACKOFF", 0.5)
+    # Скачанные результаты держатся в памяти до этого размера (КБ), крупнее — во временном файле
+    spool_memory_kb: int = get_int("HTTP_SPOOL_MEMORY_KB", 1024)
+
+
+@dataclass
+class WordPressSettings:
+    # Пакетная загрузка в Media Library (media_uploader.upload_images_batch)
+    upload_concurrency: int = get_int("WP_UPLOAD_CONCURRENCY", 4)
+    # Повторы POST при 429/502/503/504 и ошибках соединения, пауза растет вдвое
+    upload_retries: int = get_int("WP_UPLOAD_RETRIES", 2)
+    upload_retry_backoff_seconds: float = get_float("WP_UPLOAD_RETRY_BACKOFF", 1.0)
+    # Индекс загруженных изображений по SHA-256: одинаковые байты не загружаются повторно
+    media_index_enabled: bool = get_bool("WP_MEDIA_INDEX", True)
+    media_index_path: str = get_env("WP_MEDIA_INDEX_PATH", "cache/wp_media.json")
+    # Как часто при попадании проверять, что вложение еще есть на сайте (0 — при каждом попадании)
+    media_index_verify_seconds: int = get_int("WP_MEDIA_INDEX_VERIFY_SECONDS", 24 * 3600)
 
 
 @dataclass
 class TelegramSettings:
     token: str = get_env("TELEGRAM_BOT_TOKEN", "")
+    # Чаты, которым доступны /stats и /cache_clear (пусто — команды выключены)
+    admin_chat_ids: Tuple[int, ...] = get_int_list("ADMIN_CHAT_IDS")
 
 
 @dataclass
 class AppConfig:
     providers: ProviderSettings = field(default_factory=ProviderSettings)
     pipeline: PipelineSettings = field(default_factory=PipelineSettings)
+    cache: CacheSettings = field(default_factory=CacheSettings)
+    http: HttpSettings = field(default_factory=HttpSettings)
+    wordpress: WordPressSettings = field(default_factory=WordPressSettings)
     telegram: TelegramSettings = field(default_factory=TelegramSettings)
 
 
@@ -5,6 +5,8 @@ from PIL import Image
 from io import BytesIO
 from typing import Tuple, Optional
 
+from utils.image_encoder import encode_image, encode_to_budget, flatten_to_rgb
+
 
 def resize_image(image_data: bytes, max_size: Tuple[int, int] = (2048, 2048)) -> bytes:
     """
@@ -19,21 +21,11 @@ def resize_image(image_data: bytes, max_size: Tuple[int, int] = (2048, 2048)) ->
     """
     img = Image.open(BytesIO(image_data))
     
-    # Конвертируем в RGB если нужно
-    if img.mode in ('RGBA', 'LA', 'P'):
-        background = Image.new('RGB', img.size, (255, 255, 255))
-        if img.mode == 'P':
-            img = img.convert('RGBA')
-        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-        img = background
-    
-    # Изменяем размер
+    # Конвертируем в RGB (прозрачность на белом фоне) и изменяем размер
+    img = flatten_to_rgb(img)
     img.thumbnail(max_size, Image.Resampling.LANCZOS)
     
-    # Сохраняем в байты
-    output = BytesIO()
-    img.save(output, format='JPEG', quality=85, optimize=True)
-    return output.getvalue()
+    return encode_image(img, format='JPEG', quality=85).data
 
 
 def optimize_image_for_telegram(image_data: bytes) -> bytes:
@@ -47,80 +39,27 @@ def optimize_image_for_telegram(image_data: bytes) -> bytes:
     Returns:
         Оптимизированные байты изображения
     """
-    img = Image.open(BytesIO(image_data))
-    
-    # Конвертируем в RGB
-    if img.mode in ('RGBA', 'LA', 'P'):
-        background = Image.new('RGB', img.size, (255, 255, 255))
-        if img.mode == 'P':
-            img = img.convert('RGBA')
-        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-        img = background
-    
-    # Уменьшаем до разумного размера
-    max_dimension = 2560
-    if img.width > max_dimension or img.height > max_dimension:
-        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
-    
-    # Сохраняем с оптимизацией
-    output = BytesIO()
-    img.save(output, format='JPEG', quality=90, optimize=True)
-    
-    return output.getvalue()
+    # Уменьшаем до разумного размера и сохраняем с оптимизацией
+    return encode_image(image_data, format='JPEG', quality=90, max_dimension=2560).data
 
 
-def compress_image(image_data: bytes, target_size_kb: int = 500) -> bytes:
+def compress_image(image_data: bytes, target_size_kb: int = 500, format: str = 'JPEG') -> bytes:
     """
     Сжимает изображение до целевого размера
     
+    Качество подбирается бисекцией по уменьшенной копии, а полное изображение
+    кодируется один-три раза; если не хватает даже качества 25, изображение
+    уменьшается (см. utils.image_encoder.encode_to_budget).
+    
     Args:
         image_data: Байты изображения
         target_size_kb: Целевой размер в килобайтах
+        format: 'JPEG' или 'WEBP'
     
     Returns:
         Сжатые байты изображения
     """
-    img = Image.open(BytesIO(image_data))
-    
-    # Конвертируем в RGB
-    if img.mode in ('RGBA', 'LA', 'P'):
-        background = Image.new('RGB', img.size, (255, 255, 255))
-        if img.mode == 'P':
-            img = img.convert('RGBA')
-        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-        img = background
-    
-    # Начинаем с высокого качества
-    quality = 95
-    
-    while quality > 20:
-        output = BytesIO()
-        img.save(output, format='JPEG', quality=quality, optimize=True)
-        size_kb = len(output.getvalue()) / 1024
-        
-        if size_kb <= target_size_kb:
-            return output.getvalue()
-        
-        quality -= 5
-    
-    # Если не удалось сжать до нужного размера, уменьшаем разрешение
-    scale = 0.9
-    while scale > 0.3:
-        new_width = int(img.width * scale)
-        new_height = int(img.height * scale)
-        resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        output = BytesIO()
-        resized.save(output, format='JPEG', quality=85, optimize=True)
-        size_kb = len(output.getvalue()) / 1024
-        
-        if size_kb <= target_size_kb:
-            return output.getvalue()
-        
-        scale -= 0.1
-    
-    # Возвращаем максимально сжатое изображение
-    return output.getvalue()
+    return encode_to_budget(image_data, target_size_kb * 1024, format=format).data
 
 
 def get_image_info(image_data: bytes) -> dict:
@@ -157,21 +96,9 @@ def create_thumbnail(image_data: bytes, size: Tuple[int, int] = (300, 300)) -> b
     Returns:
         Байты миниатюры
     """
-    img = Image.open(BytesIO(image_data))
-    
-    # Конвертируем в RGB
-    if img.mode in ('RGBA', 'LA', 'P'):
-        background = Image.new('RGB', img.size, (255, 255, 255))
-        if img.mode == 'P':
-            img = img.convert('RGBA')
-        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-        img = background
+    img = flatten_to_rgb(Image.open(BytesIO(image_data)))
     
     # Создаем миниатюру
     img.thumbnail(size, Image.Resampling.LANCZOS)
     
-    # Сохраняем
-    output = BytesIO()
-    img.save(output, format='JPEG', quality=85)
-    
-    return output.getvalue()
+    return encode_image(img, format='JPEG', quality=85, optimize=False).data
@@ -3,27 +3,174 @@
 """
 import os
 import base64
-import requests
-from typing import Optional, List
-from io import BytesIO
-from PIL import Image
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Literal, Optional, List, Tuple
+
+import httpx
+
+from config import CONFIG
+from utils.http import http_client
+from utils.image_encoder import encode_image
+from utils.media_index import MediaIndex
+from utils.metrics import Counter, Histogram
+
+# Ответы WordPress, после которых загрузку можно повторить
+TRANSIENT_STATUSES = (429, 502, 503, 504)
+
+MEDIA_STAGE_SECONDS = Histogram(
+    "wp_media_stage_seconds", "Скачивание, сжатие и загрузка изображений в Media Library", ("stage",)
+)
+MEDIA_UPLOADS = Counter(
+    "wp_media_uploads_total", "Изображения для Media Library: загружены или найдены в индексе", ("outcome",)
+)
+
+MEDIA_INDEX = MediaIndex(
+    CONFIG.wordpress.media_index_path,
+    verify_seconds=CONFIG.wordpress.media_index_verify_seconds,
+    enabled=CONFIG.wordpress.media_index_enabled,
+)
 
 
 def compress_image(img_data: bytes, max_size: int = 800, quality: int = 70) -> bytes:
     """Сжатие изображения"""
     try:
-        img = Image.open(BytesIO(img_data))
-        if img.mode in ('RGBA', 'P'):
-            img = img.convert('RGB')
-        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        output = BytesIO()
-        img.save(output, format='JPEG', quality=quality, optimize=True)
-        return output.getvalue()
+        return encode_image(img_data, format='JPEG', quality=quality, max_dimension=max_size).data
     except Exception as e:
         print(f"Ошибка сжатия изображения: {e}")
         return img_data
 
 
+class TransientUploadError(RuntimeError):
+    """Временная ошибка WordPress (429/502/503/504 или нет соединения): загрузку можно повторить."""
+
+
+def _site_url(wp_url: str) -> str:
+    return wp_url if wp_url.endswith('/') else wp_url + '/'
+
+
+def _post_media(
+    compressed_data: bytes,
+    filename: str,
+    wp_url: str,
+    wp_username: str,
+    wp_app_password: str
+) -> dict:
+    """POST сжатого изображения в Media Library; ошибки пробрасываются (временные — TransientUploadError)."""
+    media_url = f"{_site_url(wp_url)}wp-json/wp/v2/media"
+
+    headers = {
+        'Content-Type': 'image/jpeg',
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    }
+
+    try:
+        response = http_client().post(
+            media_url,
+            content=compressed_data,
+            headers=headers,
+            auth=(wp_username, wp_app_password),
+            timeout=60
+        )
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+        # Запрос не дошел до сервера — повтор не создаст дубликат
+        raise TransientUploadError(f"Нет соединения с WordPress: {e}") from e
+
+    if response.status_code == 201:
+        media_data = response.json()
+        return {
+            'id': media_data['id'],
+            'url': media_data['source_url'],
+            'title': media_data['title']['rendered']
+        }
+    message = f"Ошибка загрузки в Media Library: {response.status_code}, Response: {response.text[:300]}"
+    if response.status_code in TRANSIENT_STATUSES:
+        raise TransientUploadError(message)
+    raise RuntimeError(message)
+
+
+@dataclass(frozen=True)
+class MediaCheck:
+    """
+    Результат проверки вложения на сайте: exists (url и title актуальны),
+    deleted (404/410) или unknown (сеть, 5xx, авторизация — проверим в следующий раз).
+    """
+
+    status: Literal["exists", "deleted", "unknown"]
+    url: str = ""
+    title: str = ""
+
+
+def _media_exists(media_id: int, wp_url: str, wp_username: str, wp_app_password: str) -> MediaCheck:
+    """Проверка вложения на сайте (GET /wp/v2/media/<id>)."""
+    try:
+        response = http_client().get(
+            f"{_site_url(wp_url)}wp-json/wp/v2/media/{media_id}",
+            auth=(wp_username, wp_app_password),
+            timeout=30
+        )
+    except httpx.HTTPError as e:
+        print(f"⚠️ Не удалось проверить вложение {media_id}: {e}")
+        return MediaCheck("unknown")
+    if response.status_code in (404, 410):
+        return MediaCheck("deleted")
+    if response.status_code != 200:
+        print(f"⚠️ Не удалось проверить вложение {media_id}: {response.status_code}")
+        return MediaCheck("unknown")
+    media_data = response.json()
+    return MediaCheck("exists", url=media_data['source_url'], title=media_data['title']['rendered'])
+
+
+def _store_media(
+    compressed_data: bytes,
+    filename: str,
+    wp_url: str,
+    wp_username: str,
+    wp_app_password: str
+) -> dict:
+    """
+    Загрузка сжатого изображения с дедупликацией по содержимому.
+
+    Если такие же байты уже загружались на этот сайт (MEDIA_INDEX), возвращается
+    существующее вложение без POST; запись проверяется на сайте не чаще раза
+    в WP_MEDIA_INDEX_VERIFY_SECONDS. Одинаковые байты из параллельных потоков
+    (например, одной пачки) загружаются один раз: остальные ждут и получают
+    то же вложение из индекса.
+    """
+    site = _site_url(wp_url)
+    digest = hashlib.sha256(compressed_data).hexdigest()
+    with MEDIA_INDEX.reserve(site, digest):
+        entry = MEDIA_INDEX.lookup(site, digest)
+        if entry is not None:
+            if not MEDIA_INDEX.needs_verification(entry):
+                MEDIA_INDEX.confirm(site, digest)
+                MEDIA_UPLOADS.inc(outcome="dedup")
+                return {'id': entry['id'], 'url': entry['url'], 'title': entry['title']}
+            check = _media_exists(entry['id'], site, wp_username, wp_app_password)
+            if check.status == "exists":
+                MEDIA_INDEX.confirm(site, digest, verified=True, url=check.url, title=check.title)
+                entry.update(url=check.url, title=check.title)
+            elif check.status == "unknown":
+                MEDIA_INDEX.confirm(site, digest)
+            if check.status != "deleted":
+                MEDIA_UPLOADS.inc(outcome="dedup")
+                print(f"♻️ Изображение уже в Media Library (ID: {entry['id']}), загрузка пропущена")
+                return {'id': entry['id'], 'url': entry['url'], 'title': entry['title']}
+            print(f"Вложение {entry['id']} удалено на сайте, загружаем заново")
+            MEDIA_INDEX.forget(site, digest)
+
+        media = _post_media(compressed_data, filename, site, wp_username, wp_app_password)
+        MEDIA_INDEX.store(site, digest, media)
+        MEDIA_UPLOADS.inc(outcome="uploaded")
+        return media
+
+
+def media_index_stats() -> dict:
+    return MEDIA_INDEX.stats()
+
+
 def upload_image_to_media(
     image_data: bytes,
     filename: str,
@@ -44,39 +191,10 @@ def upload_image_to_media(
     Returns:
         Словарь с данными загруженного изображения или None при ошибке
     """
-    if not wp_url.endswith('/'):
-        wp_url += '/'
-
-    media_url = f"{wp_url}wp-json/wp/v2/media"
-
-    headers = {
-        'Content-Type': 'image/jpeg',
-        'Content-Disposition': f'attachment; filename="{filename}"'
-    }
-
     try:
         # Сжимаем изображение перед загрузкой
         compressed_data = compress_image(image_data, max_size=1200, quality=80)
-
-        response = requests.post(
-            media_url,
-            data=compressed_data,
-            headers=headers,
-            auth=(wp_username, wp_app_password),
-            timeout=60
-        )
-
-        if response.status_code == 201:
-            media_data = response.json()
-            return {
-                'id': media_data['id'],
-                'url': media_data['source_url'],
-                'title': media_data['title']['rendered']
-            }
-        else:
-            print(f"Ошибка загрузки в Media Library: {response.status_code}")
-            print(f"Response: {response.text[:300]}")
-            return None
+        return _store_media(compressed_data, filename, wp_url, wp_username, wp_app_password)
 
     except Exception as e:
         print(f"Исключение при загрузке изображения: {e}")
@@ -105,7 +223,7 @@ def upload_image_from_url(
     """
     try:
         # Скачиваем изображение
-        response = requests.get(image_url, timeout=30)
+        response = http_client().get(image_url, timeout=30)
         response.raise_for_status()
 
         # Загружаем в Media Library
@@ -122,36 +240,101 @@ def upload_image_from_url(
         return None
 
 
+def _upload_batch_item(
+    idx: int,
+    image_url: str,
+    wp_url: str,
+    wp_username: str,
+    wp_app_password: str,
+    retries: int,
+    backoff: float
+) -> Tuple[Optional[dict], Dict[str, float]]:
+    """Скачивание, сжатие и загрузка одного изображения пакета; возвращает (результат, тайминги этапов)."""
+    timings: Dict[str, float] = {}
+    filename = f"product_image_{idx}_{os.urandom(4).hex()}.jpg"
+    try:
+        # Повторы скачивания (сеть, 429/5xx) выполняет общий HTTP-клиент
+        started = time.perf_counter()
+        response = http_client().get(image_url, timeout=30)
+        response.raise_for_status()
+        timings['download'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        compressed_data = compress_image(response.content, max_size=1200, quality=80)
+        timings['compress'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for attempt in range(retries + 1):
+            try:
+                return _store_media(compressed_data, filename, wp_url, wp_username, wp_app_password), timings
+            except TransientUploadError as e:
+                if attempt == retries:
+                    raise
+                delay = backoff * 2 ** attempt
+                print(f"⚠️ Изображение {idx + 1}: {e}; повтор {attempt + 1}/{retries} через {delay:.1f}s")
+                time.sleep(delay)
+    except Exception as e:
+        print(f"Ошибка при скачивании/загрузке изображения из {image_url}: {e}")
+        return None, timings
+    finally:
+        if 'compress' in timings:
+            timings['upload'] = time.perf_counter() - started
+        for stage, seconds in timings.items():
+            MEDIA_STAGE_SECONDS.observe(seconds, stage=stage)
+    return None, timings
+
+
 def upload_images_batch(
     image_urls: List[str],
     wp_url: str,
     wp_username: str,
-    wp_app_password: str
+    wp_app_password: str,
+    max_workers: Optional[int] = None,
+    retries: Optional[int] = None
 ) -> List[dict]:
     """
     Массовая загрузка изображений
 
+    Изображения обрабатываются параллельно (не больше max_workers одновременно):
+    скачивание, сжатие и загрузка разных изображений перекрываются. Временные
+    ошибки WordPress повторяются для каждого изображения до retries раз.
+
     Args:
         image_urls: Список URL изображений
         wp_url: URL WordPress сайта
         wp_username: Имя пользователя WordPress
         wp_app_password: Application Password
+        max_workers: Число одновременно загружаемых изображений (по умолчанию WP_UPLOAD_CONCURRENCY)
+        retries: Повторов загрузки при временных ошибках (по умолчанию WP_UPLOAD_RETRIES)
 
     Returns:
-        Список словарей с данными загруженных изображений
+        Список словарей с данными загруженных изображений (в порядке image_urls)
     """
-    uploaded_images = []
+    if not image_urls:
+        return []
+    settings = CONFIG.wordpress
+    max_workers = max(1, max_workers if max_workers is not None else settings.upload_concurrency)
+    retries = max(0, retries if retries is not None else settings.upload_retries)
+    backoff = settings.upload_retry_backoff_seconds
 
-    for idx, img_url in enumerate(image_urls):
-        print(f"Загрузка изображения {idx + 1}/{len(image_urls)}...")
-
-        filename = f"product_image_{idx}_{os.urandom(4).hex()}.jpg"
-        result = upload_image_from_url(img_url, filename, wp_url, wp_username, wp_app_password)
+    print(f"Загрузка {len(image_urls)} изображений (параллельно до {max_workers})...")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="wp-media") as pool:
+        # map сохраняет порядок входного списка
+        results = list(pool.map(
+            lambda item: _upload_batch_item(item[0], item[1], wp_url, wp_username, wp_app_password, retries, backoff),
+            enumerate(image_urls)
+        ))
+    total = time.perf_counter() - started
 
+    uploaded_images = []
+    for idx, (result, timings) in enumerate(results):
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
         if result:
             uploaded_images.append({'id': result['id']})
-            print(f"✅ Изображение {idx + 1} загружено (ID: {result['id']})")
+            print(f"✅ Изображение {idx + 1} загружено (ID: {result['id']}): {stages}")
         else:
-            print(f"❌ Не удалось загрузить изображение {idx + 1}")
+            print(f"❌ Не удалось загрузить изображение {idx + 1}" + (f": {stages}" if stages else ""))
 
+    print(f"Загружено {len(uploaded_images)}/{len(image_urls)} изображений за {total:.2f}s")
     return uploaded_images
@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from utils.images import ImageHandle
+from utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+# (quality_mode, width, height, base_model)
+PoolKey = Tuple[str, int, int, str]
+
+
+@dataclass
+class PooledPortrait:
+    """Базовый портрет, уже прошедший проверку на головные уборы, с готовой маской."""
+
+    base: ImageHandle
+    mask: Image.Image
+    guard: List[Dict[str, Any]] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+
+
+class BasePortraitPool:
+    """
+    Ограниченный пул заранее сгенерированных портретов без головного убора.
+
+    Фоновые потоки пополняют пул для каждого ключа (режим качества, размер,
+    base модель) до `depth` портретов. Ключ регистрируется при первом запросе
+    или явно через `register`.
+
+    После ошибки пополнения ключ ждет с экспоненциальной задержкой (до
+    MAX_BACKOFF_SECONDS), после `pause_after` ошибок подряд — `pause_seconds`,
+    чтобы пул не тратил квоту, пока провайдер недоступен. Портреты старше
+    `max_age_seconds` выбрасываются и генерируются заново.
+    """
+
+    ERROR_BACKOFF_SECONDS = 10.0
+    MAX_BACKOFF_SECONDS = 300.0
+
+    def __init__(
+        self,
+        depth: int,
+        producer: Callable[[PoolKey], PooledPortrait],
+        workers: int = 1,
+        max_age_seconds: float = 0.0,
+        pause_after: int = 5,
+        pause_seconds: float = 900.0,
+    ):
+        self.depth = max(0, depth)
+        self.workers = max(1, workers)
+        self.max_age_seconds = max(0.0, max_age_seconds)
+        self.pause_after = max(1, pause_after)
+        self.pause_seconds = max(0.0, pause_seconds)
+        self._producer = producer
+        self._queues: Dict[PoolKey, Deque[PooledPortrait]] = {}
+        self._in_flight: Dict[PoolKey, int] = {}
+        # Ошибки пополнения подряд и время (monotonic), до которого ключ не пополняется
+        self._failures: Dict[PoolKey, int] = {}
+        self._retry_at: Dict[PoolKey, float] = {}
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopped = False
+
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_errors = 0
+        self.expired = 0
+        self.pauses = 0
+        self.last_refill_seconds: Optional[float] = None
+        self._refill_total_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.depth > 0
+
+    def register(self, key: PoolKey) -> None:
+        """Добавляет ключ в список пополняемых."""
+        if not self.enabled:
+            return
+        with self._condition:
+            if key not in self._queues:
+                self._queues[key] = deque()
+                self._in_flight[key] = 0
+                logger.info("Пул base портретов: новый ключ %s", key)
+                self._condition.notify_all()
+
+    def take(self, key: PoolKey) -> Optional[PooledPortrait]:
+        """Забирает готовый портрет из пула; None, если пул пуст или выключен."""
+        if not self.enabled:
+            return None
+        self.register(key)
+        with self._condition:
+            self._drop_expired()
+            queue = self._queues[key]
+            if queue:
+                self.hits += 1
+                portrait = queue.popleft()
+            else:
+                self.misses += 1
+                portrait = None
+            # Освободилось место — будим пополнение
+            self._condition.notify_all()
+        return portrait
+
+    def start(self) -> None:
+        if not self.enabled or self._threads:
+            return
+        self._stopped = False
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._replenish_loop, name=f"base-pool-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Пул base портретов запущен: глубина %s, потоков %s", self.depth, self.workers)
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self._threads.clear()
+
+    def _drop_expired(self) -> None:
+        """Выбрасывает портреты старше max_age_seconds (вызывается под `_condition`)."""
+        if not self.max_age_seconds:
+            return
+        oldest_allowed = time.time() - self.max_age_seconds
+        for key, queue in self._queues.items():
+            while queue and queue[0].created_at < oldest_allowed:
+                queue.popleft()
+                self.expired += 1
+                logger.info("Пул base портретов: портрет для %s устарел и выброшен", key)
+
+    def _wait_timeout(self) -> Optional[float]:
+        """Через сколько секунд пулу снова есть что делать: конец паузы ключа или устаревание портрета."""
+        now = time.monotonic()
+        deadlines = [retry_at - now for retry_at in self._retry_at.values() if retry_at > now]
+        if self.max_age_seconds:
+            deadlines += [
+                queue[0].created_at + self.max_age_seconds - time.time() for queue in self._queues.values() if queue
+            ]
+        return max(0.0, min(deadlines)) if deadlines else None
+
+    def _next_key(self) -> Optional[PoolKey]:
+        """Ключ с наибольшим дефицитом с учетом уже идущих генераций; ключи на паузе пропускаются."""
+        self._drop_expired()
+        now = time.monotonic()
+        best_key, best_deficit = None, 0
+        for key, queue in self._queues.items():
+            if self._retry_at.get(key, 0.0) > now:
+                continue
+            deficit = self.depth - len(queue) - self._in_flight[key]
+            if deficit > best_deficit:
+                best_key, best_deficit = key, deficit
+        return best_key
+
+    def _replenish_loop(self) -> None:
+        while True:
+            with self._condition:
+                key = self._next_key()
+                while key is None and not self._stopped:
+                    self._condition.wait(timeout=self._wait_timeout())
+                    key = self._next_key()
+                if self._stopped:
+                    return
+                self._in_flight[key] += 1
+
+            started = time.perf_counter()
+            try:
+                portrait = self._producer(key)
+            except Exception as error:  # noqa: BLE001
+                with self._condition:
+                    self._in_flight[key] -= 1
+                    self.refill_errors += 1
+                    delay = self._record_failure(key)
+                logger.warning(
+                    "Не удалось пополнить пул base портретов для %s: %s; повтор через %.0fs", key, error, delay
+                )
+                continue
+
+            elapsed = time.perf_counter() - started
+            with self._condition:
+                self._in_flight[key] -= 1
+                self._failures.pop(key, None)
+                self._retry_at.pop(key, None)
+                self._queues[key].append(portrait)
+                self.refills += 1
+                self.last_refill_seconds = round(elapsed, 3)
+                self._refill_total_seconds += elapsed
+                self._condition.notify_all()
+            logger.info("Пул base портретов пополнен для %s за %.2fs", key, elapsed)
+
+    def _record_failure(self, key: PoolKey) -> float:
+        """Откладывает пополнение ключа после ошибки (вызывается под `_condition`); возвращает задержку."""
+        failures = self._failures.get(key, 0) + 1
+        self._failures[key] = failures
+        if failures >= self.pause_after:
+            delay = self.pause_seconds
+            self.pauses += 1
+            logger.warning(
+                "Пул base портретов: %s ошибок подряд для %s, пополнение приостановлено на %.0fs",
+                failures, key, delay,
+            )
+        else:
+            delay = min(self.MAX_BACKOFF_SECONDS, self.ERROR_BACKOFF_SECONDS * 2 ** (failures - 1))
+        self._retry_at[key] = time.monotonic() + delay
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            now = time.monotonic()
+            requests = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "depth_limit": self.depth,
+                "depth": {"/".join(map(str, key)): len(queue) for key, queue in self._queues.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+                "refills": self.refills,
+                "refill_errors": self.refill_errors,
+                "expired": self.expired,
+                "pauses": self.pauses,
+                "consecutive_failures": {
+                    "/".join(map(str, key)): failures for key, failures in self._failures.items()
+                },
+                "paused": {
+                    "/".join(map(str, key)): round(retry_at - now, 1)
+                    for key, retry_at in self._retry_at.items()
+                    if retry_at > now and self._failures.get(key, 0) >= self.pause_after
+                },
+                "last_refill_seconds": self.last_refill_seconds,
+                "avg_refill_seconds": (
+                    round(self._refill_total_seconds / self.refills, 3) if self.refills else None
+                ),
+            }
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class Stage:
+    """
+    Узел графа пайплайна.
+
+    Args:
+        name: Уникальное имя узла, под ним сохраняется результат
+        func: Функция узла, получает результаты `inputs` как именованные аргументы
+        inputs: Имена узлов (или начальных значений), от которых зависит узел
+        afunc: Асинхронный вариант функции для `arun`; без него `func` выполняется в потоке
+    """
+
+    name: str
+    func: Callable[..., Any]
+    inputs: Tuple[str, ...] = field(default_factory=tuple)
+    afunc: Optional[Callable[..., Awaitable[Any]]] = None
+
+
+@dataclass
+class StageEvent:
+    """
+    Событие выполнения стадии для отображения прогресса.
+
+    Args:
+        stage: Имя стадии
+        status: "started", "finished" или "failed"
+        elapsed: Длительность стадии в секундах (для finished/failed)
+        result: Результат стадии (для finished)
+        detail: Дополнительные сведения, которые стадия сообщает сама (например, попытка guard)
+    """
+
+    stage: str
+    status: str
+    elapsed: Optional[float] = None
+    result: Any = None
+    detail: Dict[str, Any] = field(default_factory=dict)
+
+
+StageCallback = Callable[[StageEvent], None]
+
+
+def emit(on_event: Optional[StageCallback], event: StageEvent) -> None:
+    """Передает событие подписчику; ошибки подписчика не прерывают пайплайн."""
+    if on_event is None:
+        return
+    try:
+        on_event(event)
+    except Exception as error:  # noqa: BLE001
+        logger.warning("Обработчик событий стадий упал на %s/%s: %s", event.stage, event.status, error)
+
+
+class StageGraph:
+    """
+    Декларативный граф стадий: узлы с явными входами, независимые ветки
+    выполняются параллельно (в пуле потоков для `run`, задачами asyncio для `arun`).
+    """
+
+    def __init__(self, stages: Iterable[Stage]):
+        self.stages: Dict[str, Stage] = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Дублирующееся имя стадии: {stage.name}")
+            self.stages[stage.name] = stage
+
+    def _validate(self, initial: Dict[str, Any]) -> None:
+        known = set(initial) | set(self.stages)
+        for stage in self.stages.values():
+            missing = [name for name in stage.inputs if name not in known]
+            if missing:
+                raise ValueError(f"Стадия {stage.name} зависит от неизвестных входов: {missing}")
+
+        # Проверка на циклы: топологическая сортировка по Кану
+        remaining = {name: {dep for dep in stage.inputs if dep in self.stages}
+                     for name, stage in self.stages.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Цикл в графе стадий: {sorted(remaining)}")
+            for name in ready:
+                remaining.pop(name)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def run(
+        self,
+        initial: Optional[Dict[str, Any]] = None,
+        max_workers: Optional[int] = None,
+        on_event: Optional[StageCallback] = None,
+    ) -> Tuple[Dict[str, Any], Dict[str, float]]:
+        """
+        Выполняет граф.
+
+        `on_event` получает StageEvent о начале и завершении каждой стадии;
+        вызывается из потоков стадий.
+
+        Returns:
+            Кортеж (результаты всех узлов и начальные значения, длительность узлов в секундах)
+
+        Raises:
+            Первое исключение, выброшенное любым узлом; еще не начатые узлы не запускаются
+        """
+        results: Dict[str, Any] = dict(initial or {})
+        self._validate(results)
+
+        timings: Dict[str, float] = {}
+        pending = dict(self.stages)
+        running: Dict[Future, str] = {}
+
+        def _timed(stage: Stage, kwargs: Dict[str, Any]) -> Any:
+            started = time.perf_counter()
+            emit(on_event, StageEvent(stage.name, "started"))
+            status, result = "failed", None
+            try:
+                result = stage.func(**kwargs)
+                status = "finished"
+                return result
+            finally:
+                timings[stage.name] = round(time.perf_counter() - started, 3)
+                emit(on_event, StageEvent(stage.name, status, timings[stage.name], result))
+
+        def _submit_ready(executor: ThreadPoolExecutor) -> None:
+            for name in list(pending):
+                stage = pending[name]
+                if all(dep in results for dep in stage.inputs):
+                    pending.pop(name)
+                    kwargs = {dep: results[dep] for dep in stage.inputs}
+                    # Переменные контекста вызывающего (contextvars) доступны и в потоке стадии
+                    running[executor.submit(contextvars.copy_context().run, _timed, stage, kwargs)] = name
+
+        workers = max_workers or max(1, len(self.stages))
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stage")
+        try:
+            _submit_ready(executor)
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        logger.error("Стадия %s завершилась ошибкой: %s", name, error)
+                        raise error
+                    results[name] = future.result()
+                _submit_ready(executor)
+        finally:
+            # Не ждем параллельные ветки, если граф уже упал
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return results, timings
+
+
+    async def arun(
+        self, initial: Optional[Dict[str, Any]] = None, on_event: Optional[StageCallback] = None
+    ) -> Tuple[Dict[str, Any], Dict[str, float]]:
+        """
+        Асинхронно выполняет граф в текущем event loop.
+
+        Узлы с `afunc` ожидаются напрямую, остальные выполняются через
+        `asyncio.to_thread`. Семантика результата и ошибок как у `run`;
+        при ошибке остальные запущенные узлы отменяются. `on_event`
+        вызывается в потоке event loop.
+        """
+        results: Dict[str, Any] = dict(initial or {})
+        self._validate(results)
+
+        timings: Dict[str, float] = {}
+        pending = dict(self.stages)
+        running: Dict[asyncio.Task, str] = {}
+
+        async def _timed(stage: Stage, kwargs: Dict[str, Any]) -> Any:
+            started = time.perf_counter()
+            emit(on_event, StageEvent(stage.name, "started"))
+            status, result = "failed", None
+            try:
+                if stage.afunc is not None:
+                    result = await stage.afunc(**kwargs)
+                else:
+                    result = await asyncio.to_thread(stage.func, **kwargs)
+                status = "finished"
+                return result
+            finally:
+                timings[stage.name] = round(time.perf_counter() - started, 3)
+                emit(on_event, StageEvent(stage.name, status, timings[stage.name], result))
+
+        def _start_ready() -> None:
+            for name in list(pending):
+                stage = pending[name]
+                if all(dep in results for dep in stage.inputs):
+                    pending.pop(name)
+                    kwargs = {dep: results[dep] for dep in stage.inputs}
+                    running[asyncio.create_task(_timed(stage, kwargs), name=f"stage-{name}")] = name
+
+        try:
+            _start_ready()
+            while running:
+                done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    error = task.exception()
+                    if error is not None:
+                        logger.error("Стадия %s завершилась ошибкой: %s", name, error)
+                        raise error
+                    results[name] = task.result()
+                _start_ready()
+        finally:
+            for task in running:
+                task.cancel()
+
+        return results, timings
@@ -1,24 +1,75 @@
 from __future__ import annotations
 
-import base64
-import os
+import asyncio
+import time
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Sequence, Tuple
 
-from PIL import Image, ImageDraw
+from PIL import Image
 
 from config import CONFIG, QualityMode
-from providers.anthropic import extract_product_spec, check_headwear_present
-from providers.replicate_flux import generate_base_model_image, inpaint_hat
-from utils.image_hash import sha256_hex
-from utils.images import resize_to_max, image_from_bytes, image_to_bytes, ensure_rgb
+from pipeline.base_pool import BasePortraitPool, PoolKey, PooledPortrait
+from pipeline.graph import Stage, StageCallback, StageEvent, StageGraph, emit
+from pipeline.headwear_detector import HeadwearVerdict, adetect_headwear_batch, detect_headwear_batch
+from pipeline.result_cache import ResultCache, make_cache_key
+from pipeline.spec_cache import SpecCache
+from providers.anthropic import FALLBACK_SPEC, aextract_product_spec, extract_product_spec
+from providers.hedging import hedge_report
+from providers.replicate_flux import (
+    agenerate_base_model_images,
+    ainpaint_hat,
+    generate_base_model_images,
+    inpaint_hat,
+    prediction_job,
+)
+from utils.image_hash import ColorSignature, color_signature
+from utils.images import ImageHandle, ImageSource, SpooledImage, image_to_bytes
 from utils.logging import get_logger
 from utils.mask import create_head_mask
+from utils.metrics import Counter, Histogram
 
 logger = get_logger(__name__)
 
+STAGE_SECONDS = Histogram(
+    "hat_stage_seconds", "Длительность стадий пайплайна", ("stage", "quality", "outcome")
+)
+PIPELINE_SECONDS = Histogram(
+    "hat_pipeline_seconds", "Полный прогон пайплайна", ("quality", "result_cache", "outcome")
+)
+BASE_ATTEMPT_SECONDS = Histogram(
+    "hat_base_attempt_seconds", "Генерация base портрета по номеру попытки guard", ("model", "attempt")
+)
+GUARD_CHECKS = Counter(
+    "hat_guard_checks_total", "Проверки base портрета на головной убор", ("model", "detector", "verdict")
+)
+GUARD_RETRIES = Counter(
+    "hat_guard_retries_total", "Перегенерации base портрета по решению guard", ("model", "reason")
+)
+BASE_PORTRAITS = Counter(
+    "hat_base_portraits_total", "Итоги guard по числу попыток", ("model", "attempts", "outcome")
+)
+
+# Версия промптов: увеличивайте при любом изменении текстов промптов,
+# чтобы кэш результатов не отдавал изображения, созданные по старым промптам.
+PROMPT_VERSION = 1
+
+RESULT_CACHE = ResultCache(
+    root=CONFIG.cache.result_cache_dir,
+    max_bytes=CONFIG.cache.result_cache_max_mb * 1024 * 1024,
+    max_age_seconds=CONFIG.cache.result_cache_max_age_hours * 3600,
+    enabled=CONFIG.cache.result_cache_enabled,
+)
+
+SPEC_CACHE = SpecCache(
+    path=CONFIG.cache.spec_cache_path,
+    max_distance=CONFIG.cache.spec_cache_max_distance,
+    max_entries=CONFIG.cache.spec_cache_max_entries,
+    max_color_distance=CONFIG.cache.spec_cache_max_color_distance,
+    enabled=CONFIG.cache.spec_cache_enabled,
+)
+
 
 def _select_flux_base_model(quality: QualityMode) -> str:
     if quality == "hq":
@@ -28,17 +79,19 @@ def _select_flux_base_model(quality: QualityMode) -> str:
 
 @dataclass
 class PipelineResult:
-    final_image: bytes
+    # Закодированный результат во временном буфере (память или диск); файл для reply_photo — final_image.open()
+    final_image: SpooledImage
     metadata: Dict[str, Any]
     overlay_image: Optional[bytes] = None  # Для режима отладки
 
 
-def _build_base_prompt(spec: Dict[str, Any], strict_mode: bool = False) -> str:
+def _build_base_prompt(strict_mode: bool = False) -> str:
     """
     Создает промпт для генерации базового портрета.
+    Промпт не зависит от спецификации продукта, поэтому base генерация
+    выполняется параллельно с анализом шапки.
 
     Args:
-        spec: Спецификация продукта (не используется в базовом промпте)
         strict_mode: Если True, добавляет еще более строгие ограничения против головных уборов
     """
     base = (
@@ -78,109 +131,217 @@ def _build_fill_prompt(spec: Dict[str, Any]) -> str:
 def _create_overlay_image(base_image: Image.Image, mask_l: Image.Image) -> Image.Image:
     """
     Создает изображение overlay для отладки: base + полупрозрачная красная маска.
+    Строится операциями над целым изображением, без попиксельного цикла.
     """
-    overlay = base_image.copy().convert("RGBA")
+    overlay = base_image.convert("RGBA")
 
-    # Создаем красную полупрозрачную маску
+    # Белые области маски (> 128) становятся полупрозрачным красным, остальное прозрачно
+    alpha = mask_l.convert("L").resize(base_image.size).point(lambda value: 128 if value > 128 else 0)
     red_mask = Image.new("RGBA", base_image.size, (255, 0, 0, 0))
-    red_draw = ImageDraw.Draw(red_mask)
-
-    # Конвертируем маску в пиксели
-    mask_resized = mask_l.resize(base_image.size)
-    for y in range(base_image.size[1]):
-        for x in range(base_image.size[0]):
-            pixel = mask_resized.getpixel((x, y))
-            if pixel > 128:  # Белые области маски
-                red_draw.point((x, y), fill=(255, 0, 0, 128))  # Полупрозрачный красный
+    red_mask.putalpha(alpha)
 
     # Накладываем красную маску на изображение
-    overlay = Image.alpha_composite(overlay, red_mask)
-    return overlay.convert("RGB")
+    return Image.alpha_composite(overlay, red_mask).convert("RGB")
+
+
+GUARD_MAX_ATTEMPTS = 3  # Основная попытка + 2 retry
+
+
+def _guard_prompt(attempt: int, base_model: str) -> str:
+    strict_mode = attempt > 0  # С 2-й попытки включаем strict mode
+    base_prompt = _build_base_prompt(strict_mode=strict_mode)
+
+    if CONFIG.pipeline.mask_debug:
+        logger.info(
+            f"Base generation attempt {attempt + 1}/{GUARD_MAX_ATTEMPTS}, "
+            f"strict_mode={strict_mode}, "
+            f"model={base_model}"
+        )
+        logger.debug(f"Base prompt: {base_prompt}")
+    return base_prompt
+
+
+def _guard_accepts(has_headwear: Optional[bool], attempt: int) -> bool:
+    """
+    Решение guard по результату проверки одного портрета.
+
+    Returns:
+        True — портрет принимается, False — нужна повторная генерация
+
+    Raises:
+        RuntimeError: Если на последней попытке все еще есть headwear
+    """
+    if CONFIG.pipeline.mask_debug:
+        state = "UNKNOWN" if has_headwear is None else ("FOUND" if has_headwear else "CLEAN")
+        logger.info(f"Headwear detection result: {state}")
+
+    if has_headwear is None:
+        logger.warning(
+            "Проверка головного убора не сработала, результат неизвестен. "
+            "Продолжаем работу, возможна повторная попытка."
+        )
+        if attempt < GUARD_MAX_ATTEMPTS - 1:
+            logger.info("Повторяем генерацию из-за сбоя проверки головного убора...")
+            return False
+        logger.info("Продолжаем с текущим изображением без подтверждения проверки.")
+        return True
+
+    if not has_headwear:
+        logger.info(f"Base image generated successfully (attempt {attempt + 1})")
+        return True
+
+    # Если headwear обнаружен и это не последняя попытка
+    if attempt < GUARD_MAX_ATTEMPTS - 1:
+        logger.warning(
+            f"Headwear detected in base image (attempt {attempt + 1}/{GUARD_MAX_ATTEMPTS}), "
+            f"retrying with stricter prompt..."
+        )
+        return False
+
+    # Последняя попытка и все еще есть headwear
+    error_msg = (
+        "Не удалось создать портрет без головных уборов после 3 попыток. "
+        "Модель генерации упорно добавляет головные уборы. "
+        "Пожалуйста, попробуйте запустить генерацию заново."
+    )
+    logger.error(error_msg)
+    raise RuntimeError(error_msg)
+
+
+def _guard_select(verdicts: Sequence[HeadwearVerdict], attempt: int) -> Optional[int]:
+    """
+    Выбор среди кандидатов одной попытки: первый чистый портрет; если чистых
+    нет — решение `_guard_accepts` (непроверенный принимается только на
+    последней попытке, портрет с головным убором — никогда).
+
+    Returns:
+        Индекс принятого кандидата или None — нужна повторная генерация
+
+    Raises:
+        RuntimeError: Если на последней попытке у всех кандидатов есть headwear
+    """
+    for index, verdict in enumerate(verdicts):
+        if verdict.has_headwear is False:
+            _guard_accepts(False, attempt)
+            return index
+    unknown = [index for index, verdict in enumerate(verdicts) if verdict.has_headwear is None]
+    if unknown:
+        return unknown[0] if _guard_accepts(None, attempt) else None
+    _guard_accepts(True, attempt)
+    return None
+
+
+def _record_guard_attempt(
+    base_model: str,
+    attempts: List[Dict[str, Any]],
+    attempt: int,
+    verdicts: Sequence[HeadwearVerdict],
+    generation_seconds: float,
+    on_event: Optional[StageCallback],
+) -> None:
+    """Журнал, метрики и события прогресса для кандидатов одной попытки guard."""
+    BASE_ATTEMPT_SECONDS.observe(generation_seconds, model=base_model, attempt=attempt + 1)
+    for candidate, verdict in enumerate(verdicts, start=1):
+        entry: Dict[str, Any] = {"attempt": attempt + 1, **verdict.as_dict()}
+        if len(verdicts) > 1:
+            entry["candidate"] = candidate
+        attempts.append(entry)
+        GUARD_CHECKS.inc(model=base_model, detector=verdict.detector, verdict=verdict.state)
+        emit(on_event, StageEvent("guard", "finished", verdict.latency_ms / 1000, detail=entry))
+
+
+def _guard_decision(base_model: str, verdicts: Sequence[HeadwearVerdict], attempt: int) -> Optional[int]:
+    """`_guard_select` с учетом перегенераций и итогов в метриках."""
+    try:
+        chosen = _guard_select(verdicts, attempt)
+    except RuntimeError:
+        BASE_PORTRAITS.inc(model=base_model, attempts=attempt + 1, outcome="rejected")
+        raise
+    if chosen is None:
+        found = any(verdict.has_headwear for verdict in verdicts)
+        GUARD_RETRIES.inc(model=base_model, reason="found" if found else "unknown")
+    else:
+        BASE_PORTRAITS.inc(model=base_model, attempts=attempt + 1, outcome="accepted")
+    return chosen
 
 
 def _generate_base_with_headwear_guard(
-    spec: Dict[str, Any], width: int, height: int, steps: int, base_model: str
-) -> bytes:
+    width: int, height: int, steps: int, base_model: str, on_event: Optional[StageCallback] = None
+) -> Tuple[ImageHandle, List[Dict[str, Any]]]:
     """
     Генерирует base image с проверкой на наличие головных уборов.
-    Повторяет генерацию до 2 раз при обнаружении headwear.
+
+    Каждая попытка запрашивает BASE_CANDIDATES портретов одним предсказанием
+    FLUX (`num_outputs`), все кандидаты проверяются вместе: локальный CPU-детектор,
+    затем одно сообщение Claude для нерешенных. Побеждает первый чистый кандидат;
+    если чистых нет, генерация повторяется до 2 раз со strict промптом.
 
     Args:
-        spec: Спецификация продукта
         width: Ширина изображения
         height: Высота изображения
         steps: Количество шагов генерации
+        base_model: Модель FLUX для base генерации
+        on_event: Подписчик событий; получает событие "guard" по каждому кандидату
 
     Returns:
-        Байты сгенерированного изображения
+        Принятый портрет (декодированный детекторами один раз) и журнал проверок
+        (попытка, кандидат, какой детектор принял решение и за сколько)
 
     Raises:
         RuntimeError: Если после всех попыток все еще есть headwear
     """
-    max_attempts = 3  # Основная попытка + 2 retry
-    is_debug = CONFIG.pipeline.mask_debug
-
-    for attempt in range(max_attempts):
-        strict_mode = attempt > 0  # С 2-й попытки включаем strict mode
-        base_prompt = _build_base_prompt(spec, strict_mode=strict_mode)
-
-        if is_debug:
-            logger.info(
-                f"Base generation attempt {attempt + 1}/{max_attempts}, "
-                f"strict_mode={strict_mode}, "
-                f"model={base_model}"
+    attempts: List[Dict[str, Any]] = []
+    candidates = max(1, CONFIG.pipeline.base_candidates)
+    for attempt in range(GUARD_MAX_ATTEMPTS):
+        base_prompt = _guard_prompt(attempt, base_model)
+        started = time.perf_counter()
+        images = [
+            ImageHandle(image)
+            for image in generate_base_model_images(
+                base_prompt, width, height, steps, model=base_model, num_outputs=candidates
             )
-            logger.debug(f"Base prompt: {base_prompt}")
+        ]
+        generation_seconds = time.perf_counter() - started
+        verdicts = detect_headwear_batch(images)
+        _record_guard_attempt(base_model, attempts, attempt, verdicts, generation_seconds, on_event)
+        chosen = _guard_decision(base_model, verdicts, attempt)
+        if chosen is not None:
+            return images[chosen], attempts
 
-        # Генерируем изображение
-        base_image_bytes = generate_base_model_image(base_prompt, width, height, steps, model=base_model)
-
-        # Проверяем на наличие headwear
-        has_headwear = check_headwear_present(base_image_bytes)
+    # Этот код не должен быть достижим, но для безопасности
+    raise RuntimeError("Unexpected error in base generation")
 
-        if is_debug:
-            state = "UNKNOWN" if has_headwear is None else ("FOUND" if has_headwear else "CLEAN")
-            logger.info(f"Headwear detection result: {state}")
 
-        if has_headwear is None:
-            logger.warning(
-                "Проверка головного убора не сработала, результат неизвестен. "
-                "Продолжаем работу, возможна повторная попытка."
-            )
-            if attempt < max_attempts - 1:
-                logger.info("Повторяем генерацию из-за сбоя проверки головного убора...")
-                continue
-            logger.info("Продолжаем с текущим изображением без подтверждения проверки.")
-            return base_image_bytes
-
-        if not has_headwear:
-            logger.info(f"Base image generated successfully (attempt {attempt + 1})")
-            return base_image_bytes
-
-        # Если headwear обнаружен и это не последняя попытка
-        if attempt < max_attempts - 1:
-            logger.warning(
-                f"Headwear detected in base image (attempt {attempt + 1}/{max_attempts}), "
-                f"retrying with stricter prompt..."
-            )
-        else:
-            # Последняя попытка и все еще есть headwear
-            error_msg = (
-                "Не удалось создать портрет без головных уборов после 3 попыток. "
-                "Модель генерации упорно добавляет головные уборы. "
-                "Пожалуйста, попробуйте запустить генерацию заново."
+async def _agenerate_base_with_headwear_guard(
+    width: int, height: int, steps: int, base_model: str, on_event: Optional[StageCallback] = None
+) -> Tuple[ImageHandle, List[Dict[str, Any]]]:
+    """Асинхронный вариант `_generate_base_with_headwear_guard`."""
+    attempts: List[Dict[str, Any]] = []
+    candidates = max(1, CONFIG.pipeline.base_candidates)
+    for attempt in range(GUARD_MAX_ATTEMPTS):
+        base_prompt = _guard_prompt(attempt, base_model)
+        started = time.perf_counter()
+        images = [
+            ImageHandle(image)
+            for image in await agenerate_base_model_images(
+                base_prompt, width, height, steps, model=base_model, num_outputs=candidates
             )
-            logger.error(error_msg)
-            raise RuntimeError(error_msg)
+        ]
+        generation_seconds = time.perf_counter() - started
+        verdicts = await adetect_headwear_batch(images)
+        _record_guard_attempt(base_model, attempts, attempt, verdicts, generation_seconds, on_event)
+        chosen = _guard_decision(base_model, verdicts, attempt)
+        if chosen is not None:
+            return images[chosen], attempts
 
-    # Этот код не должен быть достижим, но для безопасности
     raise RuntimeError("Unexpected error in base generation")
 
 
 def _save_debug_images(request_id: str, base_image: Image.Image, mask_l: Image.Image,
-                       final_image_bytes: bytes, overlay: Image.Image) -> None:
+                       final_image: SpooledImage, overlay_bytes: bytes) -> None:
     """
     Сохраняет отладочные изображения в папку debug/.
+    Overlay и результат сохраняются уже закодированными, без повторного декодирования.
     """
     debug_dir = Path("debug")
     debug_dir.mkdir(exist_ok=True)
@@ -191,59 +352,329 @@ def _save_debug_images(request_id: str, base_image: Image.Image, mask_l: Image.I
     try:
         base_image.save(debug_dir / f"{prefix}_base.png")
         mask_l.save(debug_dir / f"{prefix}_mask.png")
-        overlay.save(debug_dir / f"{prefix}_overlay.png")
+        (debug_dir / f"{prefix}_overlay.png").write_bytes(overlay_bytes)
 
-        final_image = image_from_bytes(final_image_bytes)
-        final_image.save(debug_dir / f"{prefix}_result.png")
+        final_image.copy_to(debug_dir / f"{prefix}_result.{final_image.extension}")
 
         logger.info(f"Debug images saved to {debug_dir} with prefix {prefix}")
     except Exception as e:
         logger.error(f"Failed to save debug images: {e}")
 
 
-def generate_hat_on_model(product_image: bytes, quality_mode: QualityMode | None = None) -> PipelineResult:
-    quality = quality_mode or CONFIG.pipeline.quality_mode
-    steps = CONFIG.pipeline.steps_hq if quality == "hq" else CONFIG.pipeline.steps_preview
-    base_model = _select_flux_base_model(quality)
+def _store_spec(spec_hash: int, spec_color: ColorSignature, spec: Dict[str, Any]) -> Dict[str, Any]:
+    # Запасную спецификацию (невалидный JSON от модели) не кэшируем
+    if spec != FALLBACK_SPEC:
+        SPEC_CACHE.store(spec_hash, spec_color, spec)
+    return spec
 
-    resized_bytes, _ = resize_to_max(product_image, CONFIG.pipeline.max_size)
-    spec = extract_product_spec(resized_bytes)
 
-    width = height = CONFIG.pipeline.max_size
+def _steps_for_quality(quality: QualityMode) -> int:
+    return CONFIG.pipeline.steps_hq if quality == "hq" else CONFIG.pipeline.steps_preview
 
-    # Генерируем base image с проверкой на головные уборы (guard)
-    base_image_bytes = _generate_base_with_headwear_guard(spec, width, height, steps, base_model)
-    base_image = ensure_rgb(image_from_bytes(base_image_bytes))
 
-    mask_l = create_head_mask(base_image)
-    mask_bytes = image_to_bytes(mask_l, format="PNG")
+def _produce_pooled_portrait(key: PoolKey) -> PooledPortrait:
+    """Генерирует портрет для пула: guard + маска считаются заранее, вне запроса пользователя."""
+    quality, width, height, base_model = key
+    base, guard = _generate_base_with_headwear_guard(width, height, _steps_for_quality(quality), base_model)
+    return PooledPortrait(base=base, mask=create_head_mask(base.rgb), guard=guard)
 
-    # Создаем overlay изображение для отладки (если включен режим MASK_DEBUG)
-    overlay_bytes = None
+
+BASE_POOL = BasePortraitPool(
+    depth=CONFIG.pipeline.base_pool_size,
+    producer=_produce_pooled_portrait,
+    workers=CONFIG.pipeline.base_pool_workers,
+    max_age_seconds=CONFIG.pipeline.base_pool_max_age_seconds,
+    pause_after=CONFIG.pipeline.base_pool_pause_after,
+    pause_seconds=CONFIG.pipeline.base_pool_pause_seconds,
+)
+
+
+def _pool_key(quality: QualityMode) -> PoolKey:
+    size = CONFIG.pipeline.max_size
+    return (quality, size, size, _select_flux_base_model(quality))
+
+
+def start_base_pool(quality_mode: QualityMode | None = None) -> None:
+    """Запускает фоновое пополнение пула и прогревает ключ для режима по умолчанию."""
+    if not BASE_POOL.enabled:
+        return
+    BASE_POOL.register(_pool_key(quality_mode or CONFIG.pipeline.quality_mode))
+    BASE_POOL.start()
+
+
+def _build_pipeline_graph(key: PoolKey, steps: int, on_event: Optional[StageCallback] = None) -> StageGraph:
+    """
+    Собирает граф стадий пайплайна.
+
+    Ветка анализа (resize → spec) и ветка портрета (base → mask) независимы
+    и выполняются параллельно; inpaint ждет обе. Портрет из пула приходит
+    с готовой маской. Стадии с вызовами провайдеров имеют async вариант
+    для `StageGraph.arun`.
+    """
+    _, width, height, base_model = key
+
+    def spec(
+        resized: ImageHandle,
+        resized_extras: List[ImageHandle],
+        spec_hash: int,
+        spec_color: ColorSignature,
+        spec_cached: Optional[tuple],
+    ) -> Dict[str, Any]:
+        if spec_cached:
+            return spec_cached[0]
+        spec_value = extract_product_spec([resized, *resized_extras])
+        # Спецификация альбома собрана по нескольким фото: по хешу первого ее не кэшируем
+        return spec_value if resized_extras else _store_spec(spec_hash, spec_color, spec_value)
+
+    async def aspec(
+        resized: ImageHandle,
+        resized_extras: List[ImageHandle],
+        spec_hash: int,
+        spec_color: ColorSignature,
+        spec_cached: Optional[tuple],
+    ) -> Dict[str, Any]:
+        if spec_cached:
+            return spec_cached[0]
+        spec_value = await aextract_product_spec([resized, *resized_extras])
+        if resized_extras:
+            return spec_value
+        return await asyncio.to_thread(_store_spec, spec_hash, spec_color, spec_value)
+
+    def base(pooled: Optional[PooledPortrait]) -> Tuple[ImageHandle, List[Dict[str, Any]]]:
+        if pooled:
+            return pooled.base, pooled.guard
+        return _generate_base_with_headwear_guard(width, height, steps, base_model, on_event)
+
+    async def abase(pooled: Optional[PooledPortrait]) -> Tuple[ImageHandle, List[Dict[str, Any]]]:
+        if pooled:
+            return pooled.base, pooled.guard
+        return await _agenerate_base_with_headwear_guard(width, height, steps, base_model, on_event)
+
+    def fill_inputs(portrait: ImageHandle, mask: Image.Image, spec: Dict[str, Any]) -> tuple:
+        # PNG кодируются здесь (в потоке стадии), провайдер берет их из ручек готовыми;
+        # портрет, пришедший в PNG, не перекодируется
+        mask_handle = ImageHandle(image=mask)
+        for handle in (portrait, mask_handle):
+            handle.png
+        return (portrait, mask_handle, _build_fill_prompt(spec), steps)
+
+    def final_bytes(portrait: ImageHandle, mask: Image.Image, spec: Dict[str, Any]) -> SpooledImage:
+        return inpaint_hat(*fill_inputs(portrait, mask, spec))
+
+    async def afinal_bytes(portrait: ImageHandle, mask: Image.Image, spec: Dict[str, Any]) -> SpooledImage:
+        return await ainpaint_hat(*await asyncio.to_thread(fill_inputs, portrait, mask, spec))
+
+    stages = [
+        Stage("resized", lambda product_image: product_image.resized(CONFIG.pipeline.max_size), ("product_image",)),
+        # Остальные фото альбома идут только в анализ шапки
+        Stage(
+            "resized_extras",
+            lambda extra_images: [image.resized(CONFIG.pipeline.max_size) for image in extra_images],
+            ("extra_images",),
+        ),
+        Stage("spec_hash", lambda resized: resized.dhash(), ("resized",)),
+        Stage("spec_color", lambda resized: color_signature(resized.image), ("resized",)),
+        # Спецификация похожего фото из кэша или None (тогда запрашиваем Claude);
+        # для альбомов кэш не используется: ключ — хеш только первого фото
+        Stage(
+            "spec_cached",
+            lambda spec_hash, spec_color, resized_extras: (
+                None if resized_extras else SPEC_CACHE.lookup(spec_hash, spec_color)
+            ),
+            ("spec_hash", "spec_color", "resized_extras"),
+        ),
+        Stage(
+            "spec",
+            spec,
+            ("resized", "resized_extras", "spec_hash", "spec_color", "spec_cached"),
+            afunc=aspec,
+        ),
+        # Готовый портрет из пула или None (тогда генерируем inline)
+        Stage("pooled", lambda: BASE_POOL.take(key)),
+        # Портрет и журнал проверок guard
+        Stage("base", base, ("pooled",), afunc=abase),
+        # Портрет декодирован один раз (детекторами guard или здесь) и общий для маски, превью и инпейнтинга
+        Stage("portrait", lambda base: base[0], ("base",)),
+        Stage("base_image", lambda portrait: portrait.rgb, ("portrait",)),
+        Stage(
+            "mask",
+            lambda pooled, base_image: pooled.mask if pooled else create_head_mask(base_image),
+            ("pooled", "base_image"),
+        ),
+        Stage("final_bytes", final_bytes, ("portrait", "mask", "spec"), afunc=afinal_bytes),
+    ]
+
+    # Overlay для отладки строится параллельно с инпейнтингом (если включен режим MASK_DEBUG)
     if CONFIG.pipeline.mask_debug:
-        overlay = _create_overlay_image(base_image, mask_l)
-        overlay_bytes = image_to_bytes(overlay, format="PNG")
+        stages.append(
+            Stage("overlay", lambda base_image, mask: _create_overlay_image(base_image, mask), ("base_image", "mask"))
+        )
+
+    return StageGraph(stages)
+
+
+def _observed(on_event: Optional[StageCallback], quality: QualityMode) -> StageCallback:
+    """Подписчик событий, который пишет длительность стадий в метрики и передает события дальше."""
+
+    def handle(event: StageEvent) -> None:
+        if event.status != "started" and event.stage != "guard":
+            outcome = "ok" if event.status == "finished" else "error"
+            STAGE_SECONDS.observe(event.elapsed, stage=event.stage, quality=quality, outcome=outcome)
+        emit(on_event, event)
 
-    fill_prompt = _build_fill_prompt(spec)
-    final_image_bytes = inpaint_hat(image_to_bytes(base_image, format="PNG"), mask_bytes, fill_prompt, steps)
+    return handle
 
-    # Сохраняем отладочные изображения если включен режим MASK_DEBUG
+
+@dataclass
+class _Job:
+    quality: QualityMode
+    steps: int
+    key: PoolKey
+    product_hash: str
+    cache_key: str
+    album_size: int = 1
+
+    @property
+    def base_model(self) -> str:
+        return self.key[3]
+
+
+def _prepare_job(
+    product_image: ImageHandle, quality_mode: QualityMode | None, extra_images: Sequence[ImageHandle] = ()
+) -> _Job:
+    quality = quality_mode or CONFIG.pipeline.quality_mode
+    steps = _steps_for_quality(quality)
+    key = _pool_key(quality)
+    product_hash = product_image.sha256
+    # Фото альбома влияют на спецификацию, поэтому входят в ключ результата
+    album_hashes = [image.sha256 for image in extra_images]
+    cache_key = make_cache_key(
+        product_hash, quality, key[3], CONFIG.providers.flux_fill_model,
+        CONFIG.pipeline.max_size, steps, PROMPT_VERSION, *album_hashes,
+    )
+    return _Job(
+        quality=quality, steps=steps, key=key, product_hash=product_hash, cache_key=cache_key,
+        album_size=1 + len(album_hashes),
+    )
+
+
+def _cached_result(job: _Job) -> Optional[PipelineResult]:
+    cached = RESULT_CACHE.get(job.cache_key)
+    if cached is None:
+        return None
+    final_image, overlay_bytes, metadata = cached
+    return PipelineResult(
+        final_image=final_image,
+        metadata={**metadata, "result_cache": "hit"},
+        overlay_image=overlay_bytes,
+    )
+
+
+def _finalize(
+    job: _Job, results: Dict[str, Any], timings: Dict[str, float], hedging: Dict[str, Any]
+) -> PipelineResult:
+    """Собирает результат из узлов графа, сохраняет отладку и кладет результат в кэш."""
+    logger.info("Тайминги стадий: %s", timings)
+
+    spec = results["spec"]
+    base_image = results["base_image"]
+    mask_l = results["mask"]
+    final_image: SpooledImage = results["final_bytes"]
+
+    overlay_bytes = None
     if CONFIG.pipeline.mask_debug:
-        request_id = sha256_hex(product_image)[:8]
-        overlay_for_save = _create_overlay_image(base_image, mask_l)
-        _save_debug_images(request_id, base_image, mask_l, final_image_bytes, overlay_for_save)
+        # Overlay кодируется один раз и используется и для ответа в Telegram, и для debug/
+        overlay_bytes = image_to_bytes(results["overlay"], format="PNG")
+        _save_debug_images(job.product_hash[:8], base_image, mask_l, final_image, overlay_bytes)
 
     metadata = {
         "spec": spec,
-        "quality_mode": quality,
-        "base_model": base_model,
-        "steps": steps,
+        "spec_source": "cache" if results["spec_cached"] else "claude",
+        "album_photos": job.album_size,
+        "quality_mode": job.quality,
+        "base_model": job.base_model,
+        "steps": job.steps,
+        "base_source": "pool" if results["pooled"] else "inline",
+        "headwear_guard": results["base"][1],
+        "hedging": hedging,
+        "final_image": {"format": final_image.format, "bytes": final_image.size},
         "hashes": {
-            "product": sha256_hex(product_image),
-            "base": sha256_hex(base_image_bytes),
-            "final": sha256_hex(final_image_bytes),
+            "product": job.product_hash,
+            "base": results["portrait"].sha256,
+            "final": final_image.sha256,
         },
-        "preview_note": "Используется режим preview (низкая стоимость)" if quality != "hq" else "HQ",
+        "result_cache": "miss",
+        "timings": timings,
+        "preview_note": "Используется режим preview (низкая стоимость)" if job.quality != "hq" else "HQ",
+        "prompt_version": PROMPT_VERSION,
     }
+    RESULT_CACHE.put(job.cache_key, final_image, overlay_bytes, metadata)
+
+    return PipelineResult(final_image=final_image, metadata=metadata, overlay_image=overlay_bytes)
+
 
-    return PipelineResult(final_image=final_image_bytes, metadata=metadata, overlay_image=overlay_bytes)
+def generate_hat_on_model(
+    product_image: ImageSource,
+    quality_mode: QualityMode | None = None,
+    on_event: Optional[StageCallback] = None,
+    extra_images: Sequence[ImageSource] = (),
+) -> PipelineResult:
+    """
+    Полный пайплайн: фото шапки → фото модели в этой шапке.
+
+    `on_event` получает события стадий (начало/завершение, попытки guard) —
+    для отображения прогресса; событие "base_image" несет готовый портрет.
+    `extra_images` — остальные фото той же шапки из альбома: они анализируются
+    вместе с основным одним запросом к Claude, генерация выполняется один раз.
+    Фото принимаются байтами или ImageHandle и декодируются один раз за задачу.
+    """
+    started = time.perf_counter()
+    product, extras = ImageHandle.of(product_image), tuple(ImageHandle.of(image) for image in extra_images)
+    job = _prepare_job(product, quality_mode, extras)
+    cached = _cached_result(job)
+    if cached is not None:
+        elapsed = time.perf_counter() - started
+        PIPELINE_SECONDS.observe(elapsed, quality=job.quality, result_cache="hit", outcome="ok")
+        return cached
+
+    on_event = _observed(on_event, job.quality)
+    graph = _build_pipeline_graph(job.key, job.steps, on_event)
+    # Предсказания Replicate этой задачи журналируются и возобновляются после перезапуска,
+    # их хеджирование попадает в metadata
+    with PIPELINE_SECONDS.time(quality=job.quality, result_cache="miss"), prediction_job(job.cache_key):
+        with hedge_report() as hedging:
+            results, timings = graph.run(
+                {"product_image": product, "extra_images": extras}, on_event=on_event
+            )
+    return _finalize(job, results, timings, hedging.summary())
+
+
+async def agenerate_hat_on_model(
+    product_image: ImageSource,
+    quality_mode: QualityMode | None = None,
+    on_event: Optional[StageCallback] = None,
+    extra_images: Sequence[ImageSource] = (),
+) -> PipelineResult:
+    """
+    Асинхронный вариант `generate_hat_on_model`.
+
+    Вызовы провайдеров ожидаются на общих async клиентах и не занимают потоки;
+    в потоках выполняются только CPU/диск стадии (resize, маска, кэши).
+    """
+    started = time.perf_counter()
+    product, extras = ImageHandle.of(product_image), tuple(ImageHandle.of(image) for image in extra_images)
+    job = await asyncio.to_thread(_prepare_job, product, quality_mode, extras)
+    cached = await asyncio.to_thread(_cached_result, job)
+    if cached is not None:
+        elapsed = time.perf_counter() - started
+        PIPELINE_SECONDS.observe(elapsed, quality=job.quality, result_cache="hit", outcome="ok")
+        return cached
+
+    on_event = _observed(on_event, job.quality)
+    graph = _build_pipeline_graph(job.key, job.steps, on_event)
+    with PIPELINE_SECONDS.time(quality=job.quality, result_cache="miss"), prediction_job(job.cache_key):
+        with hedge_report() as hedging:
+            results, timings = await graph.arun(
+                {"product_image": product, "extra_images": extras}, on_event=on_event
+            )
+    return await asyncio.to_thread(_finalize, job, results, timings, hedging.summary())
@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import asyncio
+import colorsys
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Protocol, Sequence, Tuple
+
+from PIL import Image
+
+from config import CONFIG
+from providers.anthropic import (
+    acheck_headwear_batch,
+    acheck_headwear_present,
+    check_headwear_batch,
+    check_headwear_present,
+)
+from utils.images import ImageHandle, ImageSource
+from utils.logging import get_logger
+from utils.metrics import Histogram
+
+logger = get_logger(__name__)
+
+DETECTOR_SECONDS = Histogram(
+    "headwear_detector_seconds", "Проверка портрета на головной убор по детекторам", ("detector", "verdict")
+)
+
+
+try:  # pragma: no cover - optional dependency
+    import numpy as np
+    import onnxruntime
+    _ONNX_AVAILABLE = True
+except Exception:  # pragma: no cover
+    _ONNX_AVAILABLE = False
+
+
+@dataclass
+class HeadwearVerdict:
+    """Решение одного детектора: True — головной убор есть, None — не удалось определить."""
+
+    has_headwear: Optional[bool]
+    confidence: float
+    detector: str
+    latency_ms: float
+
+    @property
+    def state(self) -> str:
+        return "unknown" if self.has_headwear is None else ("found" if self.has_headwear else "clean")
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "detector": self.detector,
+            "verdict": self.state,
+            "confidence": round(self.confidence, 3),
+            "latency_ms": round(self.latency_ms, 1),
+        }
+
+
+class HeadwearDetector(Protocol):
+    """
+    Локальный CPU-детектор: (есть ли головной убор или None, уверенность 0..1).
+
+    `can_reject` — может ли детектор сам забраковать портрет; если нет, его
+    ответ «головной убор есть» перепроверяет Claude при любой уверенности.
+    """
+
+    name: str
+    can_reject: bool
+
+    def detect(self, image: Image.Image) -> Tuple[Optional[bool], float]:
+        ...
+
+
+class HeuristicHeadwearDetector:
+    """
+    Эвристика по области над лицом (та же зона, что и маска шапки).
+
+    Фон оценивается по верхним углам кадра; среди пикселей переднего плана
+    в зоне макушки считается доля «ярких» (насыщенный цвет вне оттенков
+    волос) и доля «похожих на волосы» пикселей. Оба ответа эвристики
+    ограничены по уверенности: шапку в цвет волос она не отличит от волос,
+    а крашеные волосы — от ткани. Уверенное «чисто» (макушка почти целиком
+    цвета волос) проходит порог по умолчанию и экономит вызов Claude, а
+    «головной убор есть» от эвристики не бракует портрет никогда.
+    """
+
+    name = "heuristic"
+    can_reject = False
+    PROBE_SIZE = 64
+    # Оттенки волос в градусах HSV: рыжие и медные у 0° (с переходом через 360°),
+    # каштановые, русые и золотистые блонд — до 55°
+    HAIR_HUE_BANDS = ((0.0, 55.0), (340.0, 360.0))
+    MAX_CLEAN_CONFIDENCE = 0.7
+    MAX_FOUND_CONFIDENCE = 0.7
+
+    def _features(self, image: Image.Image) -> Tuple[float, float, float]:
+        probe = image.convert("RGB").resize((self.PROBE_SIZE, self.PROBE_SIZE), Image.Resampling.BILINEAR)
+        size = self.PROBE_SIZE
+        corner = max(2, size // 10)
+        background = [
+            probe.getpixel((x, y))
+            for x in list(range(corner)) + list(range(size - corner, size))
+            for y in range(corner)
+        ]
+        bg = tuple(sum(channel) / len(background) for channel in zip(*background))
+
+        crown = probe.crop((int(size * 0.19), int(size * 0.06), int(size * 0.81), int(size * 0.34)))
+        foreground = vivid = hair = 0
+        for r, g, b in crown.getdata():
+            if abs(r - bg[0]) + abs(g - bg[1]) + abs(b - bg[2]) < 60:
+                continue
+            foreground += 1
+            hue, saturation, value = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+            hue *= 360
+            hair_hue = any(low <= hue <= high for low, high in self.HAIR_HUE_BANDS)
+            if saturation > 0.45 and value > 0.25 and not hair_hue:
+                vivid += 1
+            elif value < 0.35 or (hair_hue and 0.15 <= saturation <= 0.85):
+                hair += 1
+
+        total = crown.size[0] * crown.size[1]
+        if not foreground:
+            return 0.0, 0.0, 0.0
+        return foreground / total, vivid / foreground, hair / foreground
+
+    def detect(self, image: Image.Image) -> Tuple[Optional[bool], float]:
+        foreground_ratio, vivid_ratio, hair_ratio = self._features(image)
+        if foreground_ratio < 0.1:
+            # Макушка не найдена (необычная композиция) — решать не берёмся
+            return None, 0.0
+        if vivid_ratio >= 0.25:
+            return True, min(self.MAX_FOUND_CONFIDENCE, 0.5 + vivid_ratio)
+        if hair_ratio >= 0.85 and vivid_ratio < 0.03:
+            # Доля волос 0.9 и выше без ярких пикселей — потолок уверенности, его и ждет порог по умолчанию
+            return False, min(self.MAX_CLEAN_CONFIDENCE, 0.5 + (hair_ratio - 0.85) * 4)
+        return None, 0.0
+
+
+class OnnxHeadwearDetector:  # pragma: no cover - optional dependency
+    """
+    Классификатор ONNX: вход 1x3x224x224 (RGB, нормализация ImageNet),
+    выход — вероятность головного убора (один логит или softmax из двух классов).
+    """
+
+    name = "onnx"
+    can_reject = True
+    INPUT_SIZE = 224
+    MEAN = (0.485, 0.456, 0.406)
+    STD = (0.229, 0.224, 0.225)
+
+    def __init__(self, model_path: str):
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1
+        self._session = onnxruntime.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self._input_name = self._session.get_inputs()[0].name
+
+    def detect(self, image: Image.Image) -> Tuple[Optional[bool], float]:
+        probe = image.convert("RGB").resize((self.INPUT_SIZE, self.INPUT_SIZE), Image.Resampling.BILINEAR)
+        tensor = (np.asarray(probe, dtype=np.float32) / 255.0 - self.MEAN) / self.STD
+        tensor = tensor.transpose(2, 0, 1)[None].astype(np.float32)
+        output = np.asarray(self._session.run(None, {self._input_name: tensor})[0]).reshape(-1)
+        if output.size == 1:
+            probability = float(1 / (1 + np.exp(-output[0])))
+        else:
+            exp = np.exp(output - output.max())
+            probability = float(exp[-1] / exp.sum())
+        has_headwear = probability >= 0.5
+        return has_headwear, probability if has_headwear else 1 - probability
+
+
+def _build_local_detectors() -> List[HeadwearDetector]:
+    kind = CONFIG.pipeline.headwear_detector
+    if kind == "off":
+        return []
+    if kind == "onnx":
+        if not _ONNX_AVAILABLE or not CONFIG.pipeline.headwear_onnx_model:
+            logger.warning("ONNX детектор недоступен (нет onnxruntime или HEADWEAR_ONNX_MODEL), используем эвристику")
+        else:
+            try:  # pragma: no cover - optional dependency
+                return [OnnxHeadwearDetector(CONFIG.pipeline.headwear_onnx_model)]
+            except Exception as error:  # noqa: BLE001
+                logger.warning("Не удалось загрузить ONNX детектор, используем эвристику: %s", error)
+    return [HeuristicHeadwearDetector()]
+
+
+LOCAL_DETECTORS: List[HeadwearDetector] = _build_local_detectors()
+
+
+def _detect_locally(image_bytes: ImageSource) -> Optional[HeadwearVerdict]:
+    """Локальные детекторы по очереди; первый уверенный ответ побеждает."""
+    if not LOCAL_DETECTORS:
+        return None
+    # Ручка декодирует портрет один раз: его же потом используют маска и инпейнтинг
+    image = ImageHandle.of(image_bytes).image
+    for detector in LOCAL_DETECTORS:
+        started = time.perf_counter()
+        try:
+            has_headwear, confidence = detector.detect(image)
+        except Exception as error:  # noqa: BLE001
+            logger.warning("Локальный детектор %s упал: %s", detector.name, error)
+            continue
+        verdict = HeadwearVerdict(
+            has_headwear, confidence, detector.name, (time.perf_counter() - started) * 1000
+        )
+        DETECTOR_SECONDS.observe(verdict.latency_ms / 1000, detector=detector.name, verdict=verdict.state)
+        logger.info(
+            "Локальный детектор %s: %s (уверенность %.2f, %.1f мс)",
+            detector.name, verdict.state, confidence, verdict.latency_ms,
+        )
+        if has_headwear and not detector.can_reject:
+            continue
+        if has_headwear is not None and confidence >= CONFIG.pipeline.headwear_local_confidence:
+            return verdict
+    return None
+
+
+def _claude_verdict(has_headwear: Optional[bool], started: float) -> HeadwearVerdict:
+    confidence = 0.0 if has_headwear is None else 1.0
+    verdict = HeadwearVerdict(has_headwear, confidence, "claude", (time.perf_counter() - started) * 1000)
+    DETECTOR_SECONDS.observe(verdict.latency_ms / 1000, detector="claude", verdict=verdict.state)
+    return verdict
+
+
+def detect_headwear(image_bytes: ImageSource) -> HeadwearVerdict:
+    """Проверка портрета: сначала локально на CPU, Claude — только при низкой уверенности."""
+    local = _detect_locally(image_bytes)
+    if local is not None:
+        return local
+    started = time.perf_counter()
+    has_headwear = check_headwear_present(image_bytes)
+    return _claude_verdict(has_headwear, started)
+
+
+async def adetect_headwear(image_bytes: ImageSource) -> HeadwearVerdict:
+    """Асинхронный вариант `detect_headwear`: локальный детектор в потоке, Claude на async клиенте."""
+    local = await asyncio.to_thread(_detect_locally, image_bytes)
+    if local is not None:
+        return local
+    started = time.perf_counter()
+    has_headwear = await acheck_headwear_present(image_bytes)
+    return _claude_verdict(has_headwear, started)
+
+
+# Кандидат не проверялся: среди остальных уже нашелся чистый портрет
+SKIPPED = HeadwearVerdict(None, 0.0, "skipped", 0.0)
+
+
+def _claude_pending(local: List[Optional[HeadwearVerdict]]) -> List[int]:
+    """Кандидаты для Claude: нерешенные локально, если ни один не признан чистым."""
+    if any(verdict is not None and verdict.has_headwear is False for verdict in local):
+        return []
+    return [index for index, verdict in enumerate(local) if verdict is None]
+
+
+def _merge_verdicts(
+    local: List[Optional[HeadwearVerdict]], pending: List[int], answers: List[Optional[bool]], started: float
+) -> List[HeadwearVerdict]:
+    verdicts = [verdict or SKIPPED for verdict in local]
+    for index, has_headwear in zip(pending, answers):
+        verdicts[index] = _claude_verdict(has_headwear, started)
+    return verdicts
+
+
+def detect_headwear_batch(images: Sequence[ImageSource]) -> List[HeadwearVerdict]:
+    """
+    Проверка нескольких кандидатов: локальные детекторы по каждому, затем
+    одно сообщение Claude со всеми нерешенными. Если локально уже найден
+    чистый портрет, Claude не вызывается.
+    """
+    local = [_detect_locally(image) for image in images]
+    pending = _claude_pending(local)
+    started = time.perf_counter()
+    answers = check_headwear_batch([images[index] for index in pending]) if pending else []
+    return _merge_verdicts(local, pending, answers, started)
+
+
+async def adetect_headwear_batch(images: Sequence[ImageSource]) -> List[HeadwearVerdict]:
+    """Асинхронный вариант `detect_headwear_batch`."""
+    local = await asyncio.to_thread(lambda: [_detect_locally(image) for image in images])
+    pending = _claude_pending(local)
+    started = time.perf_counter()
+    answers = await acheck_headwear_batch([images[index] for index in pending]) if pending else []
+    return _merge_verdicts(local, pending, answers, started)
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+from utils.logging import get_logger
+from utils.metrics import Gauge, Histogram
+
+logger = get_logger(__name__)
+
+QUEUE_WAIT_SECONDS = Histogram("queue_wait_seconds", "Ожидание задачи в очереди пайплайна")
+QUEUE_SERVICE_SECONDS = Histogram("queue_service_seconds", "Выполнение задачи воркером очереди", ("outcome",))
+QUEUE_DEPTH = Gauge("queue_depth", "Задач в очереди пайплайна, еще не взятых воркерами")
+QUEUE_OWNER_BACKLOG = Gauge("queue_owner_backlog", "Задач в очереди по владельцам (чатам)", ("owner",))
+QUEUE_BUSY_WORKERS = Gauge("queue_busy_workers", "Воркеры очереди, выполняющие задачу")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobCancelledError(Exception):
+    """Задача снята из очереди владельцем до начала выполнения."""
+
+
+@dataclass
+class _Job:
+    owner: Hashable
+    factory: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+class FairJobQueue:
+    """
+    Ограниченная очередь задач пайплайна с честным round-robin между владельцами.
+
+    У каждого владельца (чата) своя FIFO-очередь; воркеры по кругу берут
+    по одной задаче от каждого владельца, поэтому пакет из 20 фото одного
+    продавца не блокирует остальных. Работает в одном event loop.
+    """
+
+    def __init__(self, workers: int, max_length: int):
+        self.workers = max(1, workers)
+        self.max_length = max(1, max_length)
+        self._queues: "OrderedDict[Hashable, Deque[_Job]]" = OrderedDict()
+        self._size = 0
+        self._wakeup: Optional[asyncio.Condition] = None
+        self._tasks: List[asyncio.Task] = []
+        self._active = 0
+
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.wait_seconds_total = 0.0
+        self.service_seconds_total = 0.0
+        self.last_wait_seconds: Optional[float] = None
+        self.last_service_seconds: Optional[float] = None
+
+    @property
+    def depth(self) -> int:
+        return self._size
+
+    @property
+    def idle_workers(self) -> int:
+        return self.workers - self._active
+
+    def start(self) -> None:
+        """Запускает воркеры в текущем event loop."""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Condition()
+        QUEUE_DEPTH.set(self._size)
+        QUEUE_BUSY_WORKERS.set(self._active)
+        self._tasks = [
+            asyncio.create_task(self._worker(index), name=f"pipeline-worker-{index}")
+            for index in range(self.workers)
+        ]
+        logger.info("Очередь пайплайна запущена: воркеров %s, лимит %s", self.workers, self.max_length)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def position(self, owner: Hashable) -> int:
+        """
+        Позиция последней задачи владельца в общей очереди с учетом round-robin
+        (1 — следующая на выполнение).
+        """
+        queue = self._queues.get(owner)
+        if not queue:
+            return 0
+        owners = list(self._queues)
+        owner_index = owners.index(owner)
+        rounds = len(queue)
+        position = 0
+        for index, other in enumerate(owners):
+            # Владельцы до нашего в круге успеют взять rounds задач, после — rounds - 1
+            if index < owner_index:
+                position += min(len(self._queues[other]), rounds)
+            elif index == owner_index:
+                position += rounds
+            else:
+                position += min(len(self._queues[other]), rounds - 1)
+        return position
+
+    async def submit(self, owner: Hashable, factory: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        Ставит задачу в очередь.
+
+        Returns:
+            Future с результатом задачи
+
+        Raises:
+            QueueFullError: Если очередь заполнена
+        """
+        if self._wakeup is None:
+            raise RuntimeError("Очередь не запущена")
+        if self._size >= self.max_length:
+            self.rejected += 1
+            raise QueueFullError(f"Очередь заполнена ({self.max_length})")
+
+        job = _Job(owner=owner, factory=factory, future=asyncio.get_running_loop().create_future())
+        queue = self._queues.setdefault(owner, deque())
+        queue.append(job)
+        self._size += 1
+        QUEUE_DEPTH.set(self._size)
+        QUEUE_OWNER_BACKLOG.set(len(queue), owner=owner)
+        async with self._wakeup:
+            self._wakeup.notify()
+        return job.future
+
+    def cancel(self, owner: Hashable) -> int:
+        """
+        Снимает еще не начатые задачи владельца; их Future получают JobCancelledError.
+
+        Returns:
+            Количество снятых задач
+        """
+        queue = self._queues.pop(owner, None)
+        if not queue:
+            return 0
+        for job in queue:
+            if not job.future.done():
+                job.future.set_exception(JobCancelledError(f"Задача {owner} отменена"))
+        self._size -= len(queue)
+        QUEUE_DEPTH.set(self._size)
+        QUEUE_OWNER_BACKLOG.remove(owner=owner)
+        self.cancelled += len(queue)
+        logger.info("Сняты задачи владельца %s из очереди: %s", owner, len(queue))
+        return len(queue)
+
+    def _next_job(self) -> Optional[_Job]:
+        """Берет задачу у первого владельца и переносит его в конец круга."""
+        while self._queues:
+            owner, queue = next(iter(self._queues.items()))
+            if not queue:
+                self._queues.pop(owner)
+                QUEUE_OWNER_BACKLOG.remove(owner=owner)
+                continue
+            job = queue.popleft()
+            self._size -= 1
+            QUEUE_DEPTH.set(self._size)
+            if queue:
+                self._queues.move_to_end(owner)
+                QUEUE_OWNER_BACKLOG.set(len(queue), owner=owner)
+            else:
+                self._queues.pop(owner)
+                QUEUE_OWNER_BACKLOG.remove(owner=owner)
+            return job
+        return None
+
+    async def _worker(self, index: int) -> None:
+        assert self._wakeup is not None
+        while True:
+            async with self._wakeup:
+                job = self._next_job()
+                while job is None:
+                    await self._wakeup.wait()
+                    job = self._next_job()
+
+            if job.future.cancelled():
+                continue
+
+            started = time.perf_counter()
+            wait_seconds = started - job.enqueued_at
+            QUEUE_WAIT_SECONDS.observe(wait_seconds)
+            self._active += 1
+            QUEUE_BUSY_WORKERS.set(self._active)
+            outcome = "cancelled"
+            try:
+                result = await job.factory()
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as error:  # noqa: BLE001
+                self.failed += 1
+                outcome = "error"
+                if not job.future.done():
+                    job.future.set_exception(error)
+            else:
+                self.completed += 1
+                outcome = "ok"
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._active -= 1
+                QUEUE_BUSY_WORKERS.set(self._active)
+                service_seconds = time.perf_counter() - started
+                QUEUE_SERVICE_SECONDS.observe(service_seconds, outcome=outcome)
+                self.wait_seconds_total += wait_seconds
+                self.service_seconds_total += service_seconds
+                self.last_wait_seconds = round(wait_seconds, 3)
+                self.last_service_seconds = round(service_seconds, 3)
+                logger.info(
+                    "Задача %s выполнена воркером %s: ожидание %.2fs, выполнение %.2fs",
+                    job.owner, index, wait_seconds, service_seconds,
+                )
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "active": self._active,
+            "depth": self._size,
+            "max_length": self.max_length,
+            "owners_waiting": len(self._queues),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+            "avg_wait_seconds": round(self.wait_seconds_total / finished, 3) if finished else None,
+            "avg_service_seconds": round(self.service_seconds_total / finished, 3) if finished else None,
+            "last_wait_seconds": self.last_wait_seconds,
+            "last_service_seconds": self.last_service_seconds,
+        }
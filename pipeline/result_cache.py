@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from utils.image_hash import sha256_hex
+from utils.images import SpooledImage
+from utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+_META_FILE = "meta.json"
+_FINAL_FILE = "final.bin"
+_OVERLAY_FILE = "overlay.png"
+
+
+def make_cache_key(*parts: Any) -> str:
+    """Ключ кэша: sha256 от значимых параметров запуска."""
+    return sha256_hex("|".join(str(part) for part in parts).encode("utf-8"))
+
+
+class ResultCache:
+    """
+    Дисковый LRU-кэш результатов пайплайна с ограничениями по размеру и возрасту.
+
+    Каждая запись — каталог `<root>/<key>/` с итоговым изображением, overlay
+    (если был) и метаданными. Время последнего доступа хранится в mtime
+    файла метаданных, по нему вытесняются самые старые записи.
+    """
+
+    def __init__(self, root: str | Path, max_bytes: int, max_age_seconds: float, enabled: bool = True):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.root / key
+
+    def _is_expired(self, meta_path: Path) -> bool:
+        if self.max_age_seconds <= 0:
+            return False
+        try:
+            created_at = json.loads(meta_path.read_text(encoding="utf-8")).get("created_at", 0)
+        except (OSError, ValueError):
+            return True
+        return time.time() - created_at > self.max_age_seconds
+
+    def get(self, key: str) -> Optional[Tuple[SpooledImage, Optional[bytes], Dict[str, Any]]]:
+        """Возвращает (final, overlay, metadata) или None; final читается с диска во временный буфер."""
+        if not self.enabled:
+            return None
+        entry = self._entry_dir(key)
+        meta_path = entry / _META_FILE
+        with self._lock:
+            try:
+                if not meta_path.exists() or self._is_expired(meta_path):
+                    self.misses += 1
+                    shutil.rmtree(entry, ignore_errors=True)
+                    return None
+                stored = json.loads(meta_path.read_text(encoding="utf-8"))
+                final = SpooledImage.from_path(entry / _FINAL_FILE)
+                overlay_path = entry / _OVERLAY_FILE
+                overlay = overlay_path.read_bytes() if overlay_path.exists() else None
+                # Отмечаем доступ для LRU
+                os.utime(meta_path)
+            except (OSError, ValueError) as error:
+                logger.warning("Повреждённая запись кэша %s, удаляем: %s", key[:12], error)
+                shutil.rmtree(entry, ignore_errors=True)
+                self.misses += 1
+                return None
+            self.hits += 1
+        logger.info("Кэш результатов: попадание %s", key[:12])
+        return final, overlay, stored["metadata"]
+
+    def put(self, key: str, final: SpooledImage, overlay: Optional[bytes], metadata: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        entry = self._entry_dir(key)
+        tmp_entry = self.root / f".{key}.tmp"
+        with self._lock:
+            try:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                tmp_entry.mkdir(parents=True)
+                final.copy_to(tmp_entry / _FINAL_FILE)
+                if overlay is not None:
+                    (tmp_entry / _OVERLAY_FILE).write_bytes(overlay)
+                (tmp_entry / _META_FILE).write_text(
+                    json.dumps({"created_at": time.time(), "metadata": metadata}, ensure_ascii=False),
+                    encoding="utf-8",
+                )
+                shutil.rmtree(entry, ignore_errors=True)
+                tmp_entry.rename(entry)
+            except OSError as error:
+                logger.warning("Не удалось сохранить результат в кэш: %s", error)
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                return
+            self._evict()
+
+    def _evict(self) -> None:
+        """Удаляет просроченные записи, затем самые давно использованные сверх лимита размера."""
+        entries = []
+        for entry in self.root.iterdir():
+            meta_path = entry / _META_FILE
+            if entry.name.startswith(".") or not meta_path.exists():
+                continue
+            if self._is_expired(meta_path):
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            size = sum(path.stat().st_size for path in entry.iterdir())
+            entries.append((meta_path.stat().st_mtime, size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            logger.info("Кэш результатов: вытеснена запись %s", entry.name[:12])
+
+    def clear(self) -> int:
+        """Удаляет все записи. Возвращает количество удаленных записей."""
+        with self._lock:
+            if not self.root.exists():
+                return 0
+            removed = 0
+            for entry in self.root.iterdir():
+                shutil.rmtree(entry, ignore_errors=True)
+                removed += 1
+        logger.info("Кэш результатов очищен: %s записей", removed)
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = [e for e in self.root.iterdir() if not e.name.startswith(".")] if self.root.exists() else []
+            requests = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+            }
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.image_hash import ColorSignature, color_distance, hamming_distance
+from utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class SpecCache:
+    """
+    Кэш спецификаций шапок с поиском ближайшего соседа по перцептивному хешу.
+
+    Фото той же шапки с немного другим кадрированием дают близкие dHash;
+    если расстояние Хэмминга до сохраненного хеша не больше `max_distance`,
+    спецификация переиспользуется без обращения к Claude. dHash считается
+    по яркости, поэтому дополнительно должен совпасть цвет (`color_signature`
+    в пределах `max_color_distance`): иначе та же модель другого цвета
+    получила бы чужую спецификацию. Записи хранятся в JSON-файле, при
+    переполнении вытесняются давно не использованные. Время использования
+    обновляется в памяти и попадает на диск при следующей записи.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        max_distance: int,
+        max_entries: int,
+        max_color_distance: int,
+        enabled: bool = True,
+    ):
+        self.path = Path(path)
+        self.max_distance = max_distance
+        self.max_color_distance = max_color_distance
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: Optional[List[Dict[str, Any]]] = None
+
+    def _load(self) -> List[Dict[str, Any]]:
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                self._entries = []
+            except (OSError, ValueError) as error:
+                logger.warning("Не удалось прочитать кэш спецификаций %s: %s", self.path, error)
+                self._entries = []
+        return self._entries
+
+    def _save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+            tmp_path.replace(self.path)
+        except OSError as error:
+            logger.warning("Не удалось сохранить кэш спецификаций: %s", error)
+
+    def lookup(self, phash: int, color: ColorSignature) -> Optional[Tuple[Dict[str, Any], int]]:
+        """Возвращает (спецификация, расстояние) ближайшей записи того же цвета в пределах порога или None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            best, best_distance = None, self.max_distance + 1
+            for entry in self._load():
+                # Записи без цвета (старый формат) проверить нельзя — пропускаем
+                if "color" not in entry or color_distance(color, entry["color"]) > self.max_color_distance:
+                    continue
+                distance = hamming_distance(phash, int(entry["hash"], 16))
+                if distance < best_distance:
+                    best, best_distance = entry, distance
+
+            if best is None:
+                self.misses += 1
+                logger.info(
+                    "Кэш спецификаций: промах (порог %s, записей %s, hits=%s misses=%s)",
+                    self.max_distance, len(self._entries), self.hits, self.misses,
+                )
+                return None
+
+            self.hits += 1
+            best["last_used"] = time.time()
+        logger.info(
+            "Кэш спецификаций: попадание, расстояние %s (порог %s, hits=%s misses=%s)",
+            best_distance, self.max_distance, self.hits, self.misses,
+        )
+        return best["spec"], best_distance
+
+    def store(self, phash: int, color: ColorSignature, spec: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            entries = self._load()
+            now = time.time()
+            entries.append(
+                {"hash": f"{phash:x}", "color": list(color), "spec": spec, "created_at": now, "last_used": now}
+            )
+            if len(entries) > self.max_entries:
+                entries.sort(key=lambda entry: entry["last_used"], reverse=True)
+                del entries[self.max_entries:]
+            self._save()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._load()),
+                "max_distance": self.max_distance,
+                "max_color_distance": self.max_color_distance,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+            }
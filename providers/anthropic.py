@@ -1,16 +1,33 @@
 import base64
 import json
-from io import BytesIO
-from typing import Dict, Any, Optional
-
-from anthropic import Anthropic, APIConnectionError, APIStatusError
-from PIL import Image
-
+import re
+from typing import Dict, Any, List, Optional, Sequence, Union
+
+import httpx
+from anthropic import (
+    Anthropic,
+    AsyncAnthropic,
+    APIConnectionError,
+    APIStatusError,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    RateLimitError,
+)
 from config import CONFIG
+from providers.cassette import PROVIDER_CASSETTE, cassette_transport
+from utils.aio import PerLoop, Shared
+from utils.image_encoder import encode_to_budget
+from utils.images import ImageHandle, ImageSource
 from utils.logging import get_logger
+from utils.metrics import Histogram
+from utils.rate_limit import RATE_LIMITED_RESPONSES
 
 logger = get_logger(__name__)
 
+REQUEST_SECONDS = Histogram(
+    "anthropic_request_seconds", "Длительность запросов к Claude", ("model", "call", "outcome")
+)
+
 
 def _raise_if_model_missing(api_error: APIStatusError) -> None:
     model_name = CONFIG.providers.anthropic_model
@@ -70,133 +87,355 @@ HEADWEAR_CHECK_PROMPT = (
 )
 
 
-PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
-JPEG_SIGNATURE = b"\xff\xd8"
+HEADWEAR_BATCH_PROMPT = (
+    "Look at each of the {count} portrait photographs below (Image 1 to Image {count}) carefully. "
+    "For EACH image decide: is the woman wearing ANY headwear, head covering, or anything on her head? "
+    "This includes: hat, cap, beanie, hood, helmet, headband, bandana, scarf, headscarf, hijab, turban, "
+    "head wrap, or any fabric/accessory covering any part of the head or hair. "
+    "Answer NO only if absolutely nothing is on the head and the hair is fully visible and uncovered. "
+    "Reply with exactly {count} lines in the form `<image number>: YES` or `<image number>: NO` and nothing else."
+)
+_BATCH_ANSWER = re.compile(r"(\d+)\s*[:.)\-]\s*(YES|NO)\b")
 
+ALBUM_PROMPT = (
+    "The {count} photos show the same hat from different angles. "
+    "Combine the details visible on all of them into one spec."
+)
 
-def _normalize_image_payload(image_bytes: bytes) -> tuple[str, bytes]:
-    """Определяет тип изображения и при необходимости конвертирует в PNG."""
 
-    if image_bytes.startswith(PNG_SIGNATURE):
-        return "image/png", image_bytes
+FALLBACK_SPEC: Dict[str, Any] = {
+    "name": "Вязаная шапка",
+    "description": "Теплая вязаная шапка ручной работы.",
+    "color": "неопределенный",
+    "category": "Другое",
+    "visual": "knitted hat, details unknown",
+}
 
-    if image_bytes.startswith(JPEG_SIGNATURE):
-        return "image/jpeg", image_bytes
+
+def _normalize_image_payload(image: ImageHandle) -> tuple[str, bytes]:
+    """Определяет тип изображения и при необходимости конвертирует в PNG."""
 
     try:
-        image = Image.open(BytesIO(image_bytes))
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        return "image/png", buffer.getvalue()
+        if image.format == "PNG":
+            return "image/png", image.data
+        if image.format == "JPEG":
+            return "image/jpeg", image.data
+        return "image/png", image.png
     except Exception as exc:  # noqa: BLE001
         logger.warning("Не удалось определить тип изображения, отправляем как PNG: %s", exc)
-        return "image/png", image_bytes
+        return "image/png", image.data
+
+
+def _fit_to_budget(image: ImageHandle, max_bytes: int) -> ImageHandle:
+    """
+    Ужимает фото до бюджета байт: JPEG с качеством 70–85, при необходимости
+    с уменьшением. Фото, которые уже укладываются в бюджет, отправляются как есть.
+    """
+    if max_bytes <= 0 or len(image.data) <= max_bytes:
+        return image
+    try:
+        encoded = encode_to_budget(image, max_bytes, min_quality=70, max_quality=85, min_scale=0.05)
+        return ImageHandle(encoded.data)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Не удалось уменьшить фото для Claude, отправляем как есть: %s", exc)
+        return image
+
+
+def _image_block(image: ImageSource, max_bytes: int = 0) -> Dict[str, Any]:
+    media_type, normalized_bytes = _normalize_image_payload(_fit_to_budget(ImageHandle.of(image), max_bytes))
+    image_b64 = base64.b64encode(normalized_bytes).decode('utf-8')
+    return {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_b64}}
+
+
+def _headwear_request(image_bytes: ImageSource) -> Dict[str, Any]:
+    if not image_bytes:
+        raise ValueError("Пустое изображение для проверки")
+
+    return {
+        "model": CONFIG.providers.anthropic_model,
+        "max_tokens": 10,  # Нужен только YES/NO
+        "temperature": 0,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": HEADWEAR_CHECK_PROMPT},
+                    _image_block(image_bytes),
+                ],
+            }
+        ],
+    }
+
+
+def _parse_headwear_response(message: Any) -> Optional[bool]:
+    if not message.content:
+        logger.warning("Пустой ответ Claude при проверке головного убора")
+        return None
+
+    response = (message.content[0].text or "").strip().upper()
+    if response not in ("YES", "NO"):
+        logger.warning("Неверный формат ответа Claude при проверке головного убора: %s", response)
+        return None
+    logger.info(f"Headwear check response: {response}")
+
+    # Если ответ содержит YES - есть головной убор
+    return "YES" in response
+
+
+ImageInput = Union[ImageSource, Sequence[ImageSource]]
+
+
+def _as_image_list(images: ImageInput) -> List[ImageSource]:
+    if isinstance(images, (bytes, bytearray, ImageHandle)):
+        return [images]
+    return list(images)
+
+
+def _headwear_batch_request(images: Sequence[ImageSource]) -> Dict[str, Any]:
+    if not images or not all(images):
+        raise ValueError("Пустое изображение для проверки")
+
+    content: List[Dict[str, Any]] = [{"type": "text", "text": HEADWEAR_BATCH_PROMPT.format(count=len(images))}]
+    for number, image_bytes in enumerate(images, start=1):
+        content.append({"type": "text", "text": f"Image {number}:"})
+        content.append(_image_block(image_bytes))
+    return {
+        "model": CONFIG.providers.anthropic_model,
+        "max_tokens": 8 * len(images) + 10,  # Только строки «N: YES/NO»
+        "temperature": 0,
+        "messages": [{"role": "user", "content": content}],
+    }
+
+
+def _parse_headwear_batch_response(message: Any, count: int) -> List[Optional[bool]]:
+    """Вердикт по каждому изображению; пропущенные в ответе номера — None."""
+    if not message.content:
+        logger.warning("Пустой ответ Claude при пакетной проверке головного убора")
+        return [None] * count
+
+    response = (message.content[0].text or "").upper()
+    verdicts: List[Optional[bool]] = [None] * count
+    for number, answer in _BATCH_ANSWER.findall(response):
+        index = int(number) - 1
+        if 0 <= index < count:
+            verdicts[index] = answer == "YES"
+    if None in verdicts:
+        logger.warning("Ответ Claude на пакетную проверку неполный: %s", response.strip())
+    logger.info("Headwear batch check response: %s", verdicts)
+    return verdicts
+
+
+def _spec_request(images: ImageInput) -> Dict[str, Any]:
+    image_list = _as_image_list(images)
+    if not image_list or not all(image_list):
+        raise ValueError("Пустое изображение для анализа")
+
+    # Альбом уходит одним сообщением; каждое фото ужимается до бюджета, чтобы запрос не рос с числом фото
+    budget = CONFIG.providers.anthropic_image_budget_kb * 1024
+    content: List[Dict[str, Any]] = [{"type": "text", "text": PROMPT}]
+    if len(image_list) > 1:
+        content.append({"type": "text", "text": ALBUM_PROMPT.format(count=len(image_list))})
+    content.extend(_image_block(image, budget) for image in image_list)
+    return {
+        "model": CONFIG.providers.anthropic_model,
+        "max_tokens": 400,
+        "temperature": 0,
+        "system": "Return only valid minified JSON.",
+        "messages": [
+            {
+                "role": "user",
+                "content": content,
+            }
+        ],
+    }
+
+
+def _parse_spec_response(message: Any) -> Dict[str, Any]:
+    content = message.content[0].text if message.content else "{}"
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        logger.warning("Invalid JSON from model, returning fallback")
+        return dict(FALLBACK_SPEC)
+
+
+# Долгоживущие клиенты: соединения (keep-alive) переиспользуются между вызовами.
+# Свой httpx-клиент передаем только для кассеты, иначе остаются настройки SDK по умолчанию.
+_CLIENT: Shared[Anthropic] = Shared(
+    lambda: Anthropic(
+        api_key=CONFIG.providers.anthropic_api_key,
+        base_url=CONFIG.providers.anthropic_base_url or None,
+        http_client=(
+            DefaultHttpxClient(transport=cassette_transport(httpx.HTTPTransport()))
+            if PROVIDER_CASSETTE.enabled
+            else None
+        ),
+    )
+)
+_ASYNC_CLIENT: PerLoop[AsyncAnthropic] = PerLoop(
+    lambda: AsyncAnthropic(
+        api_key=CONFIG.providers.anthropic_api_key,
+        base_url=CONFIG.providers.anthropic_base_url or None,
+        http_client=(
+            DefaultAsyncHttpxClient(transport=cassette_transport(httpx.AsyncHTTPTransport()))
+            if PROVIDER_CASSETTE.enabled
+            else None
+        ),
+    )
+)
 
 
-def check_headwear_present(image_bytes: bytes, client: Anthropic | None = None) -> Optional[bool]:
+def _api_outcome(error: Exception) -> str:
+    if isinstance(error, RateLimitError):
+        RATE_LIMITED_RESPONSES.inc(provider="anthropic")
+        return "rate_limited"
+    return "error"
+
+
+def check_headwear_present(image_bytes: ImageSource, client: Anthropic | None = None) -> Optional[bool]:
     """
     Проверяет наличие головных уборов на изображении через Claude.
 
     Args:
-        image_bytes: Байты изображения для проверки
+        image_bytes: Байты изображения (или ImageHandle) для проверки
         client: Опциональный клиент Anthropic
 
     Returns:
         True если обнаружен головной убор, False если голова чистая, None если проверка не удалась
     """
-    if not image_bytes:
-        raise ValueError("Пустое изображение для проверки")
+    request = _headwear_request(image_bytes)
+    client = client or _CLIENT.get()
 
-    media_type, normalized_bytes = _normalize_image_payload(image_bytes)
-    image_b64 = base64.b64encode(normalized_bytes).decode('utf-8')
-    client = client or Anthropic(api_key=CONFIG.providers.anthropic_api_key)
-
-    try:
-        message = client.messages.create(
-            model=CONFIG.providers.anthropic_model,
-            max_tokens=10,  # Нужен только YES/NO
-            temperature=0,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": HEADWEAR_CHECK_PROMPT},
-                        {
-                            "type": "image",
-                            "source": {"type": "base64", "media_type": media_type, "data": image_b64}
-                        },
-                    ],
-                }
-            ],
-        )
-
-        if not message.content:
-            logger.warning("Пустой ответ Claude при проверке головного убора")
+    with REQUEST_SECONDS.time(model=request["model"], call="headwear") as timer:
+        try:
+            message = client.messages.create(**request)
+            return _parse_headwear_response(message)
+        except (APIConnectionError, APIStatusError) as api_error:
+            timer.outcome = _api_outcome(api_error)
+            if isinstance(api_error, APIStatusError):
+                _raise_if_model_missing(api_error)
+
+            logger.error("Не удалось выполнить проверку головного убора: %s", api_error)
             return None
+        except Exception as unexpected_error:  # noqa: BLE001
+            timer.outcome = "error"
+            logger.error("Неожиданная ошибка проверки головного убора: %s", unexpected_error)
+            return None
+
 
-        response = (message.content[0].text or "").strip().upper()
-        if response not in ("YES", "NO"):
-            logger.warning("Неверный формат ответа Claude при проверке головного убора: %s", response)
+async def acheck_headwear_present(image_bytes: ImageSource, client: AsyncAnthropic | None = None) -> Optional[bool]:
+    """Асинхронный вариант `check_headwear_present` на общем AsyncAnthropic клиенте."""
+    request = _headwear_request(image_bytes)
+    client = client or _ASYNC_CLIENT.get()
+
+    with REQUEST_SECONDS.time(model=request["model"], call="headwear") as timer:
+        try:
+            message = await client.messages.create(**request)
+            return _parse_headwear_response(message)
+        except (APIConnectionError, APIStatusError) as api_error:
+            timer.outcome = _api_outcome(api_error)
+            if isinstance(api_error, APIStatusError):
+                _raise_if_model_missing(api_error)
+
+            logger.error("Не удалось выполнить проверку головного убора: %s", api_error)
+            return None
+        except Exception as unexpected_error:  # noqa: BLE001
+            timer.outcome = "error"
+            logger.error("Неожиданная ошибка проверки головного убора: %s", unexpected_error)
             return None
-        logger.info(f"Headwear check response: {response}")
 
-        # Если ответ содержит YES - есть головной убор
-        return "YES" in response
 
-    except (APIConnectionError, APIStatusError) as api_error:
-        if isinstance(api_error, APIStatusError):
-            _raise_if_model_missing(api_error)
+def check_headwear_batch(images: Sequence[ImageSource], client: Anthropic | None = None) -> List[Optional[bool]]:
+    """
+    Проверяет несколько портретов одним сообщением Claude.
 
-        logger.error("Не удалось выполнить проверку головного убора: %s", api_error)
-        return None
-    except Exception as unexpected_error:  # noqa: BLE001
-        logger.error("Неожиданная ошибка проверки головного убора: %s", unexpected_error)
-        return None
+    Returns:
+        Для каждого изображения True/False/None, как у `check_headwear_present`
+    """
+    if len(images) == 1:
+        return [check_headwear_present(images[0], client)]
+    request = _headwear_batch_request(images)
+    client = client or _CLIENT.get()
 
+    with REQUEST_SECONDS.time(model=request["model"], call="headwear_batch") as timer:
+        try:
+            message = client.messages.create(**request)
+            return _parse_headwear_batch_response(message, len(images))
+        except (APIConnectionError, APIStatusError) as api_error:
+            timer.outcome = _api_outcome(api_error)
+            if isinstance(api_error, APIStatusError):
+                _raise_if_model_missing(api_error)
+
+            logger.error("Не удалось выполнить пакетную проверку головного убора: %s", api_error)
+            return [None] * len(images)
+        except Exception as unexpected_error:  # noqa: BLE001
+            timer.outcome = "error"
+            logger.error("Неожиданная ошибка пакетной проверки головного убора: %s", unexpected_error)
+            return [None] * len(images)
+
+
+async def acheck_headwear_batch(
+    images: Sequence[ImageSource], client: AsyncAnthropic | None = None
+) -> List[Optional[bool]]:
+    """Асинхронный вариант `check_headwear_batch`."""
+    if len(images) == 1:
+        return [await acheck_headwear_present(images[0], client)]
+    request = _headwear_batch_request(images)
+    client = client or _ASYNC_CLIENT.get()
+
+    with REQUEST_SECONDS.time(model=request["model"], call="headwear_batch") as timer:
+        try:
+            message = await client.messages.create(**request)
+            return _parse_headwear_batch_response(message, len(images))
+        except (APIConnectionError, APIStatusError) as api_error:
+            timer.outcome = _api_outcome(api_error)
+            if isinstance(api_error, APIStatusError):
+                _raise_if_model_missing(api_error)
+
+            logger.error("Не удалось выполнить пакетную проверку головного убора: %s", api_error)
+            return [None] * len(images)
+        except Exception as unexpected_error:  # noqa: BLE001
+            timer.outcome = "error"
+            logger.error("Неожиданная ошибка пакетной проверки головного убора: %s", unexpected_error)
+            return [None] * len(images)
+
+
+def extract_product_spec(images: ImageInput, client: Anthropic | None = None) -> Dict[str, Any]:
+    """
+    Извлекает JSON-спецификацию шапки.
 
+    `images` — одно фото или все фото альбома; альбом анализируется одним
+    запросом с несколькими изображениями.
+    """
+    request = _spec_request(images)
+    client = client or _CLIENT.get()
+    with REQUEST_SECONDS.time(model=request["model"], call="spec") as timer:
+        try:
+            message = client.messages.create(**request)
+        except (APIConnectionError, APIStatusError) as api_error:
+            timer.outcome = _api_outcome(api_error)
+            if isinstance(api_error, APIStatusError):
+                _raise_if_model_missing(api_error)
 
-def extract_product_spec(image_bytes: bytes, client: Anthropic | None = None) -> Dict[str, Any]:
-    if not image_bytes:
-        raise ValueError("Пустое изображение для анализа")
+            logger.error("Anthropic API error: %s", api_error)
+            raise
 
-    media_type, normalized_bytes = _normalize_image_payload(image_bytes)
-    image_b64 = base64.b64encode(normalized_bytes).decode('utf-8')
+    return _parse_spec_response(message)
 
-    client = client or Anthropic(api_key=CONFIG.providers.anthropic_api_key)
-    try:
-        message = client.messages.create(
-            model=CONFIG.providers.anthropic_model,
-            max_tokens=400,
-            temperature=0,
-            system="Return only valid minified JSON.",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": PROMPT},
-                        {
-                            "type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_b64}
-                        },
-                    ],
-                }
-            ],
-        )
-    except (APIConnectionError, APIStatusError) as api_error:
-        if isinstance(api_error, APIStatusError):
-            _raise_if_model_missing(api_error)
-
-        logger.error("Anthropic API error: %s", api_error)
-        raise
 
-    content = message.content[0].text if message.content else "{}"
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        logger.warning("Invalid JSON from model, returning fallback")
-        return {
-            "name": "Вязаная шапка",
-            "description": "Теплая вязаная шапка ручной работы.",
-            "color": "неопределенный",
-            "category": "Другое",
-            "visual": "knitted hat, details unknown",
-        }
+async def aextract_product_spec(images: ImageInput, client: AsyncAnthropic | None = None) -> Dict[str, Any]:
+    """Асинхронный вариант `extract_product_spec` на общем AsyncAnthropic клиенте."""
+    request = _spec_request(images)
+    client = client or _ASYNC_CLIENT.get()
+    with REQUEST_SECONDS.time(model=request["model"], call="spec") as timer:
+        try:
+            message = await client.messages.create(**request)
+        except (APIConnectionError, APIStatusError) as api_error:
+            timer.outcome = _api_outcome(api_error)
+            if isinstance(api_error, APIStatusError):
+                _raise_if_model_missing(api_error)
+
+            logger.error("Anthropic API error: %s", api_error)
+            raise
+
+    return _parse_spec_response(message)
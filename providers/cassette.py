@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, TypeVar, Union
+from urllib.parse import parse_qsl, urlencode
+
+import httpx
+
+from config import CONFIG
+from utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+MODES = ("off", "record", "replay")
+# Заголовки ответа, которые httpx пересчитывает сам или которые не имеют смысла при воспроизведении
+_DROPPED_HEADERS = {"content-length", "content-encoding", "transfer-encoding", "connection", "date", "set-cookie"}
+
+TransportT = TypeVar("TransportT", httpx.BaseTransport, httpx.AsyncBaseTransport)
+
+
+class CassetteMissError(RuntimeError):
+    """В режиме replay запрос не найден в кассете."""
+
+
+def _kept_headers(response: httpx.Response) -> List[Tuple[str, str]]:
+    # Тело уже раскодировано read(), поэтому content-encoding и длину отбрасываем
+    return [(name, value) for name, value in response.headers.items() if name.lower() not in _DROPPED_HEADERS]
+
+
+def request_key(request: httpx.Request) -> str:
+    """
+    Нормализованный хеш запроса: метод, путь, отсортированный query и тело.
+
+    Хост не учитывается (кассета, записанная через прокси или заглушки,
+    воспроизводится и на адресах по умолчанию), заголовки тоже — в них
+    ключи API, идентификаторы ретраев и версии SDK. JSON-тело канонизируется.
+    """
+    body = request.content
+    content_type = request.headers.get("content-type", "")
+    if "boundary=" in content_type:
+        # Граница multipart случайна при каждом запросе
+        body = body.replace(content_type.split("boundary=", 1)[1].strip('"').encode("ascii"), b"")
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode("utf-8")
+    except ValueError:
+        pass
+    query = urlencode(sorted(parse_qsl(request.url.query.decode("ascii"), keep_blank_values=True)))
+    digest = hashlib.sha256()
+    for part in (request.method.encode("ascii"), request.url.path.encode("utf-8"), query.encode("ascii"), body):
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class CassetteStore:
+    """
+    Кассета HTTP-взаимодействий с провайдерами на диске.
+
+    `index.json` хранит для каждого ключа запроса последовательность ответов
+    (статус, заголовки, хеш тела, длительность и смещение от первого запроса
+    с этим ключом); тела лежат в `bodies/<sha256>` и дедуплицируются — опросы
+    предсказания и повторяющиеся изображения занимают место один раз.
+
+    При воспроизведении с `time_scale=0` каждый ключ сразу отдает последний
+    записанный ответ (итоговое состояние: предсказание готово, 429 пропущены).
+    С `time_scale>0` ответ выбирается по времени, прошедшему с первого запроса
+    ключа, и задерживается на записанную длительность — так воспроизводятся
+    «processing → succeeded» и реальные задержки, умноженные на масштаб.
+    """
+
+    def __init__(self, root: Union[str, Path], mode: str = "off", time_scale: float = 0.0):
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим кассеты {mode!r}, ожидается один из {MODES}")
+        self.root = Path(root)
+        self.mode = mode
+        self.time_scale = max(0.0, time_scale)
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+        # Начало записи/воспроизведения каждого ключа в текущем процессе
+        self._first_seen: Dict[str, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @property
+    def _index_path(self) -> Path:
+        return self.root / "index.json"
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._index is None:
+            try:
+                self._index = json.loads(self._index_path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                self._index = {}
+            except (OSError, ValueError) as error:
+                logger.warning("Не удалось прочитать кассету %s: %s", self._index_path, error)
+                self._index = {}
+        return self._index
+
+    def _save(self) -> None:
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._index_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(self._index, ensure_ascii=False), encoding="utf-8")
+            tmp_path.replace(self._index_path)
+        except OSError as error:
+            logger.warning("Не удалось сохранить кассету: %s", error)
+
+    def _offset(self, key: str, now: float) -> float:
+        return now - self._first_seen.setdefault(key, now)
+
+    def record(self, key: str, request: httpx.Request, response: httpx.Response, body: bytes, elapsed: float) -> None:
+        digest = hashlib.sha256(body).hexdigest()
+        body_path = self.root / "bodies" / digest
+        with self._lock:
+            if not body_path.exists():
+                body_path.parent.mkdir(parents=True, exist_ok=True)
+                body_path.write_bytes(body)
+            entry = self._load().get(key)
+            fresh = key not in self._first_seen
+            offset = max(0.0, self._offset(key, time.monotonic() - elapsed))
+            if entry is None or fresh:
+                # Новая запись ключа в этом процессе заменяет старую последовательность
+                entry = {"method": request.method, "url": str(request.url.copy_with(query=None)), "responses": []}
+                self._index[key] = entry  # type: ignore[index]
+            entry["responses"].append({
+                "status": response.status_code,
+                "headers": _kept_headers(response),
+                "body": digest,
+                "elapsed": round(elapsed, 3),
+                "at": round(offset, 3),
+            })
+            self.recorded += 1
+            self._save()
+
+    def lookup(self, key: str, request: httpx.Request) -> Tuple[Dict[str, Any], bytes]:
+        """Записанный ответ для запроса; CassetteMissError, если его нет."""
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is None:
+                self.misses += 1
+                raise CassetteMissError(f"Нет записи для {request.method} {request.url} в кассете {self.root}")
+            responses: List[Dict[str, Any]] = entry["responses"]
+            if self.time_scale == 0:
+                chosen = responses[-1]
+            else:
+                offset = self._offset(key, time.monotonic()) / self.time_scale
+                chosen = [item for item in responses if item["at"] <= offset][-1]
+            self.replayed += 1
+        return chosen, (self.root / "bodies" / chosen["body"]).read_bytes()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "requests": len(self._load()) if self.enabled else 0,
+                "recorded": self.recorded,
+                "replayed": self.replayed,
+                "misses": self.misses,
+            }
+
+
+def _replayed_response(recorded: Dict[str, Any], body: bytes, request: httpx.Request) -> httpx.Response:
+    return httpx.Response(recorded["status"], headers=recorded["headers"], content=body, request=request)
+
+
+class CassetteTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """
+    httpx транспорт, который записывает ответы в кассету (record) или
+    отдает их из кассеты без сети (replay). Подставляется внутрь клиентов SDK,
+    поэтому код провайдеров не знает о кассете.
+    """
+
+    def __init__(self, store: CassetteStore, wrapped: Union[httpx.BaseTransport, httpx.AsyncBaseTransport]):
+        self.store = store
+        self._wrapped = wrapped
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        # Потоковое тело (multipart загрузки файлов) нужно прочитать до хеширования
+        request.read()
+        key = request_key(request)
+        if self.store.mode == "replay":
+            recorded, body = self.store.lookup(key, request)
+            if self.store.time_scale:
+                time.sleep(recorded["elapsed"] * self.store.time_scale)
+            return _replayed_response(recorded, body, request)
+
+        started = time.monotonic()
+        response = self._wrapped.handle_request(request)  # type: ignore[union-attr]
+        body = response.read()
+        response.close()
+        self.store.record(key, request, response, body, time.monotonic() - started)
+        return _replayed_response({"status": response.status_code, "headers": _kept_headers(response)}, body, request)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        key = request_key(request)
+        if self.store.mode == "replay":
+            recorded, body = await asyncio.to_thread(self.store.lookup, key, request)
+            if self.store.time_scale:
+                await asyncio.sleep(recorded["elapsed"] * self.store.time_scale)
+            return _replayed_response(recorded, body, request)
+
+        started = time.monotonic()
+        response = await self._wrapped.handle_async_request(request)  # type: ignore[union-attr]
+        body = await response.aread()
+        await response.aclose()
+        elapsed = time.monotonic() - started
+        await asyncio.to_thread(self.store.record, key, request, response, body, elapsed)
+        return _replayed_response({"status": response.status_code, "headers": _kept_headers(response)}, body, request)
+
+    def close(self) -> None:
+        self._wrapped.close()  # type: ignore[union-attr]
+
+    async def aclose(self) -> None:
+        await self._wrapped.aclose()  # type: ignore[union-attr]
+
+
+# Одна кассета на процесс для всех провайдеров (Anthropic, Replicate, загрузка результатов)
+PROVIDER_CASSETTE = CassetteStore(
+    CONFIG.providers.cassette_dir,
+    mode=CONFIG.providers.cassette_mode,
+    time_scale=CONFIG.providers.cassette_time_scale,
+)
+
+
+def cassette_transport(transport: TransportT) -> TransportT:
+    """Оборачивает транспорт кассетой, если PROVIDER_CASSETTE включен; иначе возвращает как есть."""
+    if not PROVIDER_CASSETTE.enabled:
+        return transport
+    return CassetteTransport(PROVIDER_CASSETTE, transport)  # type: ignore[return-value]
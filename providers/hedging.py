@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+
+class HedgePolicy:
+    """
+    Когда запускать дубликат медленного предсказания.
+
+    По каждой модели хранится окно последних длительностей завершенных
+    предсказаний; порог хеджирования — заданный перцентиль окна. Пока
+    замеров меньше `min_samples`, хеджирования нет. Дубликаты стоят денег,
+    поэтому их число ограничено `max_per_hour` в скользящем часовом окне.
+    """
+
+    WINDOW = 100
+
+    def __init__(self, percentile: float, min_samples: int, max_per_hour: int):
+        self.percentile = percentile
+        self.min_samples = max(1, min_samples)
+        self.max_per_hour = max(0, max_per_hour)
+        self._latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.WINDOW))
+        self._launched: Deque[float] = deque()
+        self._lock = threading.Lock()
+        self.predictions = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.denied_by_budget = 0
+        self.saved_seconds_total = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return 0 < self.percentile < 100 and self.max_per_hour > 0
+
+    def record(self, model: str, seconds: float) -> None:
+        """Длительность завершенного (не отмененного) предсказания."""
+        with self._lock:
+            self._latencies[model].append(seconds)
+
+    def threshold(self, model: str) -> Optional[float]:
+        """Через сколько секунд запускать дубликат или None (выключено, мало замеров)."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies[model])
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, math.ceil(self.percentile / 100 * len(samples)) - 1)
+        return samples[max(0, index)]
+
+    def expected_latency(self, model: str, elapsed: float) -> float:
+        """Оценка полной длительности предсказания, которое уже идет `elapsed` секунд."""
+        with self._lock:
+            slower = [seconds for seconds in self._latencies[model] if seconds > elapsed]
+        return sum(slower) / len(slower) if slower else elapsed
+
+    def try_acquire(self) -> bool:
+        """Резервирует дубликат в часовом бюджете."""
+        now = time.monotonic()
+        with self._lock:
+            while self._launched and now - self._launched[0] > 3600:
+                self._launched.popleft()
+            if len(self._launched) >= self.max_per_hour:
+                self.denied_by_budget += 1
+                return False
+            self._launched.append(now)
+            return True
+
+    def observe(self, hedged: bool, hedge_won: bool, saved_seconds: float) -> None:
+        with self._lock:
+            self.predictions += 1
+            self.hedged += int(hedged)
+            self.hedge_wins += int(hedge_won)
+            self.saved_seconds_total += saved_seconds
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "percentile": self.percentile,
+                "predictions": self.predictions,
+                "hedged": self.hedged,
+                "hedge_rate": round(self.hedged / self.predictions, 3) if self.predictions else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "saved_seconds_total": round(self.saved_seconds_total, 1),
+                "denied_by_budget": self.denied_by_budget,
+                "budget_left_this_hour": max(0, self.max_per_hour - len(self._launched)),
+            }
+
+
+@dataclass
+class HedgeReport:
+    """Хеджирование предсказаний одной задачи пайплайна — для metadata."""
+
+    entries: List[Dict[str, Any]] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self.entries.append(entry)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = list(self.entries)
+        hedged = [entry for entry in entries if entry["hedged"]]
+        return {
+            "predictions": len(entries),
+            "hedged": len(hedged),
+            "hedge_rate": round(len(hedged) / len(entries), 3) if entries else 0.0,
+            "hedge_wins": sum(1 for entry in hedged if entry["winner"] == "hedge"),
+            "saved_seconds_est": round(sum(entry["saved_seconds_est"] for entry in entries), 2),
+            "details": hedged,
+        }
+
+
+_REPORT: ContextVar[Optional[HedgeReport]] = ContextVar("replicate_hedge_report", default=None)
+
+
+@contextmanager
+def hedge_report() -> Iterator[HedgeReport]:
+    """Собирает хеджирование предсказаний, запущенных внутри блока (включая стадии в потоках и задачах)."""
+    report = HedgeReport()
+    token = _REPORT.set(report)
+    try:
+        yield report
+    finally:
+        _REPORT.reset(token)
+
+
+def report_prediction(entry: Dict[str, Any]) -> None:
+    report = _REPORT.get()
+    if report is not None:
+        report.add(entry)
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class PredictionStore:
+    """
+    Журнал незавершенных предсказаний Replicate на диске.
+
+    Ключ — хеш задачи, модели и входных данных; значение — ID предсказания.
+    Если процесс перезапустился, повторный запуск той же задачи находит
+    запись и продолжает опрос уже оплаченного предсказания вместо нового.
+    Запись удаляется, когда предсказание завершилось и результат забран.
+    Replicate хранит результаты API-предсказаний около часа, поэтому более
+    старые записи отбрасываются.
+
+    Возобновление срабатывает, только если ту же задачу отправили снова.
+    Записи, оставшиеся с прошлого запуска и не востребованные за время
+    ожидания, разбирает `asweep_orphaned_predictions`: запущенные
+    предсказания отменяются, записи удаляются.
+    """
+
+    MAX_AGE_SECONDS = 3600
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.resumed = 0
+        self.orphans_canceled = 0
+        self._claimed: set[str] = set()
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._entries is None:
+            try:
+                entries = json.loads(self.path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                entries = {}
+            except (OSError, ValueError) as error:
+                logger.warning("Не удалось прочитать журнал предсказаний %s: %s", self.path, error)
+                entries = {}
+            cutoff = time.time() - self.MAX_AGE_SECONDS
+            self._entries = {key: entry for key, entry in entries.items() if entry["created_at"] >= cutoff}
+        return self._entries
+
+    def _save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+            tmp_path.replace(self.path)
+        except OSError as error:
+            logger.warning("Не удалось сохранить журнал предсказаний: %s", error)
+
+    def get(self, key: str) -> Optional[str]:
+        """ID незавершенного предсказания для ключа или None."""
+        with self._lock:
+            entry = self._load().get(key)
+            return entry["id"] if entry else None
+
+    def mark_resumed(self, key: str) -> None:
+        with self._lock:
+            self.resumed += 1
+            self._claimed.add(key)
+
+    def pending(self) -> Dict[str, Dict[str, Any]]:
+        """Снимок записей журнала (ключ → запись)."""
+        with self._lock:
+            return {key: dict(entry) for key, entry in self._load().items()}
+
+    def is_orphan(self, key: str, prediction_id: str) -> bool:
+        """Запись все еще в журнале с тем же ID и ее задачу никто не возобновил."""
+        with self._lock:
+            entry = self._load().get(key)
+            return key not in self._claimed and entry is not None and entry["id"] == prediction_id
+
+    def drop_orphan(self, key: str, prediction_id: str, canceled: bool) -> None:
+        with self._lock:
+            entry = self._load().get(key)
+            if key in self._claimed or entry is None or entry["id"] != prediction_id:
+                return
+            del self._entries[key]
+            self.orphans_canceled += canceled
+            self._save()
+
+    def put(self, key: str, prediction_id: str, model: str) -> None:
+        with self._lock:
+            self._load()[key] = {"id": prediction_id, "model": model, "created_at": time.time()}
+            self._save()
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            if self._load().pop(key, None) is not None:
+                self._save()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"pending": len(self._load()), "resumed": self.resumed, "orphans_canceled": self.orphans_canceled}
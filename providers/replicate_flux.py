@@ -1,17 +1,210 @@
+import asyncio
 import base64
+import json
+import threading
 import time
-import requests
-from typing import Dict, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Set, Tuple
 
 import httpx
 import replicate
-from replicate.exceptions import ReplicateError
+from replicate.exceptions import ModelError, ReplicateError
+from replicate.prediction import Prediction
 
 from config import CONFIG
+from providers.cassette import cassette_transport
+from providers.hedging import HedgePolicy, report_prediction
+from providers.prediction_store import PredictionStore
+from utils.aio import PerLoop, Shared
+from utils.http import adownload_to_spool, async_http_client, download_to_spool, http_client
+from utils.image_hash import sha256_hex
+from utils.images import ImageHandle, ImageSource, SpooledImage
 from utils.logging import get_logger
+from utils.metrics import Counter, Histogram
+from utils.rate_limit import AdaptiveRateLimiter, RateLimitTransport
 
 logger = get_logger(__name__)
 
+# Retry logic для обработки rate limiting (429 errors) и timeouts
+MAX_RETRIES = 5  # Увеличено до 5 попыток из-за rate limiting
+TIMEOUT_RETRY_SECONDS = 10
+MAX_OUTPUTS = 4
+# Загруженные через files API изображения переиспользуются (ретраи, дубликаты, повторные задачи)
+# не дольше часа: файлы Replicate живут ограниченное время
+UPLOAD_TTL_SECONDS = 3600
+MAX_CACHED_UPLOADS = 256
+
+# Все вызовы Replicate (sync и async) проходят через один лимитер на процесс:
+# после 429 ожидание происходит в очереди лимитера, а не в слепых sleep
+REPLICATE_LIMITER = AdaptiveRateLimiter(
+    rate_per_minute=CONFIG.providers.replicate_rate_per_minute,
+    min_rate_per_minute=CONFIG.providers.replicate_min_rate_per_minute,
+    max_rate_per_minute=CONFIG.providers.replicate_max_rate_per_minute,
+    burst=CONFIG.providers.replicate_burst,
+    name="replicate",
+)
+
+# Долгоживущие клиенты: соединения (keep-alive) переиспользуются между вызовами.
+# Асинхронный httpx-клиент внутри replicate.Client привязан к event loop, поэтому
+# для async вызовов держим отдельный клиент на каждый цикл.
+_CLIENT: Shared[replicate.Client] = Shared(
+    lambda: replicate.Client(
+        api_token=CONFIG.providers.replicate_api_token,
+        base_url=CONFIG.providers.replicate_base_url or None,
+        transport=RateLimitTransport(REPLICATE_LIMITER, cassette_transport(httpx.HTTPTransport())),
+    )
+)
+_ASYNC_CLIENT: PerLoop[replicate.Client] = PerLoop(
+    lambda: replicate.Client(
+        api_token=CONFIG.providers.replicate_api_token,
+        base_url=CONFIG.providers.replicate_base_url or None,
+        transport=RateLimitTransport(REPLICATE_LIMITER, cassette_transport(httpx.AsyncHTTPTransport())),
+    )
+)
+
+PREDICTION_SECONDS = Histogram(
+    "replicate_prediction_seconds",
+    "Время от создания (или возобновления) предсказания до завершения",
+    ("model", "outcome"),
+)
+CREATE_RETRIES = Counter(
+    "replicate_create_retries_total", "Повторные попытки создать предсказание", ("model", "reason")
+)
+DOWNLOAD_SECONDS = Histogram("replicate_download_seconds", "Скачивание результата FLUX", ("outcome",))
+UPLOAD_BYTES = Counter("replicate_upload_bytes_total", "Байты изображений, загруженных в files API", ("outcome",))
+HEDGES = Counter(
+    "replicate_hedges_total", "Дубликаты медленных предсказаний по победителю гонки", ("model", "winner")
+)
+
+# Хеджирование хвостовых задержек (холодные старты, очередь Replicate): общий на процесс
+# порог по недавним длительностям и часовой бюджет дубликатов
+HEDGING = HedgePolicy(
+    percentile=CONFIG.providers.replicate_hedge_percentile,
+    min_samples=CONFIG.providers.replicate_hedge_min_samples,
+    max_per_hour=CONFIG.providers.replicate_hedge_max_per_hour,
+)
+
+# Предсказания создаются без ожидания и опрашиваются; незавершенные записываются
+# в журнал на диске, чтобы после перезапуска продолжить опрос, а не платить заново
+PREDICTION_STORE = PredictionStore(CONFIG.providers.replicate_predictions_path)
+_TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+# Контекст вызова: владелец (чат) — для /cancel, ключ задачи — для возобновления
+_OWNER: ContextVar[Optional[Hashable]] = ContextVar("replicate_prediction_owner", default=None)
+_JOB: ContextVar[Optional[str]] = ContextVar("replicate_prediction_job", default=None)
+# Предсказание могут ждать задачи разных чатов (одинаковое фото дает тот же
+# ключ журнала): по одной записи владельца на каждую ожидающую задачу
+_IN_FLIGHT: Dict[str, List[Optional[Hashable]]] = {}
+# Владельцы, отменившие общее предсказание: их задачи перестают его ждать
+_DETACHED: Dict[str, Set[Hashable]] = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+
+
+class PredictionCanceledError(RuntimeError):
+    """Предсказание отменено (командой /cancel или на стороне Replicate)."""
+
+
+@contextmanager
+def prediction_owner(owner: Hashable) -> Iterator[None]:
+    """Привязывает предсказания, созданные внутри блока, к владельцу (чату) для `cancel_predictions`."""
+    token = _OWNER.set(owner)
+    try:
+        yield
+    finally:
+        _OWNER.reset(token)
+
+
+@contextmanager
+def prediction_job(job_key: str) -> Iterator[None]:
+    """Предсказания внутри блока записываются в журнал под ключом задачи и возобновляются после перезапуска."""
+    token = _JOB.set(job_key)
+    try:
+        yield
+    finally:
+        _JOB.reset(token)
+
+
+@dataclass(frozen=True)
+class _ImageUpload:
+    """
+    Изображение во входе модели. Перед созданием предсказания загружается
+    через files API Replicate (multipart), во вход подставляется ссылка на файл;
+    в ключе журнала участвует хеш содержимого, а не ссылка.
+    """
+
+    data: bytes = field(repr=False)
+    filename: str
+    digest: str
+
+    @classmethod
+    def png(cls, image: ImageHandle, name: str) -> "_ImageUpload":
+        data = image.png
+        # PNG-исходник уже захеширован ручкой
+        digest = image.sha256 if data is image.data else sha256_hex(data)
+        return cls(data=data, filename=f"{name}.png", digest=digest)
+
+
+_UPLOADS: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_UPLOADS_LOCK = threading.Lock()
+
+
+def _cached_upload(digest: str) -> Optional[str]:
+    with _UPLOADS_LOCK:
+        entry = _UPLOADS.get(digest)
+        if entry is None or time.monotonic() - entry[1] > UPLOAD_TTL_SECONDS:
+            _UPLOADS.pop(digest, None)
+            return None
+        return entry[0]
+
+
+def _remember_upload(digest: str, url: str) -> None:
+    with _UPLOADS_LOCK:
+        _UPLOADS[digest] = (url, time.monotonic())
+        while len(_UPLOADS) > MAX_CACHED_UPLOADS:
+            _UPLOADS.popitem(last=False)
+
+
+def _upload(client: replicate.Client, upload: _ImageUpload) -> str:
+    url = _cached_upload(upload.digest)
+    if url is not None:
+        UPLOAD_BYTES.inc(len(upload.data), outcome="reused")
+        return url
+    # BytesIO не копирует байты, httpx отправляет multipart потоком
+    uploaded = client.files.create(BytesIO(upload.data), filename=upload.filename, content_type="image/png")
+    UPLOAD_BYTES.inc(len(upload.data), outcome="uploaded")
+    _remember_upload(upload.digest, uploaded.urls["get"])
+    return uploaded.urls["get"]
+
+
+async def _aupload(client: replicate.Client, upload: _ImageUpload) -> str:
+    url = _cached_upload(upload.digest)
+    if url is not None:
+        UPLOAD_BYTES.inc(len(upload.data), outcome="reused")
+        return url
+    uploaded = await client.files.async_create(
+        BytesIO(upload.data), filename=upload.filename, content_type="image/png"
+    )
+    UPLOAD_BYTES.inc(len(upload.data), outcome="uploaded")
+    _remember_upload(upload.digest, uploaded.urls["get"])
+    return uploaded.urls["get"]
+
+
+def _resolve_uploads(client: replicate.Client, input_payload: Dict[str, object]) -> Dict[str, object]:
+    return {
+        name: _upload(client, value) if isinstance(value, _ImageUpload) else value
+        for name, value in input_payload.items()
+    }
+
+
+async def _aresolve_uploads(client: replicate.Client, input_payload: Dict[str, object]) -> Dict[str, object]:
+    names = [name for name, value in input_payload.items() if isinstance(value, _ImageUpload)]
+    urls = await asyncio.gather(*(_aupload(client, input_payload[name]) for name in names))  # type: ignore[arg-type]
+    return {**input_payload, **dict(zip(names, urls))}
+
 
 def _clamp_steps_for_model(model: str, steps: int) -> int:
     if "flux-schnell" in model and steps > 4:
@@ -23,93 +216,635 @@ def _clamp_steps_for_model(model: str, steps: int) -> int:
 
 
 def _fetch_image(url: str) -> bytes:
-    response = requests.get(url, timeout=60)
+    response = http_client().get(url)
     response.raise_for_status()
     return response.content
 
 
-def generate_base_model_image(
-    prompt: str, width: int, height: int, steps: int, model: Optional[str] = None
-) -> bytes:
-    client = replicate.Client(api_token=CONFIG.providers.replicate_api_token)
-    base_model = model or CONFIG.providers.flux_base_model
-    steps = _clamp_steps_for_model(base_model, steps)
+async def _afetch_image(url: str) -> bytes:
+    response = await async_http_client().get(url)
+    response.raise_for_status()
+    return response.content
+
+
+def _output_urls(output: Any) -> List[str]:
+    return [str(item) for item in output] if isinstance(output, list) else [str(output)]
+
+
+def _fetch_images(urls: List[str]) -> List[bytes]:
+    with DOWNLOAD_SECONDS.time():
+        if len(urls) == 1:
+            return [_fetch_image(urls[0])]
+        with ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="replicate-download") as pool:
+            return list(pool.map(_fetch_image, urls))
+
+
+async def _afetch_images(urls: List[str]) -> List[bytes]:
+    with DOWNLOAD_SECONDS.time():
+        return list(await asyncio.gather(*(_afetch_image(url) for url in urls)))
+
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Пауза перед следующей попыткой или None, если ошибку нужно пробросить."""
+    if attempt >= MAX_RETRIES - 1:
+        return None
+    if isinstance(error, ReplicateError):
+        if error.status != 429:
+            return None
+        # Лимитер уже снизил скорость и учел Retry-After: ждем в его очереди
+        logger.warning(f"Rate limit достигнут, попытка {attempt + 2}/{MAX_RETRIES} после ожидания в лимитере")
+        return 0.0
+    logger.warning(
+        f"Timeout error, повторная попытка {attempt + 2}/{MAX_RETRIES} через {TIMEOUT_RETRY_SECONDS}s"
+    )
+    return TIMEOUT_RETRY_SECONDS
+
+
+def _prediction_key(model: str, input_payload: Dict[str, object]) -> Optional[str]:
+    """Ключ для журнала предсказаний; None вне задачи пайплайна (скрипты, пул)."""
+    job_key = _JOB.get()
+    if job_key is None:
+        return None
+    serialized = json.dumps(
+        [job_key, model, input_payload],
+        sort_keys=True,
+        default=lambda value: value.digest if isinstance(value, _ImageUpload) else str(value),
+    )
+    return sha256_hex(serialized.encode("utf-8"))
+
+
+def _track(prediction: Prediction) -> None:
+    owner = _OWNER.get()
+    with _IN_FLIGHT_LOCK:
+        _IN_FLIGHT.setdefault(prediction.id, []).append(owner)
+        _DETACHED.get(prediction.id, set()).discard(owner)
+
+
+def _untrack(prediction: Prediction) -> None:
+    owner = _OWNER.get()
+    with _IN_FLIGHT_LOCK:
+        owners = _IN_FLIGHT.get(prediction.id)
+        if owners is None:
+            return
+        if owner in owners:
+            owners.remove(owner)
+        if not owners:
+            del _IN_FLIGHT[prediction.id]
+            _DETACHED.pop(prediction.id, None)
+
+
+def _raise_if_detached(race: "_Race") -> None:
+    """Владелец задачи отменил общее с другими чатами предсказание — эта задача его больше не ждет."""
+    owner = _OWNER.get()
+    if owner is None:
+        return
+    with _IN_FLIGHT_LOCK:
+        detached = any(owner in _DETACHED.get(prediction.id, ()) for prediction in race.predictions)
+    if detached:
+        raise PredictionCanceledError(f"Предсказание {race.primary.id} отменено для {owner}, его ждут другие задачи")
+
+
+def _can_resume(prediction: Optional[Prediction]) -> bool:
+    return prediction is not None and prediction.status in ("starting", "processing", "succeeded")
+
+
+def _prediction_output(prediction: Prediction) -> Any:
+    if prediction.status == "failed":
+        raise ModelError(prediction)
+    if prediction.status == "canceled":
+        raise PredictionCanceledError(f"Предсказание {prediction.id} отменено")
+    return prediction.output
+
+
+def _create_prediction(client: replicate.Client, model: str, input_payload: Dict[str, object]) -> Prediction:
+    input_payload = _resolve_uploads(client, input_payload)
+    if ":" in model:
+        return client.predictions.create(version=model.split(":", 1)[1], input=input_payload)
+    return client.models.predictions.create(model=model, input=input_payload)
+
+
+async def _acreate_prediction(
+    client: replicate.Client, model: str, input_payload: Dict[str, object]
+) -> Prediction:
+    input_payload = await _aresolve_uploads(client, input_payload)
+    if ":" in model:
+        return await client.predictions.async_create(version=model.split(":", 1)[1], input=input_payload)
+    return await client.models.predictions.async_create(model=model, input=input_payload)
+
+
+def _start_prediction(
+    client: replicate.Client, model: str, input_payload: Dict[str, object], key: Optional[str]
+) -> Prediction:
+    """Возобновляет сохраненное предсказание задачи или создает новое (с ретраями)."""
+    prediction_id = PREDICTION_STORE.get(key) if key else None
+    if prediction_id:
+        try:
+            prediction = client.predictions.get(prediction_id)
+        except (ReplicateError, httpx.TransportError) as error:
+            logger.warning("Не удалось получить сохраненное предсказание %s: %s", prediction_id, error)
+            prediction = None
+        if _can_resume(prediction):
+            PREDICTION_STORE.mark_resumed(key)
+            logger.info("Возобновляем опрос предсказания %s (%s)", prediction.id, prediction.status)
+            return prediction
+        PREDICTION_STORE.remove(key)
+
+    for attempt in range(MAX_RETRIES):
+        REPLICATE_LIMITER.acquire()
+        try:
+            prediction = _create_prediction(client, model, input_payload)
+            break
+        except (ReplicateError, httpx.ReadTimeout, httpx.ConnectTimeout) as error:
+            delay = _retry_delay(error, attempt)
+            if delay is None:
+                logger.error(f"Replicate API error после {attempt + 1} попыток: %s", error)
+                raise
+            CREATE_RETRIES.inc(model=model, reason="rate_limited" if delay == 0 else "timeout")
+            if delay:
+                time.sleep(delay)
+
+    if key:
+        PREDICTION_STORE.put(key, prediction.id, model)
+    logger.info("Создано предсказание %s для %s", prediction.id, model)
+    return prediction
+
+
+async def _astart_prediction(
+    client: replicate.Client, model: str, input_payload: Dict[str, object], key: Optional[str]
+) -> Prediction:
+    """Асинхронный вариант `_start_prediction`."""
+    prediction_id = PREDICTION_STORE.get(key) if key else None
+    if prediction_id:
+        try:
+            prediction = await client.predictions.async_get(prediction_id)
+        except (ReplicateError, httpx.TransportError) as error:
+            logger.warning("Не удалось получить сохраненное предсказание %s: %s", prediction_id, error)
+            prediction = None
+        if _can_resume(prediction):
+            PREDICTION_STORE.mark_resumed(key)
+            logger.info("Возобновляем опрос предсказания %s (%s)", prediction.id, prediction.status)
+            return prediction
+        PREDICTION_STORE.remove(key)
+
+    for attempt in range(MAX_RETRIES):
+        await REPLICATE_LIMITER.aacquire()
+        try:
+            prediction = await _acreate_prediction(client, model, input_payload)
+            break
+        except (ReplicateError, httpx.ReadTimeout, httpx.ConnectTimeout) as error:
+            delay = _retry_delay(error, attempt)
+            if delay is None:
+                logger.error(f"Replicate API error после {attempt + 1} попыток: %s", error)
+                raise
+            CREATE_RETRIES.inc(model=model, reason="rate_limited" if delay == 0 else "timeout")
+            if delay:
+                await asyncio.sleep(delay)
+
+    if key:
+        PREDICTION_STORE.put(key, prediction.id, model)
+    logger.info("Создано предсказание %s для %s", prediction.id, model)
+    return prediction
+
+
+class _Race:
+    """
+    Основное предсказание и, если оно задержалось дольше порога `HEDGING`,
+    его дубликат с тем же входом. Побеждает первое успешное; ошибкой
+    гонка заканчивается, только когда завершились оба.
+    """
+
+    def __init__(self, model: str, primary: Prediction):
+        self.model = model
+        self.primary = primary
+        self.hedge: Optional[Prediction] = None
+        self.started = time.monotonic()
+        self.hedge_started = 0.0
+        self.hedge_after = HEDGING.threshold(model)
+
+    @property
+    def predictions(self) -> List[Prediction]:
+        return [self.primary] if self.hedge is None else [self.primary, self.hedge]
+
+    def running(self) -> List[Prediction]:
+        return [prediction for prediction in self.predictions if prediction.status not in _TERMINAL_STATUSES]
+
+    def winner(self) -> Optional[Prediction]:
+        for prediction in self.predictions:
+            if prediction.status == "succeeded":
+                return prediction
+        return None if self.running() else self.primary
+
+    def should_hedge(self) -> bool:
+        if self.hedge_after is None or self.hedge is not None:
+            return False
+        if time.monotonic() - self.started < self.hedge_after:
+            return False
+        if not HEDGING.try_acquire():
+            logger.info("Бюджет дубликатов на час исчерпан, предсказание %s ждем без хеджирования", self.primary.id)
+            self.hedge_after = None
+            return False
+        return True
+
+    def add_hedge(self, prediction: Optional[Prediction]) -> None:
+        self.hedge_after = None
+        if prediction is None:
+            return
+        self.hedge = prediction
+        self.hedge_started = time.monotonic()
+        _track(prediction)
+        logger.info(
+            "Предсказание %s идет дольше %.1fs, запущен дубликат %s",
+            self.primary.id, self.hedge_started - self.started, prediction.id,
+        )
+
+    def finish(self, winner: Prediction) -> None:
+        """Учитывает длительность победителя в пороге и пишет итог гонки в метрики и отчет задачи."""
+        now = time.monotonic()
+        elapsed = now - self.started
+        hedge_won = winner is self.hedge and winner.status == "succeeded"
+        if winner.status == "succeeded":
+            HEDGING.record(self.model, now - (self.hedge_started if hedge_won else self.started))
+        # Проигравшее основное предсказание отменено, поэтому экономия — оценка:
+        # средняя длительность недавних предсказаний, которые шли дольше него
+        saved = max(0.0, HEDGING.expected_latency(self.model, elapsed) - elapsed) if hedge_won else 0.0
+        HEDGING.observe(self.hedge is not None, hedge_won, saved)
+        if self.hedge is not None:
+            HEDGES.inc(model=self.model, winner="hedge" if hedge_won else "primary")
+        report_prediction({
+            "model": self.model,
+            "hedged": self.hedge is not None,
+            "winner": "hedge" if hedge_won else "primary",
+            "hedge_after": round(self.hedge_started - self.started, 2) if self.hedge is not None else None,
+            "seconds": round(elapsed, 2),
+            "saved_seconds_est": round(saved, 2),
+        })
+
+
+def _launch_hedge(client: replicate.Client, model: str, input_payload: Dict[str, object]) -> Optional[Prediction]:
+    # Дубликат не пишется в журнал: после перезапуска возобновляется только основное предсказание
+    REPLICATE_LIMITER.acquire()
+    try:
+        return _create_prediction(client, model, input_payload)
+    except (ReplicateError, httpx.TransportError) as error:
+        logger.warning("Не удалось запустить дубликат предсказания для %s: %s", model, error)
+        return None
+
+
+async def _alaunch_hedge(
+    client: replicate.Client, model: str, input_payload: Dict[str, object]
+) -> Optional[Prediction]:
+    await REPLICATE_LIMITER.aacquire()
+    try:
+        return await _acreate_prediction(client, model, input_payload)
+    except (ReplicateError, httpx.TransportError) as error:
+        logger.warning("Не удалось запустить дубликат предсказания для %s: %s", model, error)
+        return None
+
+
+def _cancel_quietly(prediction: Prediction) -> None:
+    try:
+        prediction.cancel()
+    except (ReplicateError, httpx.TransportError) as error:
+        logger.warning("Не удалось отменить предсказание %s: %s", prediction.id, error)
+
+
+async def _acancel_quietly(prediction: Prediction) -> None:
+    try:
+        await prediction.async_cancel()
+    except (ReplicateError, httpx.TransportError) as error:
+        logger.warning("Не удалось отменить предсказание %s: %s", prediction.id, error)
+
+
+def _wait_for_prediction(client: replicate.Client, race: _Race, input_payload: Dict[str, object]) -> Prediction:
+    """
+    Опрашивает предсказания гонки до первого успеха (или завершения всех)
+    и отменяет проигравшее; по истечении дедлайна отменяет все.
+    """
+    timeout = CONFIG.providers.replicate_prediction_timeout
+    deadline = race.started + timeout
+    while (winner := race.winner()) is None:
+        _raise_if_detached(race)
+        if time.monotonic() > deadline:
+            for prediction in race.running():
+                _cancel_quietly(prediction)
+            raise TimeoutError(f"Предсказание {race.primary.id} не завершилось за {timeout}s, отменено")
+        if race.should_hedge():
+            race.add_hedge(_launch_hedge(client, race.model, input_payload))
+        time.sleep(CONFIG.providers.replicate_poll_interval)
+        for prediction in race.running():
+            try:
+                prediction.reload()
+            except (ReplicateError, httpx.TransportError) as error:
+                logger.warning("Ошибка опроса предсказания %s, повторим: %s", prediction.id, error)
+    for loser in race.running():
+        _cancel_quietly(loser)
+    race.finish(winner)
+    return winner
+
+
+async def _await_prediction(
+    client: replicate.Client, race: _Race, input_payload: Dict[str, object]
+) -> Prediction:
+    """Асинхронный вариант `_wait_for_prediction`: ожидание не занимает поток."""
+    timeout = CONFIG.providers.replicate_prediction_timeout
+    deadline = race.started + timeout
+    while (winner := race.winner()) is None:
+        _raise_if_detached(race)
+        if time.monotonic() > deadline:
+            for prediction in race.running():
+                await _acancel_quietly(prediction)
+            raise TimeoutError(f"Предсказание {race.primary.id} не завершилось за {timeout}s, отменено")
+        if race.should_hedge():
+            race.add_hedge(await _alaunch_hedge(client, race.model, input_payload))
+        await asyncio.sleep(CONFIG.providers.replicate_poll_interval)
+        running = race.running()
+        results = await asyncio.gather(
+            *(prediction.async_reload() for prediction in running), return_exceptions=True
+        )
+        for prediction, result in zip(running, results):
+            if isinstance(result, (ReplicateError, httpx.TransportError)):
+                logger.warning("Ошибка опроса предсказания %s, повторим: %s", prediction.id, result)
+            elif isinstance(result, BaseException):
+                raise result
+    for loser in race.running():
+        await _acancel_quietly(loser)
+    race.finish(winner)
+    return winner
+
+
+def _forget_if_finished(race: _Race, key: Optional[str]) -> None:
+    # Незавершенное предсказание (процесс останавливается) остается в журнале для возобновления
+    for prediction in race.predictions:
+        _untrack(prediction)
+    if key and (race.primary.status in _TERMINAL_STATUSES or race.winner() is not None):
+        PREDICTION_STORE.remove(key)
+
+
+def _run_prediction(model: str, input_payload: Dict[str, object]) -> List[str]:
+    """Создает (или возобновляет) предсказание, дожидается его и возвращает ссылки на результаты."""
+    client = _CLIENT.get()
+    key = _prediction_key(model, input_payload)
+    race = _Race(model, _start_prediction(client, model, input_payload, key))
+    _track(race.primary)
+    with PREDICTION_SECONDS.time(model=model) as timer:
+        try:
+            output = _prediction_output(_wait_for_prediction(client, race, input_payload))
+        except TimeoutError:
+            timer.outcome = "timeout"
+            raise
+        finally:
+            timer.outcome = timer.outcome or (race.winner() or race.primary).status
+            _forget_if_finished(race, key)
+    return _output_urls(output)
+
+
+async def _arun_prediction(model: str, input_payload: Dict[str, object]) -> List[str]:
+    """Асинхронный вариант `_run_prediction`."""
+    client = _ASYNC_CLIENT.get()
+    key = _prediction_key(model, input_payload)
+    race = _Race(model, await _astart_prediction(client, model, input_payload, key))
+    _track(race.primary)
+    with PREDICTION_SECONDS.time(model=model) as timer:
+        try:
+            output = _prediction_output(await _await_prediction(client, race, input_payload))
+        except TimeoutError:
+            timer.outcome = "timeout"
+            raise
+        finally:
+            timer.outcome = timer.outcome or (race.winner() or race.primary).status
+            _forget_if_finished(race, key)
+    return _output_urls(output)
+
+
+def _run_with_retries(model: str, input_payload: Dict[str, object]) -> bytes:
+    return _fetch_images(_run_prediction(model, input_payload)[:1])[0]
+
+
+def _run_spooled(model: str, input_payload: Dict[str, object]) -> SpooledImage:
+    """Как `_run_with_retries`, но результат скачивается потоком во временный буфер."""
+    url = _run_prediction(model, input_payload)[0]
+    with DOWNLOAD_SECONDS.time():
+        return download_to_spool(url)
+
+
+async def _arun_with_retries(model: str, input_payload: Dict[str, object]) -> bytes:
+    return (await _afetch_images((await _arun_prediction(model, input_payload))[:1]))[0]
+
+
+async def _arun_spooled(model: str, input_payload: Dict[str, object]) -> SpooledImage:
+    url = (await _arun_prediction(model, input_payload))[0]
+    with DOWNLOAD_SECONDS.time():
+        return await adownload_to_spool(url)
+
+
+def _claim_for_cancel(owner: Hashable) -> Tuple[List[str], int]:
+    """
+    Предсказания владельца, которые можно отменить в Replicate (их ждет только он),
+    и число общих с другими чатами: от них владелец отвязывается без отмены.
+    """
+    to_cancel: List[str] = []
+    detached = 0
+    with _IN_FLIGHT_LOCK:
+        for prediction_id, owners in _IN_FLIGHT.items():
+            if owner not in owners:
+                continue
+            if all(holder == owner for holder in owners):
+                to_cancel.append(prediction_id)
+                continue
+            owners[:] = [holder for holder in owners if holder != owner]
+            _DETACHED.setdefault(prediction_id, set()).add(owner)
+            detached += 1
+    if detached:
+        logger.info("Владелец %s отвязан от общих предсказаний: %s", owner, detached)
+    return to_cancel, detached
+
+
+def cancel_predictions(owner: Hashable) -> int:
+    """
+    Отменяет предсказания владельца, которые сейчас выполняются, и освобождает квоту.
+    Ожидающий их код получит PredictionCanceledError при следующем опросе.
+    Предсказание, которого ждут и задачи других чатов, не отменяется: перестают
+    ждать только задачи этого владельца.
+
+    Returns:
+        Количество отмененных (и отвязанных) предсказаний
+    """
+    client = _CLIENT.get()
+    prediction_ids, canceled = _claim_for_cancel(owner)
+    for prediction_id in prediction_ids:
+        try:
+            client.predictions.cancel(prediction_id)
+            canceled += 1
+        except (ReplicateError, httpx.TransportError) as error:
+            logger.warning("Не удалось отменить предсказание %s: %s", prediction_id, error)
+    return canceled
+
+
+async def acancel_predictions(owner: Hashable) -> int:
+    """Асинхронный вариант `cancel_predictions`."""
+    client = _ASYNC_CLIENT.get()
+    prediction_ids, canceled = _claim_for_cancel(owner)
+    for prediction_id in prediction_ids:
+        try:
+            await client.predictions.async_cancel(prediction_id)
+            canceled += 1
+        except (ReplicateError, httpx.TransportError) as error:
+            logger.warning("Не удалось отменить предсказание %s: %s", prediction_id, error)
+    if canceled:
+        logger.info("Отменено предсказаний для %s: %s", owner, canceled)
+    return canceled
+
+
+async def asweep_orphaned_predictions(grace_seconds: float) -> int:
+    """
+    Разбирает записи журнала, оставшиеся с прошлого запуска.
+
+    Запись возобновляется, только если ту же задачу отправят снова, поэтому
+    сначала ждем `grace_seconds`. Затем невостребованные предсказания, которые
+    еще выполняются, отменяются (чтобы не платить за результат, который никто
+    не заберет), а записи удаляются. Если Replicate недоступен, запись остается
+    до истечения MAX_AGE_SECONDS журнала.
+
+    Returns:
+        Количество отмененных предсказаний
+    """
+    snapshot = PREDICTION_STORE.pending()
+    if not snapshot:
+        return 0
+    logger.info("В журнале %s предсказаний с прошлого запуска, разбор через %.0f с", len(snapshot), grace_seconds)
+    await asyncio.sleep(grace_seconds)
+
+    client = _ASYNC_CLIENT.get()
+    canceled = 0
+    for key, entry in snapshot.items():
+        prediction_id = entry["id"]
+        if not PREDICTION_STORE.is_orphan(key, prediction_id):
+            continue
+        try:
+            prediction = await client.predictions.async_get(prediction_id)
+            status = prediction.status
+            running = status not in _TERMINAL_STATUSES
+            if running and PREDICTION_STORE.is_orphan(key, prediction_id):
+                await client.predictions.async_cancel(prediction_id)
+                canceled += 1
+        except ReplicateError as error:
+            if error.status != 404:
+                logger.warning("Не удалось разобрать предсказание %s из журнала: %s", prediction_id, error)
+                continue
+            # Replicate уже не знает это предсказание — возобновлять нечего
+            status, running = "not found", False
+        except httpx.TransportError as error:
+            logger.warning("Не удалось разобрать предсказание %s из журнала: %s", prediction_id, error)
+            continue
+        PREDICTION_STORE.drop_orphan(key, prediction_id, canceled=running)
+        logger.info(
+            "Предсказание %s (%s) из журнала: %s",
+            prediction_id, entry["model"], "отменено" if running else f"удалено ({status})",
+        )
+    return canceled
+
+
+def prediction_stats() -> Dict[str, Any]:
+    with _IN_FLIGHT_LOCK:
+        in_flight = len(_IN_FLIGHT)
+    return {"in_flight": in_flight, **PREDICTION_STORE.stats(), "hedging": HEDGING.stats()}
+
+
+def _base_payload(
+    prompt: str, width: int, height: int, steps: int, model: str, num_outputs: int = 1
+) -> Dict[str, object]:
     input_payload: Dict[str, object] = {
         "prompt": prompt,
         "width": width,
         "height": height,
-        "num_inference_steps": steps,
+        "num_inference_steps": _clamp_steps_for_model(model, steps),
         "disable_safety_checker": True,
     }
+    if num_outputs > 1:
+        # FLUX schnell/dev отдают до 4 изображений за одно предсказание
+        input_payload["num_outputs"] = min(num_outputs, MAX_OUTPUTS)
     logger.info("Запуск FLUX base генерации: %s", input_payload)
-
-    # Retry logic для обработки rate limiting (429 errors) и timeouts
-    max_retries = 5  # Увеличено до 5 попыток из-за rate limiting
-    for attempt in range(max_retries):
-        try:
-            output = client.run(base_model, input=input_payload)
-            break
-        except ReplicateError as e:
-            if e.status == 429 and attempt < max_retries - 1:
-                # При rate limit ждем дольше с каждой попыткой (exponential backoff)
-                wait_time = 15 * (attempt + 1)  # 15s, 30s, 45s, 60s
-                logger.warning(f"Rate limit достигнут, ожидание {wait_time}s перед попыткой {attempt + 2}/{max_retries}")
-                time.sleep(wait_time)
-            else:
-                logger.error(f"Replicate API error после {attempt + 1} попыток: %s", e)
-                raise
-        except (httpx.ReadTimeout, httpx.ConnectTimeout) as timeout_error:
-            if attempt < max_retries - 1:
-                wait_time = 10
-                logger.warning(f"Timeout error, повторная попытка {attempt + 2}/{max_retries} через {wait_time}s")
-                time.sleep(wait_time)
-            else:
-                logger.error(f"Timeout после {attempt + 1} попыток: %s", timeout_error)
-                raise
-
-    image_url = output[0] if isinstance(output, list) else str(output)
-    return _fetch_image(image_url)
+    return input_payload
 
 
-def inpaint_hat(base_image: bytes, mask_image: bytes, prompt: str, steps: int) -> bytes:
-    client = replicate.Client(api_token=CONFIG.providers.replicate_api_token)
+def _image_input(image: ImageSource, name: str) -> object:
+    handle = ImageHandle.of(image)
+    if CONFIG.providers.replicate_upload_files:
+        return _ImageUpload.png(handle, name)
+    # data URI раздувает JSON на треть, но не требует files API
+    return f"data:image/png;base64,{base64.b64encode(handle.png).decode('utf-8')}"
 
-    # Конвертируем изображения в data URIs для Replicate API
-    base_image_uri = f"data:image/png;base64,{base64.b64encode(base_image).decode('utf-8')}"
-    mask_image_uri = f"data:image/png;base64,{base64.b64encode(mask_image).decode('utf-8')}"
 
+def _fill_payload(
+    base_image: ImageSource, mask_image: ImageSource, prompt: str, steps: int
+) -> Dict[str, object]:
     input_payload: Dict[str, object] = {
         "prompt": prompt,
-        "image": base_image_uri,
-        "mask": mask_image_uri,
+        "image": _image_input(base_image, "base"),
+        "mask": _image_input(mask_image, "mask"),
         "num_inference_steps": steps,
         "disable_safety_checker": True,
+        # Формат и качество задаются на стороне Replicate: скачивается уже компактный файл
+        "output_format": CONFIG.providers.flux_output_format,
     }
+    if CONFIG.providers.flux_output_quality > 0:
+        input_payload["output_quality"] = CONFIG.providers.flux_output_quality
     logger.info("Запуск FLUX fill для инпейнтинга")
+    return input_payload
+
+
+def generate_base_model_image(
+    prompt: str, width: int, height: int, steps: int, model: Optional[str] = None
+) -> bytes:
+    base_model = model or CONFIG.providers.flux_base_model
+    return _run_with_retries(base_model, _base_payload(prompt, width, height, steps, base_model))
+
+
+async def agenerate_base_model_image(
+    prompt: str, width: int, height: int, steps: int, model: Optional[str] = None
+) -> bytes:
+    """Асинхронный вариант `generate_base_model_image`, не занимает поток на время генерации."""
+    base_model = model or CONFIG.providers.flux_base_model
+    return await _arun_with_retries(base_model, _base_payload(prompt, width, height, steps, base_model))
+
+
+def generate_base_model_images(
+    prompt: str, width: int, height: int, steps: int, model: Optional[str] = None, num_outputs: int = 1
+) -> List[bytes]:
+    """
+    Несколько кандидатов base портрета одним предсказанием (`num_outputs`).
+
+    Модели без поддержки нескольких выходов возвращают одно изображение,
+    поэтому кандидатов может оказаться меньше запрошенного.
+    """
+    base_model = model or CONFIG.providers.flux_base_model
+    payload = _base_payload(prompt, width, height, steps, base_model, num_outputs)
+    return _fetch_images(_run_prediction(base_model, payload))
+
+
+async def agenerate_base_model_images(
+    prompt: str, width: int, height: int, steps: int, model: Optional[str] = None, num_outputs: int = 1
+) -> List[bytes]:
+    """Асинхронный вариант `generate_base_model_images`; кандидаты скачиваются параллельно."""
+    base_model = model or CONFIG.providers.flux_base_model
+    payload = _base_payload(prompt, width, height, steps, base_model, num_outputs)
+    return await _afetch_images(await _arun_prediction(base_model, payload))
+
+
+def inpaint_hat(base_image: ImageSource, mask_image: ImageSource, prompt: str, steps: int) -> SpooledImage:
+    """
+    FLUX Fill: шапка на портрете по маске. Результат скачивается потоком во
+    временный буфер (память, а крупнее порога — диск); закрыть его — забота вызывающего.
+    """
+    return _run_spooled(
+        CONFIG.providers.flux_fill_model, _fill_payload(base_image, mask_image, prompt, steps)
+    )
 
-    # Retry logic для обработки rate limiting (429 errors) и timeouts
-    max_retries = 5  # Увеличено до 5 попыток из-за rate limiting
-    for attempt in range(max_retries):
-        try:
-            output = client.run(CONFIG.providers.flux_fill_model, input=input_payload)
-            break
-        except ReplicateError as e:
-            if e.status == 429 and attempt < max_retries - 1:
-                # При rate limit ждем дольше с каждой попыткой (exponential backoff)
-                wait_time = 15 * (attempt + 1)  # 15s, 30s, 45s, 60s
-                logger.warning(f"Rate limit достигнут, ожидание {wait_time}s перед попыткой {attempt + 2}/{max_retries}")
-                time.sleep(wait_time)
-            else:
-                logger.error(f"Replicate API error после {attempt + 1} попыток: %s", e)
-                raise
-        except (httpx.ReadTimeout, httpx.ConnectTimeout) as timeout_error:
-            if attempt < max_retries - 1:
-                wait_time = 10
-                logger.warning(f"Timeout error, повторная попытка {attempt + 2}/{max_retries} через {wait_time}s")
-                time.sleep(wait_time)
-            else:
-                logger.error(f"Timeout после {attempt + 1} попыток: %s", timeout_error)
-                raise
 
-    image_url = output[0] if isinstance(output, list) else str(output)
-    return _fetch_image(image_url)
+async def ainpaint_hat(
+    base_image: ImageSource, mask_image: ImageSource, prompt: str, steps: int
+) -> SpooledImage:
+    """Асинхронный вариант `inpaint_hat`."""
+    return await _arun_spooled(
+        CONFIG.providers.flux_fill_model, _fill_payload(base_image, mask_image, prompt, steps)
+    )
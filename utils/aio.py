@@ -0,0 +1,47 @@
+import asyncio
+import threading
+import weakref
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Shared(Generic[T]):
+    """Лениво создаваемый долгоживущий объект (например, клиент с пулом соединений)."""
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._instance: Optional[T] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    def reset(self) -> None:
+        with self._lock:
+            self._instance = None
+
+
+class PerLoop(Generic[T]):
+    """
+    Один экземпляр на event loop.
+
+    Асинхронные httpx-клиенты привязаны к циклу, в котором открыты их
+    соединения, поэтому для каждого цикла держим свой долгоживущий клиент.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, T]" = weakref.WeakKeyDictionary()
+
+    def get(self) -> T:
+        loop = asyncio.get_running_loop()
+        instance = self._instances.get(loop)
+        if instance is None:
+            instance = self._factory()
+            self._instances[loop] = instance
+        return instance
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict, Generic, Hashable, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Album(Generic[T]):
+    items: List[T] = field(default_factory=list)
+    last_added: float = 0.0
+
+
+class AlbumCollector(Generic[T]):
+    """
+    Собирает фото одного альбома Telegram (media_group_id).
+
+    Telegram присылает альбом отдельными обновлениями с общим media_group_id.
+    Первое обновление группы ждет, пока в течение `window` секунд не придет
+    новое фото (каждое фото продлевает окно), и забирает весь альбом;
+    остальные обновления только добавляют свое фото. Работает в одном event loop.
+    """
+
+    def __init__(self, window: float):
+        self.window = max(0.0, window)
+        self._albums: Dict[Hashable, _Album[T]] = {}
+
+    async def collect(self, group_id: Hashable, item: T) -> Optional[List[T]]:
+        """
+        Returns:
+            Все элементы альбома для первого обновления группы, None для остальных
+        """
+        loop = asyncio.get_running_loop()
+        album = self._albums.get(group_id)
+        if album is not None:
+            album.items.append(item)
+            album.last_added = loop.time()
+            return None
+
+        album = _Album(items=[item], last_added=loop.time())
+        self._albums[group_id] = album
+        try:
+            while (remaining := album.last_added + self.window - loop.time()) > 0:
+                await asyncio.sleep(remaining)
+        finally:
+            self._albums.pop(group_id, None)
+        return album.items
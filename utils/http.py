@@ -0,0 +1,391 @@
+"""
+Общий HTTP-клиент для скачиваний и загрузок вне SDK провайдеров.
+
+Один долгоживущий httpx-клиент на процесс (и один async-клиент на event
+loop) держит keep-alive соединения, поэтому DNS, TCP и TLS оплачиваются
+один раз на хост, а не на каждое изображение. Поверх пула транспорт
+ограничивает одновременные запросы к одному хосту, повторяет
+идемпотентные GET/HEAD при сетевых ошибках и 429/5xx с экспоненциальной
+паузой и считает по хостам новые и переиспользованные соединения и
+задержки (метрики Prometheus и `http_stats()` для /stats).
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+import httpx
+
+from config import CONFIG
+from providers.cassette import cassette_transport
+from utils.aio import PerLoop, Shared
+from utils.images import SpooledImage
+from utils.logging import get_logger
+from utils.metrics import Counter, Histogram
+from utils.rate_limit import parse_retry_after
+
+logger = get_logger(__name__)
+
+try:  # pragma: no cover - optional dependency
+    import h2  # noqa: F401
+
+    _H2_AVAILABLE = True
+except Exception:  # pragma: no cover
+    _H2_AVAILABLE = False
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+RETRY_STATUSES = (429, 502, 503, 504)
+MAX_RETRY_AFTER_SECONDS = 30.0
+# Событие httpcore, по которому видно, что для запроса открыто новое соединение
+_CONNECT_EVENT = "connection.connect_tcp.complete"
+
+HTTP_REQUESTS = Counter(
+    "http_client_requests_total", "Запросы общего HTTP-клиента по хосту и результату", ("host", "method", "outcome")
+)
+HTTP_CONNECTIONS = Counter(
+    "http_client_connections_total", "Запросы по новому или переиспользованному соединению", ("host", "kind")
+)
+HTTP_RETRIES = Counter("http_client_retries_total", "Повторы идемпотентных запросов", ("host", "reason"))
+HTTP_SECONDS = Histogram("http_client_request_seconds", "Время до заголовков ответа по хосту", ("host",))
+
+
+class HostStats:
+    """Счетчики общего клиента по хостам — для /stats (метрики Prometheus ведутся отдельно)."""
+
+    WINDOW = 200
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, Dict[str, Any]] = defaultdict(
+            lambda: {"requests": 0, "new_connections": 0, "reused": 0, "errors": 0, "retries": 0, "latencies": []}
+        )
+
+    def observe(self, host: str, seconds: float, new_connection: bool, error: bool) -> None:
+        with self._lock:
+            entry = self._hosts[host]
+            entry["requests"] += 1
+            entry["new_connections" if new_connection else "reused"] += 1
+            entry["errors"] += int(error)
+            latencies: List[float] = entry["latencies"]
+            latencies.append(seconds)
+            if len(latencies) > self.WINDOW:
+                del latencies[: len(latencies) - self.WINDOW]
+
+    def retried(self, host: str) -> None:
+        with self._lock:
+            self._hosts[host]["retries"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hosts = {host: dict(entry, latencies=sorted(entry["latencies"])) for host, entry in self._hosts.items()}
+        result = {}
+        for host, entry in hosts.items():
+            latencies = entry.pop("latencies")
+            entry["reuse_rate"] = round(entry["reused"] / entry["requests"], 3) if entry["requests"] else 0.0
+            if latencies:
+                entry["p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 1)
+                entry["p95_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+            result[host] = entry
+        return result
+
+
+HOST_STATS = HostStats()
+
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    """Пауза перед повтором: Retry-After для 429/503, иначе экспонента с полным джиттером."""
+    if response is not None:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            return min(retry_after, MAX_RETRY_AFTER_SECONDS)
+    return random.uniform(0, CONFIG.http.retry_backoff_seconds * 2**attempt)
+
+
+def _trace_connects(request: httpx.Request, connected: List[bool], is_async: bool) -> None:
+    """Отмечает в `connected` открытие нового соединения (события httpcore), сохраняя уже установленный trace."""
+    previous = request.extensions.get("trace")
+    if is_async:
+
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            if event_name == _CONNECT_EVENT:
+                connected.append(True)
+            if previous is not None:
+                await previous(event_name, info)
+
+    else:
+
+        def trace(event_name: str, info: Dict[str, Any]) -> None:  # type: ignore[misc]
+            if event_name == _CONNECT_EVENT:
+                connected.append(True)
+            if previous is not None:
+                previous(event_name, info)
+
+    request.extensions = {**request.extensions, "trace": trace}
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """Тело ответа, по закрытию которого освобождается слот хоста."""
+
+    def __init__(self, stream: httpx.SyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield from self._stream
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+
+class _Once:
+    def __init__(self, action: Callable[[], None]):
+        self._action: Optional[Callable[[], None]] = action
+
+    def __call__(self) -> None:
+        action, self._action = self._action, None
+        if action is not None:
+            action()
+
+
+class PooledTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """
+    httpx транспорт поверх пула соединений: лимит одновременных запросов
+    к хосту (слот держится до закрытия тела ответа), повторы идемпотентных
+    запросов и наблюдение за переиспользованием соединений.
+
+    Async-экземпляр привязан к одному event loop (клиенты создаются через PerLoop).
+    """
+
+    def __init__(
+        self,
+        wrapped: Any,
+        max_per_host: int = 0,
+        retries: int = 0,
+    ):
+        self._wrapped = wrapped
+        self.max_per_host = max_per_host
+        self.retries = max(0, retries)
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._async_host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._slots_lock = threading.Lock()
+
+    def _host_slot(self, host: str) -> Optional[threading.BoundedSemaphore]:
+        if self.max_per_host <= 0:
+            return None
+        with self._slots_lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return slot
+
+    def _async_host_slot(self, host: str) -> Optional[asyncio.Semaphore]:
+        if self.max_per_host <= 0:
+            return None
+        slot = self._async_host_slots.get(host)
+        if slot is None:
+            slot = self._async_host_slots[host] = asyncio.Semaphore(self.max_per_host)
+        return slot
+
+    def _should_retry(self, request: httpx.Request, attempt: int) -> bool:
+        return request.method in IDEMPOTENT_METHODS and attempt < self.retries
+
+    def _record(
+        self, request: httpx.Request, started: float, connected: List[bool], outcome: str
+    ) -> None:
+        host = request.url.host
+        seconds = time.perf_counter() - started
+        HTTP_SECONDS.observe(seconds, host=host)
+        HTTP_REQUESTS.inc(host=host, method=request.method, outcome=outcome)
+        HTTP_CONNECTIONS.inc(host=host, kind="new" if connected else "reused")
+        HOST_STATS.observe(host, seconds, bool(connected), error=outcome == "error")
+
+    def _retrying(self, request: httpx.Request, reason: str, attempt: int) -> None:
+        HTTP_RETRIES.inc(host=request.url.host, reason=reason)
+        HOST_STATS.retried(request.url.host)
+        logger.info(
+            "HTTP %s %s: %s, повтор %s/%s", request.method, request.url.host, reason, attempt + 1, self.retries
+        )
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            connected: List[bool] = []
+            _trace_connects(request, connected, is_async=False)
+            slot = self._host_slot(request.url.host)
+            if slot is not None:
+                slot.acquire()
+            release = _Once(slot.release if slot is not None else lambda: None)
+            started = time.perf_counter()
+            try:
+                response = self._wrapped.handle_request(request)
+            except httpx.TransportError as error:
+                release()
+                self._record(request, started, connected, "error")
+                if not self._should_retry(request, attempt):
+                    raise
+                self._retrying(request, type(error).__name__, attempt)
+                time.sleep(_retry_delay(attempt, None))
+                attempt += 1
+                continue
+            self._record(request, started, connected, str(response.status_code))
+            if response.status_code in RETRY_STATUSES and self._should_retry(request, attempt):
+                response.close()
+                release()
+                self._retrying(request, str(response.status_code), attempt)
+                time.sleep(_retry_delay(attempt, response))
+                attempt += 1
+                continue
+            return httpx.Response(
+                status_code=response.status_code,
+                headers=response.headers,
+                stream=_ReleasingStream(response.stream, release),  # type: ignore[arg-type]
+                extensions=response.extensions,
+            )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            connected: List[bool] = []
+            _trace_connects(request, connected, is_async=True)
+            slot = self._async_host_slot(request.url.host)
+            if slot is not None:
+                await slot.acquire()
+            release = _Once(slot.release if slot is not None else lambda: None)
+            started = time.perf_counter()
+            try:
+                response = await self._wrapped.handle_async_request(request)
+            except httpx.TransportError as error:
+                release()
+                self._record(request, started, connected, "error")
+                if not self._should_retry(request, attempt):
+                    raise
+                self._retrying(request, type(error).__name__, attempt)
+                await asyncio.sleep(_retry_delay(attempt, None))
+                attempt += 1
+                continue
+            self._record(request, started, connected, str(response.status_code))
+            if response.status_code in RETRY_STATUSES and self._should_retry(request, attempt):
+                await response.aclose()
+                release()
+                self._retrying(request, str(response.status_code), attempt)
+                await asyncio.sleep(_retry_delay(attempt, response))
+                attempt += 1
+                continue
+            return httpx.Response(
+                status_code=response.status_code,
+                headers=response.headers,
+                stream=_AsyncReleasingStream(response.stream, release),  # type: ignore[arg-type]
+                extensions=response.extensions,
+            )
+
+    def close(self) -> None:
+        self._wrapped.close()
+
+    async def aclose(self) -> None:
+        await self._wrapped.aclose()
+
+
+def _http2_enabled() -> bool:
+    if CONFIG.http.http2 and not _H2_AVAILABLE:
+        logger.warning("HTTP_HTTP2=1, но пакет h2 не установлен (pip install 'httpx[http2]'), используем HTTP/1.1")
+        return False
+    return CONFIG.http.http2
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=CONFIG.http.max_connections,
+        max_keepalive_connections=CONFIG.http.max_keepalive_connections,
+        keepalive_expiry=CONFIG.http.keepalive_seconds,
+    )
+
+
+def _pooled(transport: Any) -> PooledTransport:
+    return PooledTransport(
+        cassette_transport(transport), max_per_host=CONFIG.http.max_per_host, retries=CONFIG.http.retries
+    )
+
+
+_HTTP: Shared[httpx.Client] = Shared(
+    lambda: httpx.Client(
+        timeout=CONFIG.http.timeout_seconds,
+        follow_redirects=True,
+        transport=_pooled(httpx.HTTPTransport(limits=_limits(), http2=_http2_enabled())),
+    )
+)
+_ASYNC_HTTP: PerLoop[httpx.AsyncClient] = PerLoop(
+    lambda: httpx.AsyncClient(
+        timeout=CONFIG.http.timeout_seconds,
+        follow_redirects=True,
+        transport=_pooled(httpx.AsyncHTTPTransport(limits=_limits(), http2=_http2_enabled())),
+    )
+)
+
+
+def http_client() -> httpx.Client:
+    """Общий на процесс клиент с пулом соединений."""
+    return _HTTP.get()
+
+
+def async_http_client() -> httpx.AsyncClient:
+    """Общий клиент текущего event loop."""
+    return _ASYNC_HTTP.get()
+
+
+def download_to_spool(url: str) -> SpooledImage:
+    """Скачивает файл кусками во временный буфер (память до HTTP_SPOOL_MEMORY_KB, дальше — диск)."""
+    image = SpooledImage(CONFIG.http.spool_memory_kb * 1024)
+    try:
+        with http_client().stream("GET", url) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes(SpooledImage.CHUNK_SIZE):
+                image.write(chunk)
+    except BaseException:
+        image.close()
+        raise
+    return image
+
+
+async def adownload_to_spool(url: str) -> SpooledImage:
+    """Асинхронный вариант `download_to_spool`; запись в буфер в памяти или в файл не блокирует надолго."""
+    image = SpooledImage(CONFIG.http.spool_memory_kb * 1024)
+    try:
+        async with async_http_client().stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(SpooledImage.CHUNK_SIZE):
+                image.write(chunk)
+    except BaseException:
+        image.close()
+        raise
+    return image
+
+
+def http_stats() -> Dict[str, Any]:
+    return {
+        "http2": CONFIG.http.http2 and _H2_AVAILABLE,
+        "max_per_host": CONFIG.http.max_per_host,
+        "hosts": HOST_STATS.stats(),
+    }
@@ -0,0 +1,209 @@
+"""
+Кодирование изображений в JPEG/WebP под бюджет байт.
+
+Вместо перебора качества и масштаба с полным кодированием на каждом шаге
+размер предсказывается по уменьшенной копии (probe): бисекция по качеству
+идет на probe, а полноразмерное изображение кодируется один раз (изредка —
+два-три, если предсказание пришлось уточнить по фактическому размеру).
+"""
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Set, Tuple, Union
+
+from PIL import Image
+
+from utils.images import ImageHandle, image_to_bytes
+
+FORMATS = ("JPEG", "WEBP")
+MEDIA_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+# Сторона probe: достаточно, чтобы плотность деталей была как у оригинала, и дешево кодировать
+PROBE_SIZE = 512
+MAX_FULL_ENCODES = 3
+# Результат, занявший такую долю бюджета, считается попаданием
+FILL_RATIO = 0.85
+
+EncoderSource = Union[bytes, ImageHandle, Image.Image]
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    format: str
+    quality: int
+    size: Tuple[int, int]
+    # Полноразмерные кодирования и кодирования probe — для бенчмарков и логов
+    encodes: int
+    probe_encodes: int = 0
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+
+def flatten_to_rgb(image: Image.Image, background: Tuple[int, int, int] = (255, 255, 255)) -> Image.Image:
+    """RGB-версия изображения; прозрачные области заливаются фоном (для JPEG)."""
+    if image.mode == "RGB":
+        return image
+    if image.mode == "P":
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA"):
+        flattened = Image.new("RGB", image.size, background)
+        flattened.paste(image, mask=image.split()[-1])
+        return flattened
+    return image.convert("RGB")
+
+
+def _as_rgb(source: EncoderSource, max_dimension: Optional[int]) -> Image.Image:
+    image = source if isinstance(source, Image.Image) else ImageHandle.of(source).image
+    image = flatten_to_rgb(image)
+    if max_dimension and max(image.size) > max_dimension:
+        image = image.copy()
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    return image
+
+
+def _save_params(format: str, quality: int, optimize: bool) -> Dict[str, object]:
+    if format == "WEBP":
+        return {"quality": quality, "method": 4}
+    return {"quality": quality, "optimize": optimize}
+
+
+def _scaled(image: Image.Image, scale: float) -> Image.Image:
+    if scale >= 1.0:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.Resampling.LANCZOS)
+
+
+def encode_image(
+    source: EncoderSource,
+    format: str = "JPEG",
+    quality: int = 85,
+    max_dimension: Optional[int] = None,
+    optimize: bool = True,
+) -> EncodedImage:
+    """Одно кодирование с фиксированным качеством (прозрачность заливается белым)."""
+    format = format.upper()
+    if format not in FORMATS:
+        raise ValueError(f"Неподдерживаемый формат {format!r}, ожидается один из {FORMATS}")
+    image = _as_rgb(source, max_dimension)
+    data = image_to_bytes(image, format=format, **_save_params(format, quality, optimize))
+    return EncodedImage(data=data, format=format, quality=quality, size=image.size, encodes=1)
+
+
+def _largest_quality(fits: Callable[[int], bool], low: int, high: int) -> Optional[int]:
+    """Наибольшее качество из [low, high], для которого fits; размер монотонно растет с качеством."""
+    if fits(high):
+        return high
+    if not fits(low):
+        return None
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def encode_to_budget(
+    source: EncoderSource,
+    max_bytes: int,
+    format: str = "JPEG",
+    max_dimension: Optional[int] = None,
+    min_quality: int = 25,
+    max_quality: int = 95,
+    scale_quality: int = 85,
+    min_scale: float = 0.3,
+    optimize: bool = True,
+) -> EncodedImage:
+    """
+    Кодирует изображение не больше чем в `max_bytes`.
+
+    Сначала ищется наибольшее качество из [min_quality, max_quality], при
+    котором предсказанный размер укладывается в бюджет. Если не укладывается
+    даже min_quality, изображение уменьшается (не меньше `min_scale`) и
+    кодируется с `scale_quality`. Размер полноразмерного кодирования
+    предсказывается по probe: байты probe × отношение площадей × поправка,
+    которая уточняется после каждого полного кодирования.
+
+    Если бюджет недостижим и при min_scale, возвращается наименьший результат.
+    """
+    format = format.upper()
+    if format not in FORMATS:
+        raise ValueError(f"Неподдерживаемый формат {format!r}, ожидается один из {FORMATS}")
+    image = _as_rgb(source, max_dimension)
+    if max_bytes <= 0:
+        return encode_image(image, format, max_quality, optimize=optimize)
+
+    probe = image
+    if max(image.size) > PROBE_SIZE:
+        probe = image.copy()
+        probe.thumbnail((PROBE_SIZE, PROBE_SIZE), Image.Resampling.BILINEAR)
+    area_ratio = (image.width * image.height) / (probe.width * probe.height)
+    probe_bytes: Dict[int, int] = {}
+
+    def probe_size(quality: int) -> int:
+        if quality not in probe_bytes:
+            # optimize у probe не нужен: постоянная разница в размере уходит в поправку
+            probe_bytes[quality] = len(image_to_bytes(probe, format=format, **_save_params(format, quality, False)))
+        return probe_bytes[quality]
+
+    correction = 1.0
+
+    def predicted(quality: int, scale: float = 1.0) -> float:
+        return probe_size(quality) * area_ratio * scale * scale * correction
+
+    encodes = 0
+    fitting: Optional[EncodedImage] = None
+    smallest: Optional[EncodedImage] = None
+    tried: Set[Tuple[int, float]] = set()
+    while encodes < MAX_FULL_ENCODES:
+        quality = _largest_quality(lambda value: predicted(value) <= max_bytes, min_quality, max_quality)
+        if quality is not None:
+            scale = 1.0
+        else:
+            # Размер примерно пропорционален площади, то есть квадрату масштаба
+            quality = scale_quality
+            scale = max(min_scale, min(1.0, math.sqrt(max_bytes / predicted(quality))))
+        choice = (quality, round(scale, 3))
+        if choice in tried:
+            break
+        tried.add(choice)
+
+        scaled = _scaled(image, scale)
+        data = image_to_bytes(scaled, format=format, **_save_params(format, quality, optimize))
+        encodes += 1
+        result = EncodedImage(data, format, quality, scaled.size, encodes)
+        if len(data) <= max_bytes:
+            if fitting is None or (scale, quality) > (fitting.size[0] / image.width, fitting.quality):
+                fitting = result
+        elif smallest is None or len(data) < len(smallest.data):
+            smallest = result
+        correction *= len(data) / predicted(quality, scale)
+        # Влезли и бюджет почти выбран (или качество уже максимальное) — дальше уточнять нечего
+        if len(data) <= max_bytes and (len(data) >= FILL_RATIO * max_bytes or (quality, scale) == (max_quality, 1.0)):
+            break
+
+    best = fitting or smallest
+    assert best is not None
+    best.encodes = encodes
+    if fitting is None:
+        # Поправка не сошлась: добиваем уменьшением масштаба
+        best = _shrink_until_fits(image, best, max_bytes, min_scale, optimize)
+    best.probe_encodes = len(probe_bytes)
+    return best
+
+
+def _shrink_until_fits(
+    image: Image.Image, best: EncodedImage, max_bytes: int, min_scale: float, optimize: bool
+) -> EncodedImage:
+    scale = best.size[0] / image.width
+    while len(best.data) > max_bytes and scale > min_scale:
+        scale = max(min_scale, scale * math.sqrt(max_bytes / len(best.data)) * 0.95)
+        scaled = _scaled(image, scale)
+        data = image_to_bytes(scaled, format=best.format, **_save_params(best.format, best.quality, optimize))
+        best = EncodedImage(data, best.format, best.quality, scaled.size, best.encodes + 1)
+    return best
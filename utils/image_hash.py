@@ -1,5 +1,67 @@
 import hashlib
+from io import BytesIO
+from typing import Tuple
+
+from PIL import Image
+
+ColorSignature = Tuple[int, int, int]
 
 
 def sha256_hex(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()
+
+
+def dhash(image: Image.Image | bytes, hash_size: int = 8) -> int:
+    """
+    Перцептивный difference hash (dHash): устойчив к масштабу, сжатию
+    и небольшим изменениям кадрирования/экспозиции.
+
+    Returns:
+        Целое число из hash_size * hash_size бит
+    """
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(BytesIO(image))
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(gray.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(left: int, right: int) -> int:
+    return bin(left ^ right).count("1")
+
+
+def color_signature(image: Image.Image | bytes, size: int = 32) -> ColorSignature:
+    """
+    Средний RGB переднего плана: пиксели, заметно отличающиеся от цвета рамки
+    кадра (фона). dHash считается по яркости и цвет не различает — одинаковые
+    по форме шапки разных цветов отличает эта сигнатура. Если передний план
+    не выделился (однотонный кадр), усредняется весь кадр.
+    """
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(BytesIO(image))
+    pixels = list(image.convert("RGB").resize((size, size), Image.Resampling.BILINEAR).getdata())
+    border = [
+        pixels[row * size + col]
+        for row in range(size)
+        for col in range(size)
+        if row in (0, size - 1) or col in (0, size - 1)
+    ]
+    background = [sum(channel) / len(border) for channel in zip(*border)]
+    foreground = [
+        pixel for pixel in pixels
+        if sum(abs(value - bg) for value, bg in zip(pixel, background)) >= 60
+    ]
+    if len(foreground) < len(pixels) * 0.05:
+        foreground = pixels
+    return tuple(round(sum(channel) / len(foreground)) for channel in zip(*foreground))
+
+
+def color_distance(left: ColorSignature, right: ColorSignature) -> int:
+    """Наибольшая разница по каналу RGB между сигнатурами."""
+    return max(abs(a - b) for a, b in zip(left, right))
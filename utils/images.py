@@ -1,23 +1,28 @@
+import hashlib
+import shutil
+import tempfile
+import threading
 from io import BytesIO
-from typing import Tuple
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+
 from PIL import Image
 
+from utils.image_hash import dhash, sha256_hex
 
-def resize_to_max(image_bytes: bytes, max_size: int) -> tuple[bytes, Tuple[int, int]]:
-    image = Image.open(BytesIO(image_bytes)).convert("RGB")
-    image.thumbnail((max_size, max_size))
-    buf = BytesIO()
-    image.save(buf, format="PNG")
-    return buf.getvalue(), image.size
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8"
+WEBP_SIGNATURE = b"WEBP"
+EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
 
 
 def image_from_bytes(image_bytes: bytes) -> Image.Image:
     return Image.open(BytesIO(image_bytes))
 
 
-def image_to_bytes(image: Image.Image, format: str = "PNG") -> bytes:
+def image_to_bytes(image: Image.Image, format: str = "PNG", **params: object) -> bytes:
     buf = BytesIO()
-    image.save(buf, format=format)
+    image.save(buf, format=format, **params)
     return buf.getvalue()
 
 
@@ -25,3 +30,208 @@ def ensure_rgb(image: Image.Image) -> Image.Image:
     if image.mode != "RGB":
         return image.convert("RGB")
     return image
+
+
+class ImageHandle:
+    """
+    Изображение, которое декодируется один раз за задачу.
+
+    Держит исходные байты и лениво — декодированную картинку, ее RGB-версию,
+    кодировки (PNG, JPEG с заданным качеством), sha256 и dHash. Кодировка
+    в исходном формате — сами исходные байты, без перекодирования. Ручку
+    читают параллельные стадии графа, поэтому ленивые поля считаются под lock.
+    Картинки из ручки не изменяются на месте — для правок нужен copy().
+    """
+
+    def __init__(self, data: Optional[bytes] = None, image: Optional[Image.Image] = None):
+        if data is None and image is None:
+            raise ValueError("ImageHandle требует байты или изображение")
+        self._data = data
+        self._image = image
+        self._rgb: Optional[Image.Image] = None
+        self._encodings: Dict[Tuple[str, Optional[int]], bytes] = {}
+        self._resized: Dict[int, "ImageHandle"] = {}
+        self._sha256: Optional[str] = None
+        self._dhash: Optional[int] = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def of(cls, source: "ImageSource") -> "ImageHandle":
+        return source if isinstance(source, ImageHandle) else cls(bytes(source))
+
+    @property
+    def format(self) -> Optional[str]:
+        """Формат исходных байт (PNG, JPEG, ...); изображения без байт кодируются в PNG."""
+        if self._data is None:
+            return "PNG"
+        if self._data.startswith(PNG_SIGNATURE):
+            return "PNG"
+        if self._data.startswith(JPEG_SIGNATURE):
+            return "JPEG"
+        return self.image.format
+
+    @property
+    def image(self) -> Image.Image:
+        """Декодированное изображение в исходном режиме (загружено сразу: Image.open ленив и не потокобезопасен)."""
+        with self._lock:
+            if self._image is None:
+                image = Image.open(BytesIO(self._data))  # type: ignore[arg-type]
+                image.load()
+                self._image = image
+            return self._image
+
+    @property
+    def rgb(self) -> Image.Image:
+        with self._lock:
+            if self._rgb is None:
+                self._rgb = ensure_rgb(self.image)
+            return self._rgb
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.image.size
+
+    @property
+    def data(self) -> bytes:
+        """Исходные байты; для ручки из изображения — его PNG."""
+        with self._lock:
+            if self._data is None:
+                self._data = image_to_bytes(self._image, format="PNG")  # type: ignore[arg-type]
+            return self._data
+
+    def encode(self, format: str = "PNG", quality: Optional[int] = None) -> bytes:
+        """Изображение в заданном формате; результат запоминается."""
+        format = format.upper()
+        if quality is None and format == self.format:
+            return self.data
+        key = (format, quality)
+        with self._lock:
+            encoded = self._encodings.get(key)
+            if encoded is None:
+                # JPEG не хранит альфу и палитру; PNG сохраняет исходный режим (маски — L)
+                source = self.rgb if format == "JPEG" else self.image
+                params = {"quality": quality} if quality is not None else {}
+                encoded = image_to_bytes(source, format=format, **params)
+                self._encodings[key] = encoded
+            return encoded
+
+    @property
+    def png(self) -> bytes:
+        return self.encode("PNG")
+
+    @property
+    def sha256(self) -> str:
+        """sha256 исходных байт."""
+        with self._lock:
+            if self._sha256 is None:
+                self._sha256 = sha256_hex(self.data)
+            return self._sha256
+
+    def dhash(self) -> int:
+        with self._lock:
+            if self._dhash is None:
+                self._dhash = dhash(self.image)
+            return self._dhash
+
+    def resized(self, max_size: int) -> "ImageHandle":
+        """
+        RGB-версия, вписанная в квадрат max_size. Фото, которое уже вписывается
+        и хранится в RGB PNG/JPEG, возвращается как есть — без перекодирования.
+        """
+        with self._lock:
+            cached = self._resized.get(max_size)
+            if cached is not None:
+                return cached
+            image = self.image
+            if max(image.size) <= max_size and image.mode == "RGB" and self.format in ("PNG", "JPEG"):
+                resized = self
+            else:
+                thumbnail = self.rgb.copy()
+                thumbnail.thumbnail((max_size, max_size))
+                resized = ImageHandle(image=thumbnail)
+            self._resized[max_size] = resized
+            return resized
+
+
+ImageSource = Union[bytes, ImageHandle]
+
+
+class SpooledImage:
+    """
+    Закодированное изображение во временном буфере: в памяти до `max_memory`
+    байт, сверх него — во временном файле на диске. Результат генерации
+    пишется сюда кусками по мере скачивания и отдается в Telegram, кэш и
+    debug/ как файл — без полной копии байт на каждом шаге. sha256 и формат
+    считаются при записи. Читать буфер одновременно из нескольких потоков нельзя.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, max_memory: int = 1024 * 1024):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._hash = hashlib.sha256()
+        self._head = b""
+        self.size = 0
+
+    @classmethod
+    def from_bytes(cls, data: bytes, max_memory: int = 1024 * 1024) -> "SpooledImage":
+        image = cls(max_memory)
+        image.write(data)
+        return image
+
+    @classmethod
+    def from_path(cls, path: Path, max_memory: int = 1024 * 1024) -> "SpooledImage":
+        image = cls(max_memory)
+        with open(path, "rb") as source:
+            for chunk in iter(lambda: source.read(cls.CHUNK_SIZE), b""):
+                image.write(chunk)
+        return image
+
+    def write(self, chunk: bytes) -> None:
+        if len(self._head) < 16:
+            self._head += chunk[: 16 - len(self._head)]
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def format(self) -> str:
+        if self._head.startswith(PNG_SIGNATURE):
+            return "PNG"
+        if self._head.startswith(JPEG_SIGNATURE):
+            return "JPEG"
+        if self._head[8:12] == WEBP_SIGNATURE:
+            return "WEBP"
+        return "PNG"
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.format]
+
+    @property
+    def on_disk(self) -> bool:
+        return bool(getattr(self._file, "_rolled", False))
+
+    def open(self) -> BinaryIO:
+        """Файловый объект буфера с начала (один на буфер — позиция общая)."""
+        self._file.seek(0)
+        return self._file  # type: ignore[return-value]
+
+    def read(self) -> bytes:
+        return self.open().read()
+
+    def copy_to(self, path: Path) -> None:
+        with open(path, "wb") as target:
+            shutil.copyfileobj(self.open(), target, self.CHUNK_SIZE)
+
+    def decode(self) -> Image.Image:
+        image = Image.open(self.open())
+        image.load()
+        return image
+
+    def close(self) -> None:
+        self._file.close()
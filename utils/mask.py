@@ -1,13 +1,21 @@
-from typing import Tuple
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
 from PIL import Image, ImageDraw
 
+from config import CONFIG
+from utils.image_hash import sha256_hex
 from utils.logging import get_logger
 
 logger = get_logger(__name__)
 
 
 try:  # pragma: no cover - optional dependency
-    from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+    import numpy as np
+    from segment_anything import sam_model_registry, SamPredictor
     _SAM_AVAILABLE = True
 except Exception:  # pragma: no cover
     _SAM_AVAILABLE = False
@@ -17,6 +25,30 @@ class MaskGenerationError(Exception):
     pass
 
 
+# Область шапки в долях размера кадра (портрет по плечи, голова по центру сверху).
+# Эти же параметры задают эллипс fallback-маски и промпт-бокс для SAM.
+_HAT_CENTER_Y = 0.20
+_HAT_HEIGHT = 0.28
+_HAT_WIDTH = 0.62
+# Нижняя граница маски: ниже начинаются лоб/глаза/лицо
+_HAT_BOTTOM_LIMIT = 0.39
+
+# Резидентная модель SAM и кэш эмбеддингов изображений
+_SAM_LOCK = threading.Lock()
+_SAM_PREDICTOR: Optional[Any] = None
+# Почему SAM не используется (нет пакета или весов); None — SAM доступен или еще не загружался
+_SAM_DISABLED_REASON: Optional[str] = None if _SAM_AVAILABLE else "segment_anything не установлен"
+_EMBEDDINGS: "OrderedDict[str, Tuple[Any, Any, Any]]" = OrderedDict()
+_STATS: Dict[str, Any] = {
+    "sam_load_seconds": None,
+    "sam_masks": 0,
+    "sam_mask_seconds_total": 0.0,
+    "sam_last_mask_seconds": None,
+    "embedding_hits": 0,
+    "ellipse_masks": 0,
+}
+
+
 def _ellipse_mask(size: Tuple[int, int]) -> Image.Image:
     """
     Создает эллиптическую маску для верхней части головы (область шапки).
@@ -31,9 +63,9 @@ def _ellipse_mask(size: Tuple[int, int]) -> Image.Image:
     # Центр эллипса: 0.20 * высоты (самая верхняя часть головы)
     # Высота эллипса: 0.28 * высоты (компактная область)
     # Ширина эллипса: 0.62 * ширины (покрывает ширину головы)
-    center_y = height * 0.20
-    ellipse_height = height * 0.28
-    ellipse_width = width * 0.62
+    center_y = height * _HAT_CENTER_Y
+    ellipse_height = height * _HAT_HEIGHT
+    ellipse_width = width * _HAT_WIDTH
 
     ellipse_box = (
         width * 0.5 - ellipse_width / 2,   # left
@@ -44,7 +76,7 @@ def _ellipse_mask(size: Tuple[int, int]) -> Image.Image:
 
     # Проверяем, что нижняя граница эллипса не опускается ниже 0.39 * height
     # (чтобы НЕ захватить лоб/глаза/лицо - маска ТОЛЬКО на макушке)
-    bottom_limit = height * 0.39
+    bottom_limit = height * _HAT_BOTTOM_LIMIT
     if ellipse_box[3] > bottom_limit:
         logger.warning(
             f"Ellipse bottom {ellipse_box[3]:.0f} exceeds safe limit {bottom_limit:.0f}, adjusting"
@@ -56,29 +88,129 @@ def _ellipse_mask(size: Tuple[int, int]) -> Image.Image:
     return mask
 
 
+def load_sam_model() -> Optional[Any]:
+    """
+    Загружает SAM один раз и держит в памяти. Повторные вызовы возвращают
+    ту же модель. None, если segment_anything не установлен или веса
+    (`SAM_CHECKPOINT`) не заданы либо не найдены: модель без весов дает
+    бессмысленные маски, поэтому тогда используется эллиптическая маска.
+    """
+    global _SAM_PREDICTOR, _SAM_DISABLED_REASON
+    if _SAM_DISABLED_REASON is not None:
+        return None
+    if _SAM_PREDICTOR is None:
+        with _SAM_LOCK:
+            if _SAM_PREDICTOR is None and _SAM_DISABLED_REASON is None:  # pragma: no cover - optional heavy path
+                checkpoint = CONFIG.pipeline.sam_checkpoint
+                if not checkpoint:
+                    _SAM_DISABLED_REASON = "SAM_CHECKPOINT не задан"
+                elif not os.path.isfile(checkpoint):
+                    _SAM_DISABLED_REASON = f"файл весов SAM не найден: {checkpoint}"
+                if _SAM_DISABLED_REASON is not None:
+                    logger.warning("SAM отключен (%s), используется эллиптическая маска", _SAM_DISABLED_REASON)
+                    return None
+                started = time.perf_counter()
+                sam = sam_model_registry[CONFIG.pipeline.sam_model_type](checkpoint=checkpoint)
+                sam.eval()
+                _SAM_PREDICTOR = SamPredictor(sam)
+                _STATS["sam_load_seconds"] = round(time.perf_counter() - started, 3)
+                logger.info(
+                    "SAM %s загружен за %.2fs", CONFIG.pipeline.sam_model_type, _STATS["sam_load_seconds"]
+                )
+    return _SAM_PREDICTOR
+
+
+def _set_image_cached(predictor: Any, image: Image.Image) -> None:  # pragma: no cover - optional heavy path
+    """
+    Считает эмбеддинг изображения или восстанавливает его из кэша, чтобы
+    повторная маска того же портрета не запускала энкодер. Вызывать под _SAM_LOCK.
+    """
+    key = sha256_hex(image.tobytes())
+    cached = _EMBEDDINGS.get(key)
+    if cached is not None:
+        predictor.features, predictor.original_size, predictor.input_size = cached
+        predictor.is_image_set = True
+        _EMBEDDINGS.move_to_end(key)
+        _STATS["embedding_hits"] += 1
+        return
+
+    predictor.set_image(np.array(image))
+    if CONFIG.pipeline.sam_embedding_cache_size > 0:
+        _EMBEDDINGS[key] = (predictor.features, predictor.original_size, predictor.input_size)
+        while len(_EMBEDDINGS) > CONFIG.pipeline.sam_embedding_cache_size:
+            _EMBEDDINGS.popitem(last=False)
+
+
+def _sam_hat_mask(image: Image.Image) -> Optional[Image.Image]:  # pragma: no cover - optional heavy path
+    """
+    Сегментация SAM с промптом: бокс вокруг ожидаемой области шапки и точка
+    на макушке вместо автоматической генерации всех масок. Результат
+    обрезается по безопасной нижней границе, чтобы не задеть лицо.
+    """
+    predictor = load_sam_model()
+    if predictor is None:
+        return None
+
+    width, height = image.size
+    box = np.array([
+        width * (0.5 - _HAT_WIDTH / 2),
+        height * max(0.0, _HAT_CENTER_Y - _HAT_HEIGHT / 2),
+        width * (0.5 + _HAT_WIDTH / 2),
+        height * _HAT_BOTTOM_LIMIT,
+    ])
+    point = np.array([[width * 0.5, height * _HAT_CENTER_Y]])
+
+    started = time.perf_counter()
+    with _SAM_LOCK:
+        _set_image_cached(predictor, image)
+        masks, scores, _ = predictor.predict(
+            point_coords=point, point_labels=np.array([1]), box=box, multimask_output=True
+        )
+    elapsed = time.perf_counter() - started
+
+    _STATS["sam_masks"] += 1
+    _STATS["sam_mask_seconds_total"] += elapsed
+    _STATS["sam_last_mask_seconds"] = round(elapsed, 3)
+    logger.info("SAM маска построена за %.3fs", elapsed)
+
+    chosen = masks[int(np.argmax(scores))]
+    chosen[int(height * _HAT_BOTTOM_LIMIT):, :] = False
+    if not chosen.any():
+        return None
+    return Image.fromarray(chosen.astype("uint8") * 255)
+
+
 def create_head_mask(image: Image.Image) -> Image.Image:
-    """Generate an alpha mask for the hat area using SAM when available, otherwise ellipse fallback."""
+    """Generate an alpha mask for the hat area using prompted SAM when available, otherwise ellipse fallback."""
     if image.mode != "RGB":
         image = image.convert("RGB")
 
     if _SAM_AVAILABLE:
         try:  # pragma: no cover - optional heavy path
-            sam = sam_model_registry.get("vit_b")()
-            generator = SamAutomaticMaskGenerator(sam)
-            masks = generator.generate(image)
-            if masks:
-                # pick largest mask near top center
-                sorted_masks = sorted(masks, key=lambda m: m.get("area", 0), reverse=True)
-                chosen = sorted_masks[0]
-                mask_image = Image.fromarray(chosen["segmentation"].astype("uint8") * 255)
+            mask_image = _sam_hat_mask(image)
+            if mask_image is not None:
                 return mask_image
         except Exception as error:
             logger.warning("SAM mask generation failed, using ellipse: %s", error)
 
     logger.info("Using fallback ellipse mask")
+    _STATS["ellipse_masks"] += 1
     return _ellipse_mask(image.size)
 
 
+def get_mask_stats() -> Dict[str, Any]:
+    """Время загрузки SAM и задержка построения масок."""
+    masks = _STATS["sam_masks"]
+    return {
+        **_STATS,
+        "sam_available": _SAM_AVAILABLE,
+        "sam_loaded": _SAM_PREDICTOR is not None,
+        "sam_disabled_reason": _SAM_DISABLED_REASON,
+        "sam_mask_seconds_total": round(_STATS["sam_mask_seconds_total"], 3),
+        "sam_avg_mask_seconds": round(_STATS["sam_mask_seconds_total"] / masks, 3) if masks else None,
+    }
+
+
 def mask_with_alpha(image: Image.Image, mask_l: Image.Image) -> Image.Image:
     rgba = image.convert("RGBA")
     alpha = mask_l.resize(image.size)
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class MediaIndex:
+    """
+    Индекс загруженных в WordPress Media Library изображений по содержимому.
+
+    Ключ — SHA-256 сжатых байт, которые уходят в POST; значение — ID и URL
+    вложения. Записи разделены по сайтам: одинаковые байты на другом сайте —
+    другое вложение. Запись может устареть (вложение удалили в админке),
+    поэтому при попадании ее проверяет вызывающий код, если с последней
+    проверки прошло больше `verify_seconds`; исчезнувшие записи удаляются.
+    Поиск и загрузку одних и тех же байт вызывающий код выполняет внутри
+    `reserve`, чтобы параллельные потоки не загрузили их дважды.
+    """
+
+    def __init__(self, path: str | Path, verify_seconds: float, enabled: bool = True):
+        self.path = Path(path)
+        self.verify_seconds = verify_seconds
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.uploads = 0
+        self._lock = threading.Lock()
+        # (сайт, хеш) → [замок загрузки, число потоков, которые его держат или ждут]
+        self._reservations: Dict[Tuple[str, str], List[Any]] = {}
+        self._entries: Optional[Dict[str, Dict[str, Dict[str, Any]]]] = None
+
+    def _load(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                self._entries = {}
+            except (OSError, ValueError) as error:
+                logger.warning("Не удалось прочитать индекс медиафайлов %s: %s", self.path, error)
+                self._entries = {}
+        return self._entries
+
+    def _save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+            tmp_path.replace(self.path)
+        except OSError as error:
+            logger.warning("Не удалось сохранить индекс медиафайлов: %s", error)
+
+    @contextmanager
+    def reserve(self, site: str, digest: str) -> Iterator[None]:
+        """Один поток на хеш: остальные ждут, пока первый найдет или загрузит вложение."""
+        key = (site, digest)
+        with self._lock:
+            reservation = self._reservations.setdefault(key, [threading.Lock(), 0])
+            reservation[1] += 1
+        try:
+            with reservation[0]:
+                yield
+        finally:
+            with self._lock:
+                reservation[1] -= 1
+                if not reservation[1]:
+                    del self._reservations[key]
+
+    def lookup(self, site: str, digest: str) -> Optional[Dict[str, Any]]:
+        """Копия записи для хеша на сайте или None; счетчик попаданий обновляет confirm/forget."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._load().get(site, {}).get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            return dict(entry)
+
+    def needs_verification(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry.get("verified_at", 0) >= self.verify_seconds
+
+    def confirm(self, site: str, digest: str, verified: bool = False, **fields: Any) -> None:
+        """Попадание: вложение переиспользовано (verified — только что проверено на сайте)."""
+        with self._lock:
+            self.hits += 1
+            entry = self._load().get(site, {}).get(digest)
+            if entry is not None and verified:
+                entry.update(fields, verified_at=time.time())
+                self._save()
+
+    def forget(self, site: str, digest: str) -> None:
+        """Вложение удалено на сайте — запись больше не годится."""
+        with self._lock:
+            self.stale += 1
+            self.misses += 1
+            if self._load().get(site, {}).pop(digest, None) is not None:
+                self._save()
+
+    def store(self, site: str, digest: str, media: Dict[str, Any]) -> None:
+        with self._lock:
+            self.uploads += 1
+            if not self.enabled:
+                return
+            now = time.time()
+            self._load().setdefault(site, {})[digest] = {
+                "id": media["id"], "url": media["url"], "title": media.get("title", ""),
+                "created_at": now, "verified_at": now,
+            }
+            self._save()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": sum(len(site) for site in self._load().values()),
+                "uploads": self.uploads,
+                "dedup_hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+            }
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from io import BytesIO
+from typing import Dict, List, Optional
+
+from PIL import Image
+from telegram import Message
+from telegram.error import TelegramError
+
+from pipeline.graph import StageEvent
+from utils.logging import get_logger
+from utils.metrics import Histogram
+
+logger = get_logger(__name__)
+
+TELEGRAM_SECONDS = Histogram(
+    "telegram_io_seconds", "Загрузка и отправка файлов через Telegram", ("operation", "outcome")
+)
+
+# Стадии, которые видит пользователь; служебные (resize, хеши, кэши) не показываем
+STAGE_LABELS = {
+    "spec": "Анализ шапки",
+    "base": "Портрет модели",
+    "mask": "Маска",
+    "final_bytes": "Инпейтинг",
+}
+PREVIEW_SIZE = 256
+
+
+def _render_preview(image: Image.Image) -> bytes:
+    preview = image.copy()
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    buffer = BytesIO()
+    preview.convert("RGB").save(buffer, format="JPEG", quality=70)
+    return buffer.getvalue()
+
+
+class ProgressMessage:
+    """
+    Живой статус обработки в одном сообщении Telegram.
+
+    Подписывается на события стадий пайплайна (`on_event` можно вызывать из
+    любого потока), редактирует статусное сообщение по мере завершения стадий
+    с длительностью каждой и присылает уменьшенное превью портрета, как только
+    он готов. Накопившиеся события сливаются в одно редактирование.
+    `subject` — что обрабатывается («фото», «альбом из 3 фото») для заголовка.
+    """
+
+    def __init__(self, status: Message, reply_to: Message, subject: str = "фото"):
+        self._status = status
+        self._reply_to = reply_to
+        self._subject = subject
+        self._loop = asyncio.get_running_loop()
+        self._events: asyncio.Queue[Optional[StageEvent]] = asyncio.Queue()
+        self._lines: Dict[str, str] = {}
+        self._started: Optional[float] = None
+        self._text = status.text or ""
+        self._preview_sent = False
+        self._task = asyncio.create_task(self._consume(), name="progress-message")
+
+    def on_event(self, event: StageEvent) -> None:
+        self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    def _apply(self, event: StageEvent) -> None:
+        if self._started is None:
+            self._started = time.perf_counter()
+        if event.stage == "guard":
+            attempt = event.detail
+            if attempt["detector"] == "skipped":
+                # Кандидат не проверялся: уже выбран другой
+                return
+            verdict = "чисто" if attempt["verdict"] == "clean" else "найден головной убор"
+            if attempt["verdict"] == "unknown":
+                verdict = "не удалось проверить"
+            name = f"попытка {attempt['attempt']}"
+            if "candidate" in attempt:
+                name += f", кандидат {attempt['candidate']}"
+            self._lines[f"guard-{attempt['attempt']}-{attempt.get('candidate', 1)}"] = (
+                f"🔎 Проверка портрета, {name}: {verdict} ({attempt['detector']}, {event.elapsed:.1f}s)"
+            )
+            return
+        label = STAGE_LABELS.get(event.stage)
+        if label is None:
+            return
+        if event.status == "started":
+            self._lines[event.stage] = f"⏳ {label}..."
+        elif event.status == "finished":
+            self._lines[event.stage] = f"✅ {label} — {event.elapsed:.1f}s"
+        else:
+            self._lines[event.stage] = f"❌ {label}"
+
+    def _render(self, header: str) -> str:
+        return "\n".join([header, *self._lines.values()])
+
+    async def _edit(self, text: str) -> None:
+        if text == self._text:
+            return
+        try:
+            await self._status.edit_text(text)
+            self._text = text
+        except TelegramError as error:
+            logger.debug("Не удалось обновить статус: %s", error)
+
+    async def _send_preview(self, image: Image.Image) -> None:
+        self._preview_sent = True
+        try:
+            preview = BytesIO(await asyncio.to_thread(_render_preview, image))
+            preview.name = "preview.jpg"
+            with TELEGRAM_SECONDS.time(operation="send_preview"):
+                await self._reply_to.reply_photo(photo=preview, caption="👀 Портрет готов, надеваю шапку...")
+        except TelegramError as error:
+            logger.warning("Не удалось отправить превью портрета: %s", error)
+
+    async def _consume(self) -> None:
+        while True:
+            batch: List[Optional[StageEvent]] = [await self._events.get()]
+            while not self._events.empty():
+                batch.append(self._events.get_nowait())
+            preview: Optional[Image.Image] = None
+            for event in batch:
+                if event is None:
+                    continue
+                self._apply(event)
+                if event.stage == "base_image" and event.status == "finished" and not self._preview_sent:
+                    preview = event.result
+            if preview is not None:
+                await self._send_preview(preview)
+            if None in batch:
+                return
+            elapsed = time.perf_counter() - (self._started or time.perf_counter())
+            await self._edit(self._render(f"🤖 Обрабатываю {self._subject} · {elapsed:.0f}s"))
+
+    async def wait_in_queue(self, position: int) -> None:
+        """Показывает позицию в очереди; пропускается, если обработка уже началась."""
+        if self._started is not None:
+            return
+        subject = self._subject[:1].upper() + self._subject[1:]
+        await self._edit(f"⏳ {subject} в очереди, позиция: {position}. Начну обработку, как только освободится место.")
+
+    async def finish(self, header: str) -> None:
+        """Дожидается обработки накопленных событий и ставит итоговый заголовок."""
+        # Через call_soon: маркер встанет после событий, уже переданных из потоков
+        self._loop.call_soon(self._events.put_nowait, None)
+        await self._task
+        if self._started is not None:
+            header = f"{header} · {time.perf_counter() - self._started:.0f}s"
+        await self._edit(self._render(header))
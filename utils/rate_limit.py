@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional, Union
+
+import httpx
+
+from utils.logging import get_logger
+from utils.metrics import Counter
+
+logger = get_logger(__name__)
+
+RATE_LIMITED_RESPONSES = Counter(
+    "rate_limited_responses_total", "Ответы 429 от провайдеров", ("provider",)
+)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата) в секунды."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.replace(".", "", 1).isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class AdaptiveRateLimiter:
+    """
+    Общий на процесс token bucket с адаптацией скорости по AIMD.
+
+    Каждый вызов резервирует токен и ждет своей очереди (в т.ч. в минусе
+    баланса), поэтому одновременные воркеры выстраиваются друг за другом,
+    а не спят вслепую после 429. Успешные запросы аддитивно увеличивают
+    скорость, 429 — мультипликативно уменьшают ее и, при наличии Retry-After,
+    ставят паузу для всех. Работает из потоков и из asyncio.
+    """
+
+    def __init__(
+        self,
+        rate_per_minute: float,
+        min_rate_per_minute: float,
+        max_rate_per_minute: float,
+        burst: int = 1,
+        increase_per_minute: float = 1.0,
+        decrease_factor: float = 0.5,
+        name: str = "limiter",
+    ):
+        self.name = name
+        self.min_rate = min_rate_per_minute / 60
+        self.max_rate = max_rate_per_minute / 60
+        self.rate = min(max(rate_per_minute / 60, self.min_rate), self.max_rate)
+        self.burst = max(1, burst)
+        self.increase = increase_per_minute / 60
+        self.decrease_factor = decrease_factor
+
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        self.acquired = 0
+        self.rate_limited = 0
+        self.waited_seconds_total = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reserve(self) -> float:
+        """Резервирует токен и возвращает, сколько нужно подождать до запроса."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            wait = max(wait, self._paused_until - now)
+            self.acquired += 1
+            self.waited_seconds_total += wait
+        if wait > 0:
+            logger.info("%s: ожидание %.1fs в очереди лимитера", self.name, wait)
+        return wait
+
+    def acquire(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate_limited += 1
+            RATE_LIMITED_RESPONSES.inc(provider=self.name)
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            # Уже выданные токены не возвращаем, но новых авансом не даем
+            self._tokens = min(self._tokens, 0.0)
+            pause = retry_after if retry_after is not None else 1 / self.rate
+            self._paused_until = max(self._paused_until, now + pause)
+        logger.warning(
+            "%s: 429, скорость снижена до %.1f/мин, пауза %.1fs", self.name, self.rate * 60, pause
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rate_per_minute": round(self.rate * 60, 2),
+                "acquired": self.acquired,
+                "rate_limited": self.rate_limited,
+                "waited_seconds_total": round(self.waited_seconds_total, 1),
+                "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 1),
+            }
+
+
+class RateLimitTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """
+    httpx транспорт, который сообщает лимитеру о 429 (с Retry-After)
+    и об успешных POST-запросах. SDK Replicate теряет заголовки ответа
+    в ReplicateError, поэтому наблюдаем ответы на уровне транспорта.
+    """
+
+    def __init__(
+        self,
+        limiter: AdaptiveRateLimiter,
+        wrapped: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+    ):
+        self.limiter = limiter
+        self._wrapped = wrapped
+
+    def _observe(self, request: httpx.Request, response: httpx.Response) -> None:
+        if response.status_code == 429:
+            self.limiter.on_rate_limited(parse_retry_after(response.headers.get("Retry-After")))
+        elif request.method == "POST" and response.status_code < 400:
+            self.limiter.on_success()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = self._wrapped.handle_request(request)  # type: ignore[union-attr]
+        self._observe(request, response)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self._wrapped.handle_async_request(request)  # type: ignore[union-attr]
+        self._observe(request, response)
+        return response
+
+    def close(self) -> None:
+        self._wrapped.close()  # type: ignore[union-attr]
+
+    async def aclose(self) -> None:
+        await self._wrapped.aclose()  # type: ignore[union-attr]